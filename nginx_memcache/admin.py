@@ -1,16 +1,195 @@
-from django.contrib import admin
+from django.conf import settings
+from django.contrib import admin, messages
+from django.contrib.admin.views.main import ChangeList, PAGE_VAR
+from django.core.paginator import Paginator
+from django.db import connections
+from django.db.models import Q
 
+from nginx_memcache.cache import (
+    bulk_invalidate,
+    invalidate_keys,
+    iter_key_chunks
+)
 from nginx_memcache.models import CachedPageRecord
 
+# Query string parameter for keyset pagination: the changelist shows
+# the records whose keys come after this one
+AFTER_VAR = 'after'
+
+# Below this many rows, counting exactly is cheap enough
+EXACT_COUNT_LIMIT = 10000
+
+
+def estimate_row_count(model):
+    """Returns the database's own estimate of how many rows are in the
+    model's table, without counting them, or None if it can't say"""
+    connection = connections[model.objects.db]
+    table = model._meta.db_table
+    vendor = connection.vendor
+    cursor = connection.cursor()
+    if vendor == 'postgresql':
+        cursor.execute(
+            "SELECT reltuples FROM pg_class WHERE relname = %s", [table]
+        )
+    elif vendor == 'mysql':
+        cursor.execute(
+            "SELECT table_rows FROM information_schema.tables "
+            "WHERE table_schema = DATABASE() AND table_name = %s", [table]
+        )
+    else:
+        return None
+    row = cursor.fetchone()
+    if row is None or row[0] is None:
+        return None
+    return int(row[0])
+
+
+class EstimatedCountPaginator(Paginator):
+    """A paginator that never runs COUNT(*) over a whole, big table.
+
+    Unfiltered, it uses the database's own estimate of the table size. Once
+    filtered (eg by a search), it counts at most EXACT_COUNT_LIMIT + 1 rows,
+    so a search matching millions of rows costs the same as one matching
+    ten thousand.
+
+    """
+
+    def _get_count(self):
+        if self._count is None:
+            estimate = None
+            if not self.object_list.query.where:
+                estimate = estimate_row_count(self.object_list.model)
+            if estimate is not None and estimate > EXACT_COUNT_LIMIT:
+                self._count = estimate
+            else:
+                # Fetch (at most) that many keys, rather than COUNT(*),
+                # which would count every match
+                self._count = len(self.object_list.values_list(
+                    'pk', flat=True
+                )[:EXACT_COUNT_LIMIT + 1])
+        return self._count
+    count = property(_get_count)
+
+
+class CachedPageRecordChangeList(ChangeList):
+    """A changelist that stays quick however big the lookup table gets:
+
+        * searches are an exact match on base_cache_key, or a prefix match on
+          parent_identifier - both of which can use an index - rather than
+          case-insensitive substring matches on every column
+        * counts come from EstimatedCountPaginator
+        * pages are fetched by key (?after=<base_cache_key>) rather than by
+          offset, so the millionth page is as quick as the first
+
+    """
+
+    def get_query_set(self, request):
+        # Stop Django applying its own (icontains) search...
+        search, self.query = self.query, ''
+        try:
+            queryset = super(CachedPageRecordChangeList, self).get_query_set(
+                request
+            )
+        finally:
+            self.query = search
+        # ...and apply ours instead
+        for term in search.split():
+            queryset = queryset.filter(
+                Q(base_cache_key=term.lower()) |
+                Q(parent_identifier__startswith=term)
+            )
+        after = getattr(request, 'nginx_memcache_after', None)
+        if after:
+            queryset = queryset.filter(base_cache_key__gt=after)
+        return queryset.order_by('base_cache_key')
+
+    def get_results(self, request):
+        paginator = self.model_admin.get_paginator(
+            request, self.query_set, self.list_per_page
+        )
+        self.result_count = paginator.count
+        if self.query_set.query.where:
+            self.full_result_count = EstimatedCountPaginator(
+                self.root_query_set, self.list_per_page
+            ).count
+        else:
+            self.full_result_count = self.result_count
+        self.result_list = list(self.query_set[:self.list_per_page])
+        self.can_show_all = False
+        self.multi_page = len(self.result_list) == self.list_per_page
+        self.paginator = paginator
+
+        if self.multi_page:
+            self.next_page_url = self.get_query_string(
+                {AFTER_VAR: self.result_list[-1].pk},
+                [PAGE_VAR]
+            )
+        else:
+            self.next_page_url = None
+        self.first_page_url = self.get_query_string({}, [PAGE_VAR, AFTER_VAR])
+        self.is_first_page = not getattr(request, 'nginx_memcache_after', None)
+
 
 class CachedPageRecordAdmin(admin.ModelAdmin):
     _all_fields = [
         'base_cache_key',
         'parent_identifier',
-        'supplementary_identifier'
+        'supplementary_identifier',
+        'stored_bytes',
     ]
     list_display = _all_fields[:]
-    search_fields = _all_fields[:]
+    # Only shown for the search box; see CachedPageRecordChangeList
+    search_fields = ['=base_cache_key', '^parent_identifier']
     readonly_fields = _all_fields[:]
+    paginator = EstimatedCountPaginator
+    actions = ['invalidate_selected', 'invalidate_selected_identifiers']
+
+    def get_changelist(self, request, **kwargs):
+        return CachedPageRecordChangeList
+
+    def changelist_view(self, request, extra_context=None):
+        # The keyset pagination parameter isn't a filter, so keep it away
+        # from the changelist's parameter checking
+        if AFTER_VAR in request.GET:
+            request.GET = request.GET.copy()
+            request.nginx_memcache_after = request.GET.pop(AFTER_VAR)[0]
+        return super(CachedPageRecordAdmin, self).changelist_view(
+            request, extra_context
+        )
+
+    def invalidate_selected(self, request, queryset):
+        invalidated = 0
+        chunk_size = getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+        # Each identifier's pages may be in a different cache alias
+        identifiers = queryset.values_list(
+            'parent_identifier', flat=True
+        ).distinct()
+        for identifier in identifiers:
+            for keys in iter_key_chunks(
+                queryset.filter(parent_identifier=identifier),
+                chunk_size
+            ):
+                invalidate_keys(keys, identifier)
+                invalidated += len(keys)
+        messages.info(request, "Invalidated %d cached page(s)" % invalidated)
+    invalidate_selected.short_description = (
+        "Invalidate the selected cached pages"
+    )
+
+    def invalidate_selected_identifiers(self, request, queryset):
+        identifiers = set(
+            queryset.values_list('parent_identifier', flat=True)
+        )
+        for identifier in identifiers:
+            bulk_invalidate(identifier)
+        messages.info(
+            request,
+            "Invalidated every cached page for %s" % ", ".join(
+                sorted(identifiers)
+            )
+        )
+    invalidate_selected_identifiers.short_description = (
+        "Invalidate every cached page for the selected pages' identifiers"
+    )
 
 admin.site.register(CachedPageRecord, CachedPageRecordAdmin)
@@ -0,0 +1,217 @@
+"""Frequency-based admission to the nginx cache.
+
+Crawlers request huge numbers of pages exactly once. Cacheing every one of
+them pushes genuinely popular pages out of memcache's LRU, for no benefit.
+With an admission threshold of N, a page is only cached once it has been
+requested N times recently; until then it's just served by Django.
+
+Request counts are kept in one of two places, chosen with
+settings.CACHE_NGINX_ADMISSION_BACKEND:
+
+    'local' (default) - a count-min sketch in each process (as in TinyLFU):
+        a fixed-size table of counters, which are all halved every so often
+        so that old popularity fades away.
+    'memcache' - counters in memcache, shared by every process, each
+        covering settings.CACHE_NGINX_ADMISSION_WINDOW seconds.
+
+With settings.CACHE_NGINX_BACKGROUND_WRITES, memcache counters are bumped
+on the background writer thread, so the request doesn't wait on memcache.
+The count it's judged by is then the last one this process saw for the
+page, plus one for itself: requests from other processes since then
+aren't included until the next time.
+
+"""
+
+import array
+import hashlib
+import struct
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+from .writer import get_writer
+
+
+class CountMinSketch(object):
+    """Approximate counts of how often each key has been seen, in a fixed
+    amount of memory. Estimates can be too high (when keys collide in
+    every row) but are never too low - until the counters are aged.
+
+    Once sample_size increments have been made, every counter is halved,
+    so the sketch reflects recent popularity rather than all-time.
+
+    """
+
+    def __init__(self, width=65536, depth=4, sample_size=None):
+        self.width = width
+        self.depth = depth
+        self.sample_size = sample_size or width * 10
+        self._rows = [array.array('I', [0]) * width for _ in range(depth)]
+        self._increments = 0
+        self._lock = threading.Lock()
+
+    def _indexes(self, key):
+        # Double hashing, with two independent halves of an md5, gives
+        # each row a hash function of its own. (Seeding crc32 with the row
+        # doesn't: for keys of the same length - every cache key - that
+        # only XORs a constant in, so keys colliding in one row collide
+        # in all of them.)
+        h1, h2 = struct.unpack('<II', hashlib.md5(key).digest()[:8])
+        # Odd, so that it's never a multiple of a power-of-two width
+        h2 |= 1
+        for row in range(self.depth):
+            yield row, (h1 + row * h2) % self.width
+
+    def increment(self, key):
+        """Count one more sighting of key, and return the new estimate"""
+        with self._lock:
+            estimate = None
+            for row, index in self._indexes(key):
+                self._rows[row][index] += 1
+                count = self._rows[row][index]
+                if estimate is None or count < estimate:
+                    estimate = count
+            self._increments += 1
+            if self._increments >= self.sample_size:
+                self._age()
+            return estimate
+
+    def estimate(self, key):
+        with self._lock:
+            return min(
+                self._rows[row][index] for row, index in self._indexes(key)
+            )
+
+    def _age(self):
+        self._rows = [
+            array.array('I', [count >> 1 for count in counters])
+            for counters in self._rows
+        ]
+        self._increments = 0
+
+
+_stats_lock = threading.Lock()
+admission_stats = {
+    'admitted': 0,
+    'rejected': 0,
+}
+
+_sketch = None
+_sketch_lock = threading.Lock()
+
+
+def get_sketch():
+    """Returns this process's CountMinSketch, creating it if needed"""
+    global _sketch
+    if _sketch is None:
+        with _sketch_lock:
+            if _sketch is None:
+                _sketch = CountMinSketch(
+                    width=getattr(
+                        settings, 'CACHE_NGINX_ADMISSION_SKETCH_WIDTH', 65536
+                    )
+                )
+    return _sketch
+
+
+# With background writes, the memcache count last seen for each page
+# (by counter key), least recently seen first
+_seen_counts = OrderedDict()
+_seen_counts_lock = threading.Lock()
+SEEN_COUNTS_SIZE = 10000
+
+
+def _bump_counter(counter_key, window):
+    # Avoid a circular import: cache.py uses this module
+    from .cache import _call_memcache, nginx_cache
+    added = _call_memcache(nginx_cache, 'add', counter_key, 1, window)
+    if added is None:
+        # Memcache couldn't be asked (see breaker.py)
+        return None
+    if added:
+        return 1
+    try:
+        return _call_memcache(nginx_cache, 'incr', counter_key)
+    except ValueError:
+        # Expired between the add and the incr
+        return 1
+
+
+def _bump_and_remember(counter_key, window):
+    count = _bump_counter(counter_key, window)
+    if count is None:
+        return
+    with _seen_counts_lock:
+        _seen_counts.pop(counter_key, None)
+        _seen_counts[counter_key] = count
+        if len(_seen_counts) > SEEN_COUNTS_SIZE:
+            _seen_counts.popitem(last=False)
+
+
+def _count_in_memcache(cache_key):
+    window = getattr(settings, 'CACHE_NGINX_ADMISSION_WINDOW', 3600)
+    counter_key = 'nmadmit:%d:%s' % (int(time.time()) // window, cache_key)
+    if not getattr(settings, 'CACHE_NGINX_BACKGROUND_WRITES', False):
+        return _bump_counter(counter_key, window)
+    get_writer().submit(_bump_and_remember, counter_key, window)
+    with _seen_counts_lock:
+        return _seen_counts.get(counter_key, 0) + 1
+
+
+def request_count(cache_key):
+    """Records a request for the page cached under cache_key, and returns
+    how many times it has (approximately) been requested recently - or
+    None if that isn't known, because memcache couldn't be asked"""
+    backend = getattr(settings, 'CACHE_NGINX_ADMISSION_BACKEND', 'local')
+    if backend == 'memcache':
+        return _count_in_memcache(cache_key)
+    return get_sketch().increment(cache_key)
+
+
+def popularity(cache_keys):
+    """Returns {cache_key: how often it's (approximately) been requested
+    recently} for the given pages, without counting a request for any of
+    them. Pages are only counted while an admission threshold is in use."""
+    backend = getattr(settings, 'CACHE_NGINX_ADMISSION_BACKEND', 'local')
+    if backend == 'memcache':
+        # Avoid a circular import: cache.py uses this module
+        from .cache import _call_memcache, nginx_cache
+        window = getattr(settings, 'CACHE_NGINX_ADMISSION_WINDOW', 3600)
+        prefix = 'nmadmit:%d:' % (int(time.time()) // window)
+        found = _call_memcache(
+            nginx_cache, 'get_many', [prefix + key for key in cache_keys]
+        ) or {}
+        return dict(
+            (key, int(found.get(prefix + key) or 0)) for key in cache_keys
+        )
+    sketch = get_sketch()
+    return dict((key, sketch.estimate(key)) for key in cache_keys)
+
+
+def admit(cache_key, threshold):
+    """True if the page should be cached, ie it has now been
+    requested at least threshold times - or we can't tell"""
+    count = request_count(cache_key)
+    admitted = count is None or count >= threshold
+    with _stats_lock:
+        admission_stats['admitted' if admitted else 'rejected'] += 1
+    return admitted
+
+
+def get_admission_stats():
+    with _stats_lock:
+        return dict(admission_stats)
+
+
+def reset_admission():
+    """Forget all counts and stats - mostly for tests"""
+    global _sketch
+    with _sketch_lock:
+        _sketch = None
+    with _seen_counts_lock:
+        _seen_counts.clear()
+    with _stats_lock:
+        for key in admission_stats:
+            admission_stats[key] = 0
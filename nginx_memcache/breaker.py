@@ -0,0 +1,203 @@
+"""A circuit breaker around the nginx cache.
+
+When memcache is down, or so slow that every operation times out, each
+request that caches or invalidates a page waits for it - for as long as
+the client's timeouts allow (see CACHE_NGINX_CLIENT_OPTIONS, and its
+operation_timeout in particular) - and then fails. With the breaker on
+(settings.CACHE_NGINX_BREAKER, default True) each cache alias has a
+CircuitBreaker which, after settings.CACHE_NGINX_BREAKER_FAILURES (default
+5) failures in a row, opens: for the next
+settings.CACHE_NGINX_BREAKER_RESET_TIMEOUT seconds (default 30) cache.py
+doesn't talk to memcache at all. Pages aren't cached (they will be once
+memcache is back), reads miss, and invalidations are queued. The same goes
+for the admission and churn counters kept in memcache, and the revalidation
+lock: a count that can't be made admits the page, and raises no alarm, and
+a lock that can't be taken isn't.
+
+After that cool-down the breaker is half-open, and lets a single operation
+through as a probe: if it works the breaker closes, and the queued
+invalidations are replayed; if not, it opens again for another cool-down.
+
+Up to settings.CACHE_NGINX_BREAKER_QUEUE_SIZE keys (default 10000) are
+queued per alias, in this process - past that, the oldest are dropped, and
+a warning logged, so those pages may be served stale until they expire.
+get_breaker_states() reports every breaker in this process, for a
+monitoring view or a health check.
+
+Only errors the client raises trip the breaker: our own pooled client (see
+client.py) raises MemcacheError, but Django's memcached backends swallow
+their errors, so behind one of those the breaker never opens.
+
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half-open'
+
+
+class CircuitBreaker(object):
+    """Counts consecutive failures of the calls it's told about, and says
+    whether the next one should be attempted. Thread-safe."""
+
+    def __init__(
+            self,
+            name,
+            failure_threshold=5,
+            reset_timeout=30.0,
+            max_queued=10000
+        ):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.max_queued = max_queued
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.total_failures = 0
+        self.rejected = 0
+        self.dropped = 0
+        self._probing = False
+        # Keys whose deletion was missed, in the order they were missed
+        self._queued = OrderedDict()
+        self._lock = threading.Lock()
+
+    def allow(self, now=None):
+        """Whether to attempt the next call: always when closed, never when
+        open, and - once the cool-down is over - just one probe at a time
+        when half-open"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            if self.state == OPEN and now >= self.opened_at + self.reset_timeout:
+                self.state = HALF_OPEN
+                logging.info("Circuit breaker for %s is half-open" % self.name)
+            if self.state == CLOSED:
+                return True
+            if self.state == HALF_OPEN and not self._probing:
+                self._probing = True
+                return True
+            self.rejected += 1
+            return False
+
+    def record_success(self):
+        """Note that a call worked. Returns True if that closed the
+        breaker."""
+        with self._lock:
+            self.failures = 0
+            if self.state == CLOSED:
+                return False
+            self.state = CLOSED
+            self.opened_at = None
+            self._probing = False
+        logging.warning("Circuit breaker for %s has closed" % self.name)
+        return True
+
+    def record_failure(self, now=None):
+        """Note that a call failed, opening the breaker if it was a probe
+        or one failure too many"""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self.failures += 1
+            self.total_failures += 1
+            if self.state == CLOSED and self.failures < self.failure_threshold:
+                return
+            self.state = OPEN
+            self.opened_at = now
+            self._probing = False
+        logging.warning(
+            "Circuit breaker for %s is open after %d failures; not using "
+            "memcache for %ss" % (self.name, self.failures, self.reset_timeout)
+        )
+
+    def queue_deletes(self, keys):
+        """Remember that these keys should have been deleted"""
+        with self._lock:
+            for key in keys:
+                self._queued.pop(key, None)
+                self._queued[key] = True
+            overflow = len(self._queued) - self.max_queued
+            for _ in range(max(0, overflow)):
+                self._queued.popitem(last=False)
+            if overflow > 0:
+                self.dropped += overflow
+        if overflow > 0:
+            logging.warning(
+                "Circuit breaker for %s dropped %d queued invalidations" % (
+                    self.name, overflow
+                )
+            )
+
+    def take_queued(self):
+        """The keys queued for deletion, oldest first, which are forgotten"""
+        with self._lock:
+            keys = self._queued.keys()
+            self._queued.clear()
+        return keys
+
+    def stats(self):
+        with self._lock:
+            return {
+                'name': self.name,
+                'state': self.state,
+                'failures': self.failures,
+                'opened_at': self.opened_at,
+                'total_failures': self.total_failures,
+                'rejected': self.rejected,
+                'queued': len(self._queued),
+                'dropped': self.dropped,
+            }
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+
+def use_breaker():
+    return getattr(settings, 'CACHE_NGINX_BREAKER', True)
+
+
+def get_breaker(name):
+    """This process's CircuitBreaker for the named cache alias, creating
+    it if needed"""
+    breaker = _breakers.get(name)
+    if breaker is None:
+        with _breakers_lock:
+            breaker = _breakers.get(name)
+            if breaker is None:
+                breaker = _breakers[name] = CircuitBreaker(
+                    name,
+                    failure_threshold=getattr(
+                        settings, 'CACHE_NGINX_BREAKER_FAILURES', 5
+                    ),
+                    reset_timeout=getattr(
+                        settings, 'CACHE_NGINX_BREAKER_RESET_TIMEOUT', 30.0
+                    ),
+                    max_queued=getattr(
+                        settings, 'CACHE_NGINX_BREAKER_QUEUE_SIZE', 10000
+                    )
+                )
+    return breaker
+
+
+def get_breaker_states():
+    """A dict of cache alias to its breaker's stats(): state ('closed',
+    'open' or 'half-open'), failures (in a row), opened_at, total_failures,
+    rejected (calls not attempted), queued (invalidations waiting to be
+    replayed) and dropped (invalidations that couldn't be queued)"""
+    with _breakers_lock:
+        breakers = _breakers.values()
+    return dict((breaker.name, breaker.stats()) for breaker in breakers)
+
+
+def reset_breakers():
+    """Forget every breaker, and its queue - mostly for tests"""
+    with _breakers_lock:
+        _breakers.clear()
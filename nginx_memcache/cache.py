@@ -1,21 +1,241 @@
 import logging
+import os
+import threading
+from collections import OrderedDict
 
 import hashlib
 
 from django.conf import settings
 from django.core.cache import get_cache
 from django.db import IntegrityError
+from django.db.models import Count
 from django.template.response import TemplateResponse
-from django.utils.encoding import DjangoUnicodeDecodeError
-from django.utils.html import strip_spaces_between_tags as minify_html
-
-from .models import CachedPageRecord
+from django.utils.cache import patch_vary_headers
+
+from .admission import admit
+from .breaker import get_breaker, use_breaker
+from .churn import (
+    counter_keys,
+    record_cache as record_churn,
+    record_invalidation as record_churn_invalidation
+)
+from .client import MemcacheClient, MemcacheError
+from .minify import minify_html
+from .models import CachedPageRecord, CachedPageTag
+from .pinning import (
+    get_page_aliases,
+    get_pinned_alias,
+    is_pinned,
+    pinned_timeout
+)
+from .routing import get_cache_alias
+from .stale import get_stale_key
+from .staggered import staggered_invalidate
+from .streaming import is_streaming, tee_streaming_response
+from .timing import start_timer
+from .ttl import get_policy, jitter, record_invalidation, ttl_scope
+from .writer import get_writer
 
 CACHE_NGINX_DEFAULT_COOKIE = getattr(settings, 'CACHE_NGINX_COOKIE', 'pv')
 CACHE_TIME = getattr(settings, 'CACHE_NGINX_TIME', 3600 * 24)
 CACHE_ALIAS = getattr(settings, 'CACHE_NGINX_ALIAS', 'default')
 CACHE_MINIFY_HTML = getattr(settings, 'CACHE_MINIFY_HTML', False)
-nginx_cache = get_cache(CACHE_ALIAS)
+
+
+_clients = {}
+_clients_pid = None
+_clients_lock = threading.Lock()
+
+
+def _build_client(alias):
+    """Make a client for the given alias in settings.CACHES.
+
+    Memcached backends get our own pooled MemcacheClient (see client.py),
+    configured by settings.CACHE_NGINX_CLIENT_OPTIONS, unless
+    settings.CACHE_NGINX_POOLED_CLIENT is False. Anything else (eg a locmem
+    cache in tests) is handed to Django's get_cache()."""
+    conf = settings.CACHES[alias]
+    use_pool = getattr(settings, 'CACHE_NGINX_POOLED_CLIENT', True)
+    if use_pool and 'memcached' in conf.get('BACKEND', '').lower():
+        options = {
+            'connect_timeout': 0.25,
+            'io_timeout': 0.5,
+            'keepalive': True,
+            'max_pool_size': 10,
+            'pool_timeout': 1.0,
+            # So one slow server can't hold a request up for every read's
+            # io_timeout in turn
+            'operation_timeout': 1.0
+        }
+        options.update(getattr(settings, 'CACHE_NGINX_CLIENT_OPTIONS', {}))
+        return MemcacheClient(
+            conf.get('LOCATION', '127.0.0.1:11211'),
+            key_prefix=conf.get('KEY_PREFIX', ''),
+            version=conf.get('VERSION', 1),
+            default_timeout=conf.get('TIMEOUT', 300),
+            **options
+        )
+    return get_cache(alias)
+
+
+def get_nginx_cache(alias=None):
+    """Returns this process's client for the nginx cache, creating it on
+    first use. Nothing is created at import time, and a forked process gets
+    a fresh client rather than sharing its parent's sockets."""
+    global _clients_pid
+    alias = alias or CACHE_ALIAS
+    pid = os.getpid()
+    if _clients_pid != pid or alias not in _clients:
+        with _clients_lock:
+            if _clients_pid != pid:
+                _clients.clear()
+                _clients_pid = pid
+            if alias not in _clients:
+                _clients[alias] = _build_client(alias)
+    return _clients[alias]
+
+
+def reset_nginx_cache():
+    """Forget every client, so the next call to get_nginx_cache() makes a
+    new one - eg after changing settings in a test."""
+    global _clients_pid
+    with _clients_lock:
+        for client in _clients.values():
+            if hasattr(client, 'disconnect_all'):
+                client.disconnect_all()
+        _clients.clear()
+        _clients_pid = None
+
+
+class _LazyNginxCache(object):
+    """Stands in for the old import-time nginx_cache global, passing
+    everything through to get_nginx_cache()"""
+
+    def __getattr__(self, name):
+        return getattr(get_nginx_cache(), name)
+
+nginx_cache = _LazyNginxCache()
+
+
+def _client_alias(client):
+    """The cache alias this process's client was made for"""
+    for alias, known in _clients.items():
+        if known is client:
+            return alias
+    return CACHE_ALIAS
+
+
+def _deleted_keys(method, args):
+    if method == 'delete':
+        return [args[0]]
+    return list(args[0])
+
+
+def _call_memcache(client, method, *args, **kwargs):
+    """Call client.method(*args, **kwargs) through its alias's circuit
+    breaker (see breaker.py): not at all while the breaker is open, and
+    returning None rather than raising if memcache fails. Deletes that
+    don't happen either way are queued, to be replayed once the breaker
+    closes again.
+
+    Without the breaker, a MemcacheError is still logged rather than
+    raised, as Django's memcached backends would, so that memcache being
+    down doesn't take every cached view down with it."""
+    fn = getattr(client, method)
+    if not use_breaker():
+        try:
+            return fn(*args, **kwargs)
+        except MemcacheError:
+            logging.exception("Cache %s failed" % method)
+            return None
+    breaker = get_breaker(_client_alias(client))
+    is_delete = method in ('delete', 'delete_many')
+    if not breaker.allow():
+        if is_delete:
+            breaker.queue_deletes(_deleted_keys(method, args))
+        return None
+    try:
+        result = fn(*args, **kwargs)
+    except ValueError:
+        # A reply - eg to incr of a key that isn't there - so memcache is up
+        if breaker.record_success():
+            _replay_deletes(client, breaker)
+        raise
+    except Exception:
+        logging.exception("Cache %s failed" % method)
+        breaker.record_failure()
+        if is_delete:
+            breaker.queue_deletes(_deleted_keys(method, args))
+        return None
+    if breaker.record_success():
+        _replay_deletes(client, breaker)
+    return result
+
+
+def _replay_deletes(client, breaker):
+    """Delete the keys queued while the breaker was open"""
+    cache_keys = breaker.take_queued()
+    if not cache_keys:
+        return
+    logging.info("Replaying %d invalidations missed by %s" % (
+        len(cache_keys), breaker.name)
+    )
+    chunk_size = getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+    for start in range(0, len(cache_keys), chunk_size):
+        # Any that fail again are queued again
+        _call_memcache(
+            client, 'delete_many', cache_keys[start:start + chunk_size]
+        )
+
+
+def _dispatch(client, method, *args, **kwargs):
+    """Carry out a cache write/delete - client.method(*args, **kwargs) -
+    either right now or - if settings.CACHE_NGINX_BACKGROUND_WRITES is
+    set - on the background writer thread, so the response isn't held up
+    by memcache. Deletes are never dropped when the writer's queue is
+    full: they wait for room."""
+    if getattr(settings, 'CACHE_NGINX_BACKGROUND_WRITES', False):
+        writer = get_writer()
+        if method in ('delete', 'delete_many'):
+            submit = writer.submit_blocking
+        else:
+            submit = writer.submit
+        submit(_call_memcache, client, method, *args, **kwargs)
+    else:
+        _call_memcache(client, method, *args, **kwargs)
+
+
+class _WriteBatch(object):
+    """Collects the cache writes made by cache_response() within
+    cache_many(), to be made with set_many(), grouped by client and
+    timeout"""
+
+    def __init__(self):
+        self.groups = OrderedDict()
+
+    def set(self, client, key, value, timeout):
+        group = self.groups.setdefault((id(client), timeout), (client, {}))
+        group[1][key] = value
+
+    def flush(self, chunk_size):
+        for (_, timeout), (client, data) in self.groups.items():
+            keys = data.keys()
+            for start in range(0, len(keys), chunk_size):
+                _dispatch(client, 'set_many', dict(
+                    (key, data[key]) for key in keys[start:start + chunk_size]
+                ), timeout)
+        self.groups.clear()
+
+# The batch cache_many() is collecting writes in, if any, for this thread
+_batches = threading.local()
+
+
+def _set(client, key, value, timeout):
+    batch = getattr(_batches, 'current', None)
+    if batch is not None:
+        batch.set(client, key, value, timeout)
+    else:
+        _dispatch(client, 'set', key, value, timeout)
 
 
 def cache_response(
@@ -25,73 +245,308 @@ def cache_response(
         cookie_name=CACHE_NGINX_DEFAULT_COOKIE,
         page_version_fn=None,
         lookup_identifier=None,
-        supplementary_identifier=None
+        supplementary_identifier=None,
+        admission_threshold=None,
+        adaptive_ttl=None,
+        max_stale=None,
+        tags=None,
+        variants=None,
+        pinned=None
     ):
 
     """Class based view responses TemplateResponse objects and do not call
     render automatically, you we must trigger this."""
-    if type(response) is TemplateResponse and not response.is_rendered:
-        response.render()
+    # Time each stage, if so configured. See timing.py
+    timer = start_timer(request)
 
-    """ Minify the HTML outout if set in settings. """
-    if CACHE_MINIFY_HTML:
-        if 'text/html' in response['Content-Type']:
-            try:
-                response.content = minify_html(response.content.strip())
-            except DjangoUnicodeDecodeError:
-                pass
+    if type(response) is TemplateResponse and not response.is_rendered:
+        with timer.stage('render'):
+            response.render()
 
     """Cache this response for the web server to grab next time."""
-    # get page version
-    if page_version_fn:
-        pv = page_version_fn(request)
+    # get page version - from the request's variant, if the page varies
+    # (see variants.py), which nginx works out for itself
+    if variants is not None:
+        page_version_fn = variants.page_version
+        patch_vary_headers(response, variants.vary_headers())
+    with timer.stage('page_version'):
+        if page_version_fn:
+            pv = page_version_fn(request)
+        else:
+            pv = ''
+    with timer.stage('cache_key'):
+        cache_key = get_cache_key(
+            request_host=request.get_host(),
+            request_path=request.get_full_path(),
+            page_version=pv,
+            cookie_name=cookie_name,
+            scheme=_key_scheme(request)
+        )
+    is_html = 'text/html' in response.get('Content-Type', '')
+    # High-value pages go in a pool of their own, if so configured. See
+    # pinning.py
+    pinned = is_pinned(request.get_full_path(), pinned)
+
+    # Only cache pages that have been asked for often enough, if so
+    # configured. See admission.py
+    if admission_threshold is None:
+        admission_threshold = getattr(
+            settings, 'CACHE_NGINX_ADMISSION_THRESHOLD', None
+        )
+    # Pages being refreshed (see refresh.py) were admitted already, and
+    # pinned pages are known to be popular
+    if admission_threshold and not pinned and not getattr(
+        request, 'nginx_memcache_refresh', False):
+        with timer.stage('admission'):
+            admitted = admit(cache_key, admission_threshold)
+        if not admitted:
+            logging.info("Not cacheing %s: not requested often enough yet" % (
+                cache_key)
+            )
+            if pv and variants is None:
+                response.set_cookie(cookie_name, pv)
+            timer.finish(request, response)
+            return
+
+    # Let the page's invalidation history choose its timeout, if so
+    # configured, then spread it a little. See ttl.py
+    if adaptive_ttl is None:
+        adaptive_ttl = getattr(settings, 'CACHE_NGINX_ADAPTIVE_TTL', False)
+    if pinned:
+        cache_timeout = pinned_timeout(cache_timeout)
+    elif adaptive_ttl:
+        cache_timeout = get_policy().record_cache(
+            ttl_scope(cache_key, lookup_identifier or request.get_host()),
+            cache_timeout
+        )
+    cache_timeout = jitter(cache_timeout)
+
+    # If no identifier specified, use the hostname.
+    # If you prefer, you could pass in a Site.id, etc
+    lookup_identifier = lookup_identifier or request.get_host()
+    if pinned:
+        client = get_nginx_cache(get_pinned_alias())
     else:
-        pv = ''
-    cache_key = get_cache_key(
-        request_host=request.get_host(),
-        request_path=request.get_full_path(),
-        page_version=pv,
-        cookie_name=cookie_name
-    )
-    logging.info("Cacheing %s %s %s %s with key %s" % (
-        request.get_host(), request.get_full_path(), pv, cookie_name, cache_key)
-    )
+        client = get_nginx_cache(get_cache_alias(lookup_identifier))
 
-    nginx_cache.set(cache_key, response.content, cache_timeout)
+    # Tags may depend on the request (eg the object the page shows)
+    if callable(tags):
+        tags = tags(request)
 
-    # Store the version, if any specified.
-    if pv:
-        response.set_cookie(cookie_name, pv)
+    # Keep a stale copy to serve while the page is re-rendered, once
+    # it has expired or been invalidated, if so configured. See stale.py
+    if max_stale is None:
+        max_stale = getattr(settings, 'CACHE_NGINX_MAX_STALE', 0)
 
-    # Add record of cacheing taking place to
-    # invalidation lookup table, if appropriate
-    if getattr(settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', False):
-        if not lookup_identifier:
-            # If no identifier specified, use the hostname.
-            # If you prefer, you could pass in a Site.id, etc
-            lookup_identifier = request.get_host()
-        add_key_to_lookup(
+    def store(content):
+        logging.info("Cacheing %s %s %s %s with key %s" % (
+            request.get_host(), request.get_full_path(), pv, cookie_name,
+            cache_key)
+        )
+        with timer.stage('memcache_set'):
+            _set(client, cache_key, content, cache_timeout)
+            if max_stale:
+                _set(client, get_stale_key(cache_key), content, max_stale)
+        # So that a refresh can tell the page was re-cached
+        request.nginx_memcache_cached_key = cache_key
+        # Watch for pages cached over and over. See churn.py
+        record_churn(
+            client,
             cache_key,
-            lookup_identifier,
-            supplementary_identifier
+            request.get_host(),
+            request.get_full_path(),
+            pv,
+            cache_timeout
+        )
+
+        # Add record of cacheing taking place to
+        # invalidation lookup table, if appropriate
+        if getattr(settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', False):
+            with timer.stage('lookup_table'):
+                add_key_to_lookup(
+                    cache_key,
+                    lookup_identifier,
+                    supplementary_identifier,
+                    stored_bytes=len(content),
+                    tags=tags,
+                    request_host=request.get_host(),
+                    request_path=request.get_full_path(),
+                    page_version=pv
+                )
+
+    if is_streaming(response):
+        # The body is only cached once it has been streamed to the client
+        def store_streamed(content):
+            if CACHE_MINIFY_HTML and is_html:
+                content = minify_html(content)
+            store(content)
+
+        tee_streaming_response(
+            response,
+            store_streamed,
+            max_size=getattr(
+                settings, 'CACHE_NGINX_STREAMING_MAX_SIZE', 1000 * 1024
+            )
         )
+    else:
+        """ Minify the HTML outout if set in settings. """
+        if CACHE_MINIFY_HTML and is_html:
+            with timer.stage('minify'):
+                response.content = minify_html(response.content)
+        store(response.content)
+
+    # Store the version, if any specified.
+    if pv and variants is None:
+        response.set_cookie(cookie_name, pv)
+
+    timer.finish(request, response)
+
+
+def cache_many(responses, **kwargs):
+    """Caches each of an iterable of (request, response) pairs, as
+    cache_response() - which is given any keyword arguments - would, but
+    with the memcache writes grouped by cache alias and timeout and made
+    with set_many(), settings.CACHE_NGINX_BULK_CHUNK_SIZE at a time.
+
+    Streamed responses are still cached once each stream has been read.
+    NB: with CACHE_NGINX_TTL_JITTER on, pages get different timeouts, so
+    go in more, smaller, groups."""
+    batch = _WriteBatch()
+    _batches.current = batch
+    try:
+        for request, response in responses:
+            cache_response(request, response, **kwargs)
+    finally:
+        _batches.current = None
+        # Whatever was cached before any error still gets written
+        batch.flush(getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000))
+
+
+def keys_include_scheme():
+    """Whether HTTP and HTTPS pages are cached under different keys"""
+    return getattr(settings, 'CACHE_NGINX_KEY_INCLUDES_SCHEME', False)
+
+
+def key_schemes(scheme=None):
+    """The schemes to make a page's keys for: just scheme, if given, or -
+    if the scheme is part of the key - both. The scheme makes no
+    difference otherwise."""
+    if scheme or not keys_include_scheme():
+        return [scheme or 'http']
+    return ['http', 'https']
+
+
+def get_request_scheme(request):
+    """'https' if the request was made over HTTPS (see
+    middleware.is_secure_request), otherwise 'http'"""
+    # Avoid a circular import: middleware.py uses this module
+    from .middleware import is_secure_request
+    if is_secure_request(request):
+        return 'https'
+    return 'http'
+
+
+def _key_scheme(request):
+    # Don't check for HTTPS unless it makes a difference
+    if keys_include_scheme():
+        return get_request_scheme(request)
+    return 'http'
 
 
 def get_cache_key(
         request_host,
         request_path,
         page_version='',
-        cookie_name=CACHE_NGINX_DEFAULT_COOKIE
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE,
+        scheme='http'
     ):
     """ Use the request host, request path and
-        optional page version to get cache key."""
+        optional page version to get cache key.
+
+        With settings.CACHE_NGINX_KEY_INCLUDES_SCHEME, the scheme (as
+        nginx's $cache_scheme has it; see nginxconf.py) is part of the
+        key, so that HTTP and HTTPS pages are cached apart."""
     raw_key = u'%s%s&%s=%s' % (
         request_host,
         request_path,
         cookie_name,
         page_version
     )
-    return hashlib.md5(raw_key).hexdigest()
+    if keys_include_scheme():
+        raw_key = u'%s://%s' % (scheme or 'http', raw_key)
+    # nginx hashes the UTF-8 bytes of the (decoded) path
+    return hashlib.md5(raw_key.encode('utf-8')).hexdigest()
+
+
+def get_request_cache_key(
+        request,
+        page_version_fn=None,
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE
+    ):
+    """The cache key for this request, as cache_response() would store
+    it and nginx would look it up."""
+    if page_version_fn:
+        pv = page_version_fn(request)
+    else:
+        pv = ''
+    return get_cache_key(
+        request_host=request.get_host(),
+        request_path=request.get_full_path(),
+        page_version=pv,
+        cookie_name=cookie_name,
+        scheme=_key_scheme(request)
+    )
+
+
+def get_cached_page(
+        request,
+        page_version_fn=None,
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE,
+        lookup_identifier=None
+    ):
+    """Returns the cached body of the page for this request - what nginx
+    would have served - or None if it isn't cached. Like nginx, looks in
+    the pinned pool first, if there is one (see pinning.py)."""
+    cache_key = get_request_cache_key(request, page_version_fn, cookie_name)
+    for alias in get_page_aliases(lookup_identifier or request.get_host()):
+        try:
+            content = _call_memcache(get_nginx_cache(alias), 'get', cache_key)
+        except MemcacheError:
+            logging.exception("Couldn't read %s from the cache" % cache_key)
+            content = None
+        if content is not None:
+            return content
+    return None
+
+
+def get_cached_or_stale_page(
+        request,
+        page_version_fn=None,
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE,
+        lookup_identifier=None
+    ):
+    """Like get_cached_page(), but falls back to the stale copy (see
+    stale.py). Returns (content, is_stale), with content None if neither
+    is cached."""
+    cache_key = get_request_cache_key(request, page_version_fn, cookie_name)
+    stale_key = get_stale_key(cache_key)
+    stale = None
+    for alias in get_page_aliases(lookup_identifier or request.get_host()):
+        try:
+            found = _call_memcache(
+                get_nginx_cache(alias), 'get_many', [cache_key, stale_key]
+            )
+        except MemcacheError:
+            logging.exception("Couldn't read %s from the cache" % cache_key)
+            found = None
+        if found is None:
+            # Failed, or the circuit breaker is open. See breaker.py
+            continue
+        if found.get(cache_key) is not None:
+            return found[cache_key], False
+        if stale is None:
+            stale = found.get(stale_key)
+    return stale, True
 
 
 def invalidate_from_request(
@@ -112,23 +567,165 @@ def invalidate(
         request_host,
         request_path,
         page_version='',
-        cookie_name=CACHE_NGINX_DEFAULT_COOKIE
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE,
+        lookup_identifier=None,
+        include_stale=False,
+        refresh=None,
+        scheme=None
     ):
-    """Delete cache key for this request path and page version."""
-    cache_key = get_cache_key(
-        request_host=request_host,
-        request_path=request_path,
-        page_version=page_version,
-        cookie_name=cookie_name
-    )
-    logging.info("Invaldidating key '%s'" % cache_key)
+    """Delete cache key for this request path and page version.
+    If the page was cached with a lookup_identifier that is routed to its
+    own cache alias (see routing.py), pass that too.
+
+    Any stale copy of the page (see stale.py) is kept, to be served while
+    the page is re-rendered, unless include_stale is True - eg if the page
+    must not be seen again.
+
+    With refresh True (default settings.CACHE_NGINX_REFRESH), the page is
+    re-rendered and its cached copy overwritten instead, and only deleted
+    if that fails. See refresh.py
+
+    With settings.CACHE_NGINX_KEY_INCLUDES_SCHEME, both the HTTP and HTTPS
+    copies of the page are invalidated, unless scheme says which."""
+    if _use_refresh(refresh):
+        # Avoid a circular import: refresh.py uses this module
+        from .refresh import refresh_page
+        refresh_page(
+            request_host,
+            request_path,
+            page_version,
+            cookie_name,
+            lookup_identifier,
+            include_stale,
+            scheme
+        )
+        return
+
+    page_keys = [
+        get_cache_key(
+            request_host=request_host,
+            request_path=request_path,
+            page_version=page_version,
+            cookie_name=cookie_name,
+            scheme=key_scheme
+        )
+        for key_scheme in key_schemes(scheme)
+    ]
+    logging.info("Invalidating keys %s" % page_keys)
+    record_invalidation([
+        ttl_scope(cache_key, lookup_identifier or request_host)
+        for cache_key in page_keys
+    ])
+    record_churn_invalidation(page_keys)
+
+    cache_keys = page_keys + counter_keys(page_keys)
+    if include_stale:
+        cache_keys += [get_stale_key(cache_key) for cache_key in page_keys]
+    # Including the pinned pool, if any. See pinning.py
+    for alias in get_page_aliases(lookup_identifier or request_host):
+        client = get_nginx_cache(alias)
+        if len(cache_keys) > 1:
+            _dispatch(client, 'delete_many', cache_keys)
+        else:
+            _dispatch(client, 'delete', cache_keys[0])
+
+
+# The arguments to invalidate() that say which page it is, in order, for
+# the pages given to invalidate_many() as tuples
+PAGE_ARGS = (
+    'request_host',
+    'request_path',
+    'page_version',
+    'cookie_name',
+    'lookup_identifier',
+    'scheme',
+)
+
+
+def invalidate_many(pages, include_stale=False, refresh=None):
+    """Invalidate many pages at once: each is a dict of invalidate()'s
+    arguments (request_host, request_path, and optionally page_version,
+    cookie_name, lookup_identifier and scheme) or a tuple of them, in that
+    order.
+
+    The keys are worked out up front, grouped by cache alias, and deleted
+    with delete_many(), settings.CACHE_NGINX_BULK_CHUNK_SIZE at a time -
+    rather than with a memcache round trip per page. With refresh True
+    (default settings.CACHE_NGINX_REFRESH), the pages are re-rendered
+    instead, as by bulk_invalidate(). Returns how many pages were
+    invalidated (or refreshed).
+
+    """
+    pages = [
+        page if isinstance(page, dict) else dict(zip(PAGE_ARGS, page))
+        for page in pages
+    ]
+    if _use_refresh(refresh):
+        # Avoid a circular import: refresh.py uses this module
+        from .refresh import refresh_pages
+        return sum(refresh_pages(
+            (
+                page['request_host'],
+                page['request_path'],
+                page.get('page_version') or '',
+                page.get('cookie_name') or CACHE_NGINX_DEFAULT_COOKIE,
+                page.get('lookup_identifier'),
+                include_stale,
+                page.get('scheme')
+            )
+            for page in pages
+        ))
+
+    by_alias = OrderedDict()
+    scopes = []
+    invalidated_keys = []
+    for page in pages:
+        page_keys = [
+            get_cache_key(
+                request_host=page['request_host'],
+                request_path=page['request_path'],
+                page_version=page.get('page_version') or '',
+                cookie_name=(
+                    page.get('cookie_name') or CACHE_NGINX_DEFAULT_COOKIE
+                ),
+                scheme=key_scheme
+            )
+            for key_scheme in key_schemes(page.get('scheme'))
+        ]
+        # Including the pinned pool, if any. See pinning.py
+        for alias in get_page_aliases(
+            page.get('lookup_identifier') or page['request_host']
+        ):
+            by_alias.setdefault(alias, []).extend(page_keys)
+        scopes.extend(
+            ttl_scope(
+                cache_key,
+                page.get('lookup_identifier') or page['request_host']
+            )
+            for cache_key in page_keys
+        )
+        invalidated_keys.extend(page_keys)
+    record_invalidation(scopes)
+    record_churn_invalidation(invalidated_keys)
 
-    nginx_cache.delete(cache_key)
+    chunk_size = getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+    for alias, cache_keys in by_alias.items():
+        logging.info("Invalidating %d keys in %s" % (len(cache_keys), alias))
+        client = get_nginx_cache(alias)
+        for start in range(0, len(cache_keys), chunk_size):
+            _delete_keys(
+                client, cache_keys[start:start + chunk_size], include_stale
+            )
+    return len(pages)
 
 
 def bulk_invalidate(
         lookup_identifier,
-        supplementary_identifier=None
+        supplementary_identifier=None,
+        include_stale=False,
+        refresh=None,
+        rate=None,
+        order=None
     ):
     """Find all the pages in the lookup table that are identifed by the args
     and invalidate the/any cache for them.
@@ -157,6 +754,22 @@ def bulk_invalidate(
     pages in that 'news' subset by passing the 'news' as the
     supplementary_identifier here.
 
+    As with invalidate(), stale copies are kept unless include_stale is True,
+    and with refresh True (default settings.CACHE_NGINX_REFRESH) the pages
+    are re-rendered rather than deleted - a few at a time, in a pool of
+    worker threads. See refresh.py
+
+    With a rate (keys per second; by default
+    settings.CACHE_NGINX_INVALIDATION_RATE) the pages are deleted in waves
+    by a background thread instead, most requested first if order is
+    'popular', and the InvalidationJob doing so is returned. See
+    staggered.py
+
+    When both could apply, whichever was asked for explicitly wins: a rate
+    passed in wins over settings.CACHE_NGINX_REFRESH, and refresh=True over
+    any rate. Otherwise, refreshing wins over the rate setting. Only a
+    staggered invalidation returns anything.
+
     """
 
     relevant_records = CachedPageRecord.objects.filter(
@@ -168,10 +781,39 @@ def bulk_invalidate(
             supplementary_identifier=supplementary_identifier
         )
 
-    keys_to_delete = [record.base_cache_key for record in relevant_records]
-    logging.info("Bulk invalidation of these keys: %s" % str(keys_to_delete))
+    if refresh is None and rate is not None:
+        refresh = False
+    if _use_refresh(refresh):
+        # Avoid a circular import: refresh.py uses this module
+        from .refresh import refresh_records
+        refresh_records(relevant_records, lookup_identifier, include_stale)
+        if getattr(settings, 'CACHE_NGINX_ADAPTIVE_TTL_SCOPE', 'key') != 'key':
+            record_invalidation([lookup_identifier])
+        return
+
+    if rate is None:
+        rate = getattr(settings, 'CACHE_NGINX_INVALIDATION_RATE', None)
+    if rate:
+        job = staggered_invalidate(
+            relevant_records,
+            lookup_identifier,
+            rate,
+            order,
+            include_stale
+        )
+        if getattr(settings, 'CACHE_NGINX_ADAPTIVE_TTL_SCOPE', 'key') != 'key':
+            record_invalidation([lookup_identifier])
+        return job
 
-    nginx_cache.delete_many(keys_to_delete)
+    # Work through the records a chunk at a time, so that memory use stays
+    # flat however many pages the identifier covers
+    chunk_size = getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+    for keys_to_delete in iter_key_chunks(relevant_records, chunk_size):
+        logging.info("Bulk invalidation of these keys: %s" % keys_to_delete)
+        invalidate_keys(keys_to_delete, lookup_identifier, include_stale)
+
+    if getattr(settings, 'CACHE_NGINX_ADAPTIVE_TTL_SCOPE', 'key') != 'key':
+        record_invalidation([lookup_identifier])
 
     # NB: we _don't_ delete the objects for the keys we've just invalidated -
     # there's little overhead in trying to invalidate an already-invalid key
@@ -182,19 +824,135 @@ def bulk_invalidate(
     # introducing an expiry_datetime field on the model
 
 
+def tagged_records(tags, match='any'):
+    """Returns the CachedPageRecords tagged with any of the given tags (if
+    match is 'any') or every one of them (if match is 'all'). Either way
+    it's a single query, with the tags found via their index, so it stays
+    quick however many pages and tags there are."""
+    tags = set(tags)
+    tag_rows = CachedPageTag.objects.filter(tag__in=tags)
+    if match == 'all':
+        tag_rows = tag_rows.values('page').annotate(
+            tag_count=Count('tag')
+        ).filter(tag_count=len(tags))
+    elif match != 'any':
+        raise ValueError("match must be 'any' or 'all', not %r" % match)
+    return CachedPageRecord.objects.filter(
+        pk__in=tag_rows.values_list('page', flat=True)
+    )
+
+
+def invalidate_tags(tags, match='any', include_stale=False, refresh=None):
+    """Invalidate every page tagged with any (or, with match='all', every
+    one) of the given tags. See the tags argument to the decorator.
+
+    Like bulk_invalidate(), this works through the matching pages in
+    chunks, and leaves the lookup table as it is - or, with refresh True,
+    re-renders them. Returns how many pages were invalidated (or
+    refreshed).
+
+    """
+    records = tagged_records(tags, match)
+    refresh = _use_refresh(refresh)
+    chunk_size = getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+    invalidated = 0
+    # Each identifier's pages may be in a different cache alias
+    identifiers = records.values_list(
+        'parent_identifier', flat=True
+    ).distinct()
+    for identifier in identifiers:
+        if refresh:
+            # Avoid a circular import: refresh.py uses this module
+            from .refresh import refresh_records
+            invalidated += sum(refresh_records(
+                records.filter(parent_identifier=identifier),
+                identifier,
+                include_stale
+            ))
+            continue
+        for keys_to_delete in iter_key_chunks(
+            records.filter(parent_identifier=identifier),
+            chunk_size
+        ):
+            logging.info("Tag invalidation of these keys: %s" % keys_to_delete)
+            invalidate_keys(keys_to_delete, identifier, include_stale)
+            invalidated += len(keys_to_delete)
+    return invalidated
+
+
+def _use_refresh(refresh):
+    if refresh is None:
+        return getattr(settings, 'CACHE_NGINX_REFRESH', False)
+    return refresh
+
+
+def iter_key_chunks(records, chunk_size):
+    """Yields lists of up to chunk_size base cache keys from the given
+    CachedPageRecord queryset. Each chunk is fetched with its own query,
+    picking up where the last left off (rather than with an ever-growing
+    OFFSET), so each costs the same however far through we are."""
+    records = records.order_by('base_cache_key')
+    last_key = None
+    while True:
+        chunk = records
+        if last_key is not None:
+            chunk = chunk.filter(base_cache_key__gt=last_key)
+        keys = list(
+            chunk.values_list('base_cache_key', flat=True)[:chunk_size]
+        )
+        if keys:
+            yield keys
+        if len(keys) < chunk_size:
+            return
+        last_key = keys[-1]
+
+
+def invalidate_keys(cache_keys, lookup_identifier=None, include_stale=False):
+    """Delete the given (base) cache keys, all for pages belonging to
+    lookup_identifier (which picks the cache alias; see routing.py), and
+    their stale copies too if include_stale is True"""
+    if getattr(settings, 'CACHE_NGINX_ADAPTIVE_TTL_SCOPE', 'key') == 'key':
+        record_invalidation(cache_keys)
+    record_churn_invalidation(cache_keys)
+    # Including the pinned pool, if any. See pinning.py
+    for alias in get_page_aliases(lookup_identifier):
+        _delete_keys(get_nginx_cache(alias), cache_keys, include_stale)
+
+
+def _delete_keys(client, cache_keys, include_stale):
+    """Delete the given pages, their churn counters (see churn.py) and, if
+    include_stale is True, their stale copies, in one delete_many()"""
+    extra_keys = counter_keys(cache_keys)
+    if include_stale:
+        extra_keys += [get_stale_key(cache_key) for cache_key in cache_keys]
+    _dispatch(client, 'delete_many', list(cache_keys) + extra_keys)
+
+
 def add_key_to_lookup(
         cache_key,
         lookup_identifier,
-        supplementary_identifier
+        supplementary_identifier,
+        stored_bytes=None,
+        tags=None,
+        request_host=None,
+        request_path=None,
+        page_version=None
     ):
     """Adds a CachedPageRecord to the lookup table, ensuring no duplicates of
-       this data are also stored.
+       this data are also stored. If the record already exists, its
+       stored_bytes and URL are brought up to date.
+
+       Any tags are added to the page's existing ones (see CachedPageTag).
     """
 
     cpr = CachedPageRecord(
         base_cache_key=cache_key,
         parent_identifier=lookup_identifier,
-        supplementary_identifier=supplementary_identifier
+        supplementary_identifier=supplementary_identifier,
+        stored_bytes=stored_bytes,
+        request_host=request_host,
+        request_path=request_path,
+        page_version=page_version
     )
     try:
         cpr.save()
@@ -203,6 +961,27 @@ def add_key_to_lookup(
         # ever need one entry per cached page
         pass
 
+    if tags:
+        add_tags_to_page(cache_key, tags)
+
+
+def add_tags_to_page(cache_key, tags):
+    """Tags the page in the lookup table with the given tags, skipping any
+    it already has"""
+    tags = set(tags)
+    existing = set(CachedPageTag.objects.filter(
+        page=cache_key,
+        tag__in=tags
+    ).values_list('tag', flat=True))
+    try:
+        CachedPageTag.objects.bulk_create([
+            CachedPageTag(page_id=cache_key, tag=tag)
+            for tag in tags - existing
+        ])
+    except IntegrityError:
+        # Another request tagged it at the same time
+        pass
+
 
 def remove_key_from_lookup(
         cache_key,
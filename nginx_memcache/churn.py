@@ -0,0 +1,292 @@
+"""Spotting pages that are re-cached far more often than they should be.
+
+A page that nginx finds in memcache isn't re-rendered until it expires or
+is invalidated, so Django should only cache it about once per timeout. A
+page that's cached over and over is one nginx never finds - usually
+because nginx and Django disagree on its key (see nginxconf.py) - and each
+of those writes is wasted.
+
+With settings.CACHE_NGINX_CHURN on, every page cached is counted, against
+what its timeout and invalidations allow, in one of two places
+(settings.CACHE_NGINX_CHURN_BACKEND):
+
+    'local' (default) - in each process, for up to
+        settings.CACHE_NGINX_CHURN_MAX_ENTRIES pages: a page cached
+        settings.CACHE_NGINX_CHURN_THRESHOLD times (default 3) as often as
+        expected, since this process first cached it, is churning
+    'memcache' - a counter in memcache next to each page, shared by every
+        process, which expires with the page and is deleted when the page
+        is invalidated: a page cached CACHE_NGINX_CHURN_THRESHOLD times
+        while the counter lives is churning
+
+Either way, once a page has been cached at least
+settings.CACHE_NGINX_CHURN_MIN_CACHES times (default 5) - by this process,
+or by all of them - and is churning,
+a warning is logged - with its host, path and page version - and passed to
+settings.CACHE_NGINX_CHURN_CALLBACK (a function, or its dotted path), if
+set. get_churn_report() lists the pages this process has seen, worst
+first.
+
+"""
+
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+from .writer import get_writer
+
+COUNTER_KEY_PREFIX = 'nmchurn:'
+
+
+class ChurnTracker(object):
+    """Keeps the cacheing history of up to max_entries pages, forgetting
+    the least recently cached beyond that"""
+
+    def __init__(self, threshold=3, min_caches=5, max_entries=10000):
+        self.threshold = threshold
+        self.min_caches = min_caches
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def record_cache(
+            self,
+            cache_key,
+            request_host,
+            request_path,
+            page_version,
+            timeout,
+            shared_count=None,
+            now=None
+        ):
+        """Note the page is being cached. shared_count is how many times
+        it has been cached while its memcache counter has lived, if that's
+        being kept. Returns a copy of its entry if it has just started
+        churning, otherwise None."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            entry = self._entries.pop(cache_key, None)
+            if entry is None:
+                entry = {
+                    'cache_key': cache_key,
+                    'first_cached': now,
+                    'caches': 0,
+                    'invalidations': 0,
+                    'churning': False,
+                }
+                if len(self._entries) >= self.max_entries:
+                    self._entries.popitem(last=False)
+            # Re-insert, so that it's the most recently used
+            self._entries[cache_key] = entry
+            entry.update({
+                'request_host': request_host,
+                'request_path': request_path,
+                'page_version': page_version,
+                'timeout': timeout,
+                'last_cached': now,
+            })
+            entry['caches'] += 1
+            if shared_count is None:
+                caches = entry['caches']
+                entry['ratio'] = caches / self.expected_caches(entry)
+            else:
+                # Every process's caches, while the page should have lived
+                caches = entry['shared_caches'] = shared_count
+                entry['ratio'] = float(shared_count)
+
+            churning = (
+                caches >= self.min_caches and
+                entry['ratio'] >= self.threshold
+            )
+            started = churning and not entry['churning']
+            entry['churning'] = churning
+            if started:
+                return dict(entry)
+        return None
+
+    def expected_caches(self, entry):
+        """How many times the page should have been cached since it was
+        first seen, if nginx was finding it"""
+        expected = 1.0 + entry['invalidations']
+        if entry['timeout']:
+            # Once more each time it has had time to expire
+            expected += (
+                entry['last_cached'] - entry['first_cached']
+            ) // entry['timeout']
+        return expected
+
+    def record_invalidation(self, cache_keys):
+        """Note the pages have been invalidated, so will be re-cached.
+        Pages this process hasn't cached are ignored."""
+        with self._lock:
+            for cache_key in cache_keys:
+                entry = self._entries.get(cache_key)
+                if entry is not None:
+                    entry['invalidations'] += 1
+
+    def report(self, churning_only=True):
+        with self._lock:
+            entries = [
+                dict(entry) for entry in self._entries.values()
+                if entry['churning'] or not churning_only
+            ]
+        return sorted(entries, key=lambda entry: -entry['ratio'])
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    """Returns this process's ChurnTracker, creating it if needed"""
+    global _tracker
+    if _tracker is None:
+        with _tracker_lock:
+            if _tracker is None:
+                _tracker = ChurnTracker(
+                    threshold=getattr(
+                        settings, 'CACHE_NGINX_CHURN_THRESHOLD', 3
+                    ),
+                    min_caches=getattr(
+                        settings, 'CACHE_NGINX_CHURN_MIN_CACHES', 5
+                    ),
+                    max_entries=getattr(
+                        settings, 'CACHE_NGINX_CHURN_MAX_ENTRIES', 10000
+                    )
+                )
+    return _tracker
+
+
+def _use_memcache():
+    backend = getattr(settings, 'CACHE_NGINX_CHURN_BACKEND', 'local')
+    return backend == 'memcache'
+
+
+def _get_callback():
+    callback = getattr(settings, 'CACHE_NGINX_CHURN_CALLBACK', None)
+    if isinstance(callback, basestring):
+        module, _, name = callback.rpartition('.')
+        callback = getattr(import_module(module), name)
+    return callback
+
+
+def _count_in_memcache(client, cache_key, timeout):
+    """The shared count, or None if memcache couldn't be asked (see
+    breaker.py)"""
+    # Avoid a circular import: cache.py uses this module
+    from .cache import _call_memcache
+    counter_key = COUNTER_KEY_PREFIX + cache_key
+    added = _call_memcache(client, 'add', counter_key, 1, timeout)
+    if added is None:
+        return None
+    if added:
+        return 1
+    try:
+        return _call_memcache(client, 'incr', counter_key)
+    except ValueError:
+        # Expired between the add and the incr
+        return 1
+
+
+def record_cache(
+        client,
+        cache_key,
+        request_host,
+        request_path,
+        page_version,
+        timeout
+    ):
+    """Note that the page is being cached (with client, under cache_key),
+    if churn tracking is on, and raise the alarm if it's churning.
+
+    With a memcache counter and settings.CACHE_NGINX_BACKGROUND_WRITES,
+    the counting (and any alarm) is left to the background writer thread,
+    so the response doesn't wait on memcache."""
+    if not getattr(settings, 'CACHE_NGINX_CHURN', False):
+        return
+    args = (
+        client, cache_key, request_host, request_path, page_version, timeout
+    )
+    if _use_memcache() and getattr(
+            settings, 'CACHE_NGINX_BACKGROUND_WRITES', False):
+        get_writer().submit(_record_cache, *args)
+    else:
+        _record_cache(*args)
+
+
+def _record_cache(
+        client,
+        cache_key,
+        request_host,
+        request_path,
+        page_version,
+        timeout
+    ):
+    shared_count = None
+    if _use_memcache():
+        shared_count = _count_in_memcache(client, cache_key, timeout)
+        if shared_count is None:
+            # Unknown, so no alarm can be raised
+            return
+    entry = get_tracker().record_cache(
+        cache_key,
+        request_host,
+        request_path,
+        page_version,
+        timeout,
+        shared_count
+    )
+    if entry is None:
+        return
+    logging.warning(
+        "%s%s (page version %r, key %s) has been cached %d times, %.1f "
+        "times as often as its %ds timeout allows: is nginx looking for it "
+        "under another key?" % (
+            entry['request_host'],
+            entry['request_path'],
+            entry['page_version'],
+            entry['cache_key'],
+            # Every process's caches, if they're being counted
+            entry.get('shared_caches', entry['caches']),
+            entry['ratio'],
+            entry['timeout']
+        )
+    )
+    callback = _get_callback()
+    if callback is not None:
+        callback(entry)
+
+
+def record_invalidation(cache_keys):
+    """Note that the pages have been invalidated, if churn tracking is on"""
+    if _tracker is not None:
+        _tracker.record_invalidation(cache_keys)
+
+
+def counter_keys(cache_keys):
+    """The memcache counters to delete along with the given pages, so that
+    their re-cacheing after invalidation isn't counted as churn"""
+    if not getattr(settings, 'CACHE_NGINX_CHURN', False) or not _use_memcache():
+        return []
+    return [COUNTER_KEY_PREFIX + cache_key for cache_key in cache_keys]
+
+
+def get_churn_report(churning_only=True):
+    """The pages this process has cached - just the churning ones, unless
+    churning_only is False - worst first. Each is a dict of its cache_key,
+    request_host, request_path, page_version, timeout, caches,
+    invalidations, first_cached, last_cached, ratio (of caches to those
+    expected) and churning."""
+    return get_tracker().report(churning_only)
+
+
+def reset_churn():
+    """Forget every page - mostly for tests"""
+    global _tracker
+    with _tracker_lock:
+        _tracker = None
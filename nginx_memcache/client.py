@@ -0,0 +1,538 @@
+"""A small memcache text-protocol client, used in place of the
+Django cache backend for the nginx cache.
+
+Why not just use get_cache()? Because the nginx cache needs things Django's
+memcached backends don't give us control over:
+
+    * a bounded pool of connections per server, shared safely between the
+      threads of a worker, rather than one client shared by everything
+    * connect and IO timeouts, plus TCP keepalive
+    * a deadline for each operation as a whole, however slowly the server
+      trickles its reply out
+    * knowing which process opened a socket, so that a forked worker never
+      re-uses a socket its parent (or a sibling) is also talking on
+
+Values are stored exactly as python-memcached would store them (same flags,
+same server selection), so pages cached by this client can be read by nginx
+and by a Django MemcachedCache backend pointed at the same servers, and
+vice versa.
+
+"""
+
+import binascii
+import cPickle as pickle
+import os
+import socket
+import threading
+import time
+import Queue
+
+# Flags, as used by python-memcached
+FLAG_PICKLE = 1 << 0
+FLAG_INTEGER = 1 << 1
+FLAG_LONG = 1 << 2
+
+DEFAULT_PORT = 11211
+# Django's memcached backends treat a timeout longer than 30 days as a
+# timestamp; we do the same
+MAX_RELATIVE_TIMEOUT = 60 * 60 * 24 * 30
+
+
+class MemcacheError(Exception):
+    """Raised when a memcache server can't be talked to, or replies with
+    something we don't understand"""
+    pass
+
+
+class UnsupportedCommand(MemcacheError):
+    """Raised when a memcache server doesn't know a command we sent it -
+    eg the meta commands, before memcached 1.6"""
+    pass
+
+
+class PoolTimeout(MemcacheError):
+    """Raised when every connection in a pool is in use, and none was
+    returned within the pool timeout"""
+    pass
+
+
+def server_hash(key):
+    """The same hash python-memcached uses to pick a server for a key"""
+    return ((binascii.crc32(key) & 0xffffffff) >> 16) & 0x7fff or 1
+
+
+class Connection(object):
+    """A single socket to a memcache server, with line-buffered reads"""
+
+    def __init__(
+            self,
+            address,
+            connect_timeout=None,
+            io_timeout=None,
+            keepalive=True
+        ):
+        if isinstance(address, basestring):
+            # unix:/path/to/socket
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.settimeout(connect_timeout)
+            sock.connect(address)
+        else:
+            sock = socket.create_connection(address, connect_timeout)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            if keepalive:
+                sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        sock.settimeout(io_timeout)
+        self.sock = sock
+        self.io_timeout = io_timeout
+        # When the operation in progress must be finished by, if ever
+        self.deadline = None
+        self._buffer = ''
+
+    def _apply_deadline(self):
+        """Shorten the socket timeout to what's left before the deadline,
+        raising socket.timeout if it has already passed"""
+        if self.deadline is None:
+            return
+        remaining = self.deadline - time.time()
+        if remaining <= 0:
+            raise socket.timeout("operation deadline passed")
+        if self.io_timeout is not None:
+            remaining = min(remaining, self.io_timeout)
+        self.sock.settimeout(remaining)
+
+    def clear_deadline(self):
+        self.deadline = None
+        self.sock.settimeout(self.io_timeout)
+
+    def send(self, data):
+        self._apply_deadline()
+        self.sock.sendall(data)
+
+    def _fill(self):
+        self._apply_deadline()
+        chunk = self.sock.recv(65536)
+        if not chunk:
+            raise MemcacheError("Connection closed by server")
+        self._buffer += chunk
+
+    def readline(self):
+        """Returns the next line, without its trailing \\r\\n"""
+        while True:
+            index = self._buffer.find('\r\n')
+            if index >= 0:
+                line = self._buffer[:index]
+                self._buffer = self._buffer[index + 2:]
+                return line
+            self._fill()
+
+    def read(self, length):
+        """Returns exactly length bytes, then consumes the trailing \\r\\n"""
+        while len(self._buffer) < length + 2:
+            self._fill()
+        data = self._buffer[:length]
+        self._buffer = self._buffer[length + 2:]
+        return data
+
+    def close(self):
+        try:
+            self.sock.close()
+        except socket.error:
+            pass
+
+
+class ConnectionPool(object):
+    """A bounded, thread-safe pool of connections to one server.
+
+    At most max_size connections are ever open at once; a thread wanting a
+    connection when all of them are in use waits up to pool_timeout seconds
+    for one to be returned, then gives up with PoolTimeout.
+
+    """
+
+    def __init__(self, connect, max_size=10, pool_timeout=1.0):
+        self.connect = connect
+        self.max_size = max_size
+        self.pool_timeout = pool_timeout
+        self._idle = Queue.LifoQueue()
+        self._lock = threading.Lock()
+        self._open = 0
+
+    def acquire(self, timeout=None):
+        """A connection, waiting up to timeout (default pool_timeout)
+        seconds for one if they're all in use"""
+        if timeout is None:
+            timeout = self.pool_timeout
+        try:
+            return self._idle.get_nowait()
+        except Queue.Empty:
+            pass
+        with self._lock:
+            can_open = self._open < self.max_size
+            if can_open:
+                self._open += 1
+        if can_open:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                raise
+        try:
+            return self._idle.get(timeout=timeout)
+        except Queue.Empty:
+            raise PoolTimeout(
+                "No connection available after %ss" % timeout
+            )
+
+    def release(self, connection):
+        self._idle.put(connection)
+
+    def discard(self, connection):
+        """Drop a connection that is broken, or in an unknown state"""
+        connection.close()
+        with self._lock:
+            self._open -= 1
+
+    def close(self):
+        """Close the idle connections. Ones checked out stay counted until
+        they're released or discarded, so the pool stays bounded."""
+        closed = 0
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except Queue.Empty:
+                break
+            closed += 1
+        with self._lock:
+            self._open -= closed
+
+
+def parse_server(location):
+    """'host:port', 'host' or 'unix:/path' to something connectable"""
+    if location.startswith('unix:'):
+        return location[5:]
+    host, _, port = location.partition(':')
+    return (host, int(port or DEFAULT_PORT))
+
+
+class MemcacheClient(object):
+    """Talks the memcache text protocol to one or more servers.
+
+    Offers the subset of Django's cache API used by nginx_memcache, and makes
+    keys the same way Django does (KEY_PREFIX:VERSION:key), so nginx can find
+    what we store.
+
+    The client records the process that created it; if it finds itself in a
+    different process (ie, after a fork) it drops its pools and starts again.
+
+    With an operation_timeout, each operation (waiting for a connection
+    included) must be over within that many seconds, or it fails with
+    MemcacheError - io_timeout only bounds each read on its own.
+
+    """
+
+    def __init__(
+            self,
+            servers,
+            key_prefix='',
+            version=1,
+            default_timeout=300,
+            connect_timeout=0.25,
+            io_timeout=0.5,
+            keepalive=True,
+            max_pool_size=10,
+            pool_timeout=1.0,
+            operation_timeout=None
+        ):
+        if isinstance(servers, basestring):
+            servers = servers.split(';')
+        self.servers = [parse_server(server.strip()) for server in servers]
+        self.key_prefix = key_prefix or ''
+        self.version = version
+        self.default_timeout = default_timeout
+        self.connect_timeout = connect_timeout
+        self.io_timeout = io_timeout
+        self.keepalive = keepalive
+        self.max_pool_size = max_pool_size
+        self.pool_timeout = pool_timeout
+        self.operation_timeout = operation_timeout
+        self._pid = None
+        self._pools = None
+        self._lock = threading.Lock()
+
+    # Keys and values
+
+    def make_key(self, key, version=None):
+        key = '%s:%s:%s' % (
+            self.key_prefix,
+            version or self.version,
+            key
+        )
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        return key
+
+    def _timeout(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        timeout = int(timeout)
+        if timeout > MAX_RELATIVE_TIMEOUT:
+            # memcache would treat this as an absolute timestamp
+            timeout += int(time.time())
+        return timeout
+
+    def _encode(self, value):
+        if isinstance(value, str):
+            return 0, value
+        if isinstance(value, unicode):
+            return 0, value.encode('utf-8')
+        if isinstance(value, bool):
+            return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if isinstance(value, int):
+            return FLAG_INTEGER, str(value)
+        if isinstance(value, long):
+            return FLAG_LONG, str(value)
+        return FLAG_PICKLE, pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+
+    def _decode(self, flags, data):
+        if flags & FLAG_INTEGER:
+            return int(data)
+        if flags & FLAG_LONG:
+            return long(data)
+        if flags & FLAG_PICKLE:
+            return pickle.loads(data)
+        return data
+
+    # Connections
+
+    def _get_pools(self):
+        pid = os.getpid()
+        if self._pid != pid:
+            with self._lock:
+                if self._pid != pid:
+                    # Either first use, or we've been forked: never
+                    # touch sockets opened by another process
+                    self._pools = [
+                        ConnectionPool(
+                            self._connector(server),
+                            max_size=self.max_pool_size,
+                            pool_timeout=self.pool_timeout
+                        )
+                        for server in self.servers
+                    ]
+                    self._pid = pid
+        return self._pools
+
+    def _connector(self, server):
+        def connect():
+            try:
+                return Connection(
+                    server,
+                    connect_timeout=self.connect_timeout,
+                    io_timeout=self.io_timeout,
+                    keepalive=self.keepalive
+                )
+            except socket.error, e:
+                raise MemcacheError("Can't connect to %s: %s" % (server, e))
+        return connect
+
+    def _pool_for(self, key):
+        pools = self._get_pools()
+        if len(pools) == 1:
+            return pools[0]
+        return pools[server_hash(key) % len(pools)]
+
+    def _group_by_pool(self, keys):
+        groups = {}
+        for key in keys:
+            groups.setdefault(self._pool_for(key), []).append(key)
+        return groups.items()
+
+    def _call(self, pool, fn):
+        """Run fn(connection) on a pooled connection, discarding the
+        connection if anything goes wrong mid-conversation"""
+        if self.operation_timeout is None:
+            deadline = None
+            connection = pool.acquire()
+        else:
+            deadline = time.time() + self.operation_timeout
+            connection = pool.acquire(
+                min(self.pool_timeout, self.operation_timeout)
+            )
+        connection.deadline = deadline
+        try:
+            result = fn(connection)
+        except socket.timeout, e:
+            pool.discard(connection)
+            raise MemcacheError("Timed out talking to memcache: %s" % e)
+        except socket.error, e:
+            pool.discard(connection)
+            raise MemcacheError("Error talking to memcache: %s" % e)
+        except Exception:
+            pool.discard(connection)
+            raise
+        if deadline is not None:
+            connection.clear_deadline()
+        pool.release(connection)
+        return result
+
+    # Protocol
+
+    def _read_values(self, connection):
+        values = {}
+        while True:
+            line = connection.readline()
+            if line == 'END':
+                return values
+            parts = line.split(' ')
+            if parts[0] != 'VALUE':
+                raise MemcacheError("Unexpected reply to get: %r" % line)
+            key, flags, length = parts[1], int(parts[2]), int(parts[3])
+            values[key] = self._decode(flags, connection.read(length))
+
+    def _expect(self, connection, *acceptable):
+        line = connection.readline()
+        if line not in acceptable:
+            raise MemcacheError("Unexpected reply: %r" % line)
+        return line
+
+    def _store_command(self, command, key, value, timeout):
+        flags, data = self._encode(value)
+        return '%s %s %d %d %d\r\n%s\r\n' % (
+            command, key, flags, self._timeout(timeout), len(data), data
+        )
+
+    # Django-style cache API
+
+    def get(self, key, default=None, version=None):
+        key = self.make_key(key, version)
+
+        def get(connection):
+            connection.send('get %s\r\n' % key)
+            return self._read_values(connection)
+        return self._call(self._pool_for(key), get).get(key, default)
+
+    def get_many(self, keys, version=None):
+        """Fetches many keys with one 'get' per server"""
+        made_keys = dict((self.make_key(key, version), key) for key in keys)
+        found = {}
+        for pool, pool_keys in self._group_by_pool(made_keys.keys()):
+            def get_many(connection):
+                connection.send('get %s\r\n' % ' '.join(pool_keys))
+                return self._read_values(connection)
+            for key, value in self._call(pool, get_many).items():
+                found[made_keys[key]] = value
+        return found
+
+    def set(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version)
+        command = self._store_command('set', key, value, timeout)
+
+        def set(connection):
+            connection.send(command)
+            return self._expect(connection, 'STORED', 'NOT_STORED')
+        return self._call(self._pool_for(key), set) == 'STORED'
+
+    def add(self, key, value, timeout=None, version=None):
+        key = self.make_key(key, version)
+        command = self._store_command('add', key, value, timeout)
+
+        def add(connection):
+            connection.send(command)
+            return self._expect(connection, 'STORED', 'NOT_STORED')
+        return self._call(self._pool_for(key), add) == 'STORED'
+
+    def set_many(self, data, timeout=None, version=None):
+        """Stores many values, pipelining the 'set' commands to each server
+        and then reading all of the replies"""
+        made = dict((self.make_key(key, version), value)
+                    for key, value in data.items())
+        for pool, pool_keys in self._group_by_pool(made.keys()):
+            def set_many(connection):
+                connection.send(''.join(
+                    self._store_command('set', key, made[key], timeout)
+                    for key in pool_keys
+                ))
+                for key in pool_keys:
+                    self._expect(connection, 'STORED', 'NOT_STORED')
+            self._call(pool, set_many)
+
+    def exists_many(self, keys, version=None):
+        """Returns the set of keys that are in memcache, without fetching
+        their values, using the meta get command ('mg', memcached 1.6+).
+        Raises UnsupportedCommand if the server doesn't have it."""
+        made = dict((self.make_key(key, version), key) for key in keys)
+        found = set()
+        for pool, pool_keys in self._group_by_pool(made.keys()):
+            def exists_many(connection):
+                connection.send(''.join(
+                    'mg %s\r\n' % key for key in pool_keys
+                ))
+                # Read every reply before complaining, so the connection
+                # can go back in the pool
+                replies = [connection.readline() for key in pool_keys]
+                for key, reply in zip(pool_keys, replies):
+                    if reply == 'ERROR':
+                        raise UnsupportedCommand(
+                            "memcache server doesn't support mg"
+                        )
+                    if reply.startswith('HD'):
+                        found.add(made[key])
+                    elif reply != 'EN':
+                        raise MemcacheError(
+                            "Unexpected reply to mg: %r" % reply
+                        )
+            self._call(pool, exists_many)
+        return found
+
+    def delete(self, key, version=None):
+        key = self.make_key(key, version)
+
+        def delete(connection):
+            connection.send('delete %s\r\n' % key)
+            return self._expect(connection, 'DELETED', 'NOT_FOUND')
+        self._call(self._pool_for(key), delete)
+
+    def delete_many(self, keys, version=None):
+        """Deletes many keys, pipelining the 'delete' commands to each server
+        and then reading all of the replies"""
+        made_keys = [self.make_key(key, version) for key in keys]
+        for pool, pool_keys in self._group_by_pool(made_keys):
+            def delete_many(connection):
+                connection.send(''.join(
+                    'delete %s\r\n' % key for key in pool_keys
+                ))
+                for key in pool_keys:
+                    self._expect(connection, 'DELETED', 'NOT_FOUND')
+            self._call(pool, delete_many)
+
+    def incr(self, key, delta=1, version=None):
+        key = self.make_key(key, version)
+
+        def incr(connection):
+            connection.send('incr %s %d\r\n' % (key, delta))
+            return connection.readline()
+        line = self._call(self._pool_for(key), incr)
+        if line == 'NOT_FOUND':
+            raise ValueError("Key '%s' not found" % key)
+        if not line.isdigit():
+            raise MemcacheError("Unexpected reply to incr: %r" % line)
+        return int(line)
+
+    def clear(self):
+        for pool in self._get_pools():
+            def flush_all(connection):
+                connection.send('flush_all\r\n')
+                self._expect(connection, 'OK')
+            self._call(pool, flush_all)
+
+    def close(self, **kwargs):
+        # Django calls close() on cache backends at the end of each request;
+        # our connections are pooled, so there's nothing to do then.
+        pass
+
+    def disconnect_all(self):
+        """Close every idle pooled connection owned by this process"""
+        if self._pools is not None and self._pid == os.getpid():
+            for pool in self._pools:
+                pool.close()
@@ -13,14 +13,30 @@ def cache_page_nginx(
         page_version_fn=None,
         anonymous_only=False,
         lookup_identifier=None,
-        supplementary_identifier=None
+        supplementary_identifier=None,
+        admission_threshold=None,
+        adaptive_ttl=None,
+        read_through=None,
+        max_stale=None,
+        tags=None,
+        variants=None,
+        pinned=None,
+        content_type=None
     ):
     decorator = decorator_from_middleware_with_args(UpdateCacheMiddleware)(
         cache_timeout=cache_timeout,
         page_version_fn=page_version_fn,
         anonymous_only=anonymous_only,
         lookup_identifier=lookup_identifier,
-        supplementary_identifier=supplementary_identifier
+        supplementary_identifier=supplementary_identifier,
+        admission_threshold=admission_threshold,
+        adaptive_ttl=adaptive_ttl,
+        read_through=read_through,
+        max_stale=max_stale,
+        tags=tags,
+        variants=variants,
+        pinned=pinned,
+        content_type=content_type
     )
     if callable(view_fn):
         return decorator(view_fn)
@@ -0,0 +1,151 @@
+"""Fragment caching, assembled by nginx with SSI.
+
+cache_page_nginx caches whole pages, so one personalised widget stops a page
+being cached at all. Instead, the page can be cached as a "shell" with
+nginx SSI include directives where its fragments go:
+
+    {% load nginx_fragments %}
+    ...
+    {% nginx_fragment "latest-news" %}
+    {% nginx_fragment "user-menu" %}
+
+Each fragment is a function of the request, registered under a name:
+
+    @fragment('latest-news', timeout=60)
+    def latest_news(request):
+        return render_to_string('news/latest.html', {...})
+
+    @fragment('user-menu', personal=True)
+    def user_menu(request):
+        return render_to_string('user_menu.html', {'user': request.user})
+
+nginx (with 'ssi on') fetches each fragment with a subrequest to
+settings.CACHE_NGINX_FRAGMENT_PREFIX + name (default '/_fragment/<name>'),
+looking in memcache first, just as it does for pages; see the README for the
+config. On a miss it comes to fragment_view() (in nginx_memcache.urls),
+which renders the fragment and - unless it's personal - caches it, with its
+own timeout. So the shell, and every shared fragment, come from memcache,
+and only personal fragments need Django.
+
+Fragments are cached by host and page version (the pv cookie), like pages,
+and with the lookup table on they're tagged 'fragment:<name>', so
+invalidate_fragment() can find them on every host.
+
+With settings.CACHE_NGINX_SSI off (eg in development, without nginx), the
+template tag renders fragments in place instead.
+
+"""
+
+import logging
+
+from django.conf import settings
+from django.http import Http404, HttpResponse
+
+from .cache import (
+    CACHE_NGINX_DEFAULT_COOKIE,
+    CACHE_TIME,
+    cache_response,
+    invalidate,
+    invalidate_tags
+)
+
+_registry = {}
+
+
+class Fragment(object):
+
+    def __init__(self, name, render, timeout=None, personal=False):
+        self.name = name
+        self.render = render
+        self.timeout = timeout
+        self.personal = personal
+
+
+def register_fragment(name, render, timeout=None, personal=False):
+    """Registers render (a function taking the request and returning HTML)
+    as the fragment called name. Shared fragments are cached for timeout
+    seconds (default CACHE_NGINX_TIME); personal ones are never cached."""
+    _registry[name] = Fragment(name, render, timeout, personal)
+    return render
+
+
+def fragment(name, timeout=None, personal=False):
+    """Decorator form of register_fragment()"""
+    def decorator(render):
+        return register_fragment(name, render, timeout, personal)
+    return decorator
+
+
+def get_fragment(name):
+    return _registry.get(name)
+
+
+def fragment_path(name):
+    """The path nginx fetches the fragment from, and caches it under"""
+    return '%s%s' % (
+        getattr(settings, 'CACHE_NGINX_FRAGMENT_PREFIX', '/_fragment/'),
+        name
+    )
+
+
+def fragment_tag(name):
+    """Tag given to cached copies of the fragment in the lookup table"""
+    return 'fragment:%s' % name
+
+
+def ssi_include(name):
+    """The SSI directive nginx replaces with the fragment"""
+    return '<!--# include virtual="%s" -->' % fragment_path(name)
+
+
+def render_fragment(request, name):
+    """Renders the fragment for this request, without cacheing it"""
+    registered = get_fragment(name)
+    if registered is None:
+        raise KeyError("No fragment registered as %r" % name)
+    return registered.render(request)
+
+
+def fragment_view(request, name):
+    """Renders, and unless it's personal caches, the fragment nginx asked
+    for (or couldn't find in memcache)"""
+    registered = get_fragment(name)
+    if registered is None or request.method not in ('GET', 'HEAD'):
+        raise Http404
+    response = HttpResponse(registered.render(request))
+    if registered.personal or not getattr(settings, 'CACHE_NGINX', True):
+        return response
+
+    # nginx keys fragments by the page version cookie the page's request
+    # (and so the subrequest) came with, so we must too
+    cookie_name = getattr(settings, 'CACHE_NGINX_COOKIE', 'pv')
+    cache_response(
+        request,
+        response,
+        cache_timeout=registered.timeout or CACHE_TIME,
+        cookie_name=cookie_name,
+        page_version_fn=lambda request: request.COOKIES.get(cookie_name, ''),
+        tags=[fragment_tag(name)]
+    )
+    logging.info("Fragment %s cached" % name)
+    return response
+
+
+def invalidate_fragment(
+        name,
+        request_host=None,
+        page_version='',
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE
+    ):
+    """Invalidate the cached fragment: on the given host (and page
+    version), or - with the lookup table on, and no host given - on every
+    host and for every page version"""
+    if request_host is not None:
+        invalidate(
+            request_host,
+            fragment_path(name),
+            page_version=page_version,
+            cookie_name=cookie_name
+        )
+    else:
+        invalidate_tags([fragment_tag(name)])
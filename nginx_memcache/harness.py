@@ -0,0 +1,192 @@
+"""An end-to-end load harness: nginx, memcache and Django, all in one
+process, with nothing to install.
+
+NginxSimulator plays nginx's part, as configured by
+nginxconf.server_config(): for each request it builds the memcache key the
+way @memcache_check does (see nginxconf.nginx_cache_key()), looks it up,
+and only passes the request on to Django - through Django's test client, so
+with your whole middleware stack and urlconf - on a miss. Requests marked
+as HTTPS skip memcache.
+
+Pointed at a LocalMemcacheServer (see localmemcache.py) with
+use_memcache(), that is enough to replay a workload of URLs against your
+project and see the hit ratio, how many Django renders were avoided and the
+throughput. ./manage.py nginx_memcache_loadtest does all that for you.
+
+With ssi=True, pages are assembled the way nginx's SSI module would
+(see fragments.py): each <!--# include virtual="..." --> is replaced by a
+subrequest for that path, itself looked for in memcache first.
+
+To simulate an older config, pass its key as key_template - eg the
+README's original '$http_host$uri&pv=$page_version', which ignores query
+strings.
+
+"""
+
+import re
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.test.client import Client
+
+from .cache import keys_include_scheme, reset_nginx_cache
+from .client import Connection, parse_server
+from .nginxconf import nginx_cache_key
+
+SSI_INCLUDE_RE = re.compile(r'<!--#\s*include\s+virtual="([^"]+)"\s*-->')
+# nginx gives up on subrequests nested deeper than this
+MAX_SSI_DEPTH = 10
+
+
+class SSIError(Exception):
+    pass
+
+
+class NginxSimulator(object):
+    """Serves requests as nginx would: from memcache at location if the
+    page is there, otherwise from Django"""
+
+    def __init__(
+            self,
+            location,
+            key_prefix='',
+            cookie_name='pv',
+            key_template=None
+        ):
+        self.connection = Connection(parse_server(location))
+        self.key_prefix = key_prefix
+        self.cookie_name = cookie_name
+        self.key_template = key_template
+        # Keeps cookies (eg the page version) between requests, as a
+        # browser would
+        self.django = Client()
+        self.hits = 0
+        self.misses = 0
+
+    def _cookie_header(self):
+        return '; '.join(
+            '%s=%s' % (morsel.key, morsel.value)
+            for morsel in self.django.cookies.values()
+        )
+
+    def _memcache_get(self, key):
+        self.connection.send('get %s\r\n' % key)
+        value = None
+        while True:
+            line = self.connection.readline()
+            if line == 'END':
+                return value
+            length = int(line.split(' ')[3])
+            value = self.connection.read(length)
+
+    def request(self, path, host='testserver', secure=False):
+        """Returns (source, status, content), where source is 'memcache'
+        or 'django'"""
+        # Unless HTTPS pages are cached under keys of their own, the
+        # documented config sends HTTPS requests straight to Django
+        if not secure or keys_include_scheme():
+            key = nginx_cache_key(
+                host,
+                path,
+                self._cookie_header(),
+                self.cookie_name,
+                self.key_prefix,
+                key_template=self.key_template,
+                scheme='https' if secure else 'http'
+            )
+            content = self._memcache_get(key)
+            if content is not None:
+                self.hits += 1
+                return 'memcache', 200, content
+        self.misses += 1
+        extra = {'HTTP_HOST': host}
+        if secure:
+            extra['HTTP_X_FORWARDED_PROTO'] = 'https'
+        response = self.django.get(path, **extra)
+        return 'django', response.status_code, response.content
+
+    def request_assembled(self, path, host='testserver', secure=False):
+        """Like request(), but with SSI includes filled in by subrequests"""
+        source, status, content = self.request(path, host, secure)
+
+        def fetch(include_path):
+            return self.request(include_path, host, secure)[2]
+        return source, status, assemble_ssi(content, fetch)
+
+    def close(self):
+        self.connection.close()
+
+
+def assemble_ssi(content, fetch, depth=0):
+    """Replaces each SSI include virtual directive in content with
+    fetch(path), recursively, as nginx's SSI module does"""
+    if depth > MAX_SSI_DEPTH:
+        raise SSIError("SSI includes nested too deeply")
+
+    def include(match):
+        return assemble_ssi(fetch(match.group(1)), fetch, depth + 1)
+    return SSI_INCLUDE_RE.sub(include, content)
+
+
+def parse_workload(lines):
+    """Reads a workload: one request per line, as 'path', 'host path' or
+    'https host path'. Blank lines and #comments are skipped. Yields
+    (host, path, secure)"""
+    for line in lines:
+        parts = line.split('#', 1)[0].split()
+        if not parts:
+            continue
+        secure = parts[0].lower() == 'https'
+        if secure:
+            parts = parts[1:]
+        if len(parts) == 1:
+            yield 'testserver', parts[0], secure
+        else:
+            yield parts[0], parts[1], secure
+
+
+def run_workload(simulator, workload, ssi=False):
+    """Replays (host, path, secure) requests through the simulator (with
+    SSI includes assembled, if ssi is True), and returns a report: requests
+    (counting SSI subrequests), hits, misses (ie Django renders),
+    renders_avoided, hit_ratio, errors (non-200 responses), seconds and
+    requests_per_second"""
+    errors = 0
+    started = time.time()
+    request = simulator.request_assembled if ssi else simulator.request
+    for host, path, secure in workload:
+        source, status, content = request(path, host, secure)
+        if status != 200:
+            errors += 1
+    seconds = time.time() - started
+    requests = simulator.hits + simulator.misses
+    return {
+        'requests': requests,
+        'hits': simulator.hits,
+        'misses': simulator.misses,
+        'renders_avoided': simulator.hits,
+        'hit_ratio': float(simulator.hits) / requests if requests else 0.0,
+        'errors': errors,
+        'seconds': seconds,
+        'requests_per_second': requests / seconds if seconds else 0.0,
+    }
+
+
+@contextmanager
+def use_memcache(location, alias=None):
+    """Points the nginx cache alias at the memcache server at location,
+    for the duration of the block"""
+    alias = alias or getattr(settings, 'CACHE_NGINX_ALIAS', 'default')
+    caches = settings.CACHES
+    conf = dict(caches.get(alias, {}))
+    conf['BACKEND'] = 'django.core.cache.backends.memcached.MemcachedCache'
+    conf['LOCATION'] = location
+    settings.CACHES = dict(caches)
+    settings.CACHES[alias] = conf
+    reset_nginx_cache()
+    try:
+        yield conf
+    finally:
+        settings.CACHES = caches
+        reset_nginx_cache()
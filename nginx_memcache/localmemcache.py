@@ -0,0 +1,386 @@
+"""A memcache server, in pure Python, for trying this app out - in tests,
+on a laptop or in CI - without installing memcached.
+
+It speaks enough of the text protocol for this app, nginx's memcached
+module and Django's memcached backends: get/gets, set/add/replace/
+append/prepend/cas, delete, incr/decr, touch, flush_all, stats, version,
+quit, and the meta command mg (with the v, s, f and k flags). Like the
+real thing it has:
+
+    * a memory limit, past which the least recently used items are evicted
+    * an item size limit (1MB by default)
+    * flags, stored and returned untouched
+    * expiry times, relative or (beyond 30 days) absolute
+
+It isn't fast, and it isn't meant for production. Start one with:
+
+    server = LocalMemcacheServer(('127.0.0.1', 0))
+    server.start()   # in a background thread; server.port is the port
+    ...
+    server.stop()
+
+or ./manage.py nginx_memcache_loadtest, which starts one for the duration
+of a load test (see harness.py).
+
+"""
+
+import SocketServer
+import threading
+import time
+from collections import OrderedDict
+
+MAX_RELATIVE_EXPIRY = 60 * 60 * 24 * 30
+# What memcached adds to each item's size, near enough, for its own
+# bookkeeping; counted against the memory limit
+ITEM_OVERHEAD = 48
+VERSION = '1.6.0-nginx-memcache'
+
+
+class MemcacheStore(object):
+    """The items, in least- to most-recently used order, and their stats.
+    Every method is thread-safe."""
+
+    def __init__(
+            self,
+            memory_limit=64 * 1024 * 1024,
+            item_size_limit=1024 * 1024
+        ):
+        self.memory_limit = memory_limit
+        self.item_size_limit = item_size_limit
+        self._items = OrderedDict()  # key -> (flags, expires, cas, value)
+        self._bytes = 0
+        self._next_cas = 1
+        self._lock = threading.Lock()
+        self.stats = {
+            'cmd_get': 0,
+            'cmd_set': 0,
+            'get_hits': 0,
+            'get_misses': 0,
+            'evictions': 0,
+        }
+
+    @staticmethod
+    def _size(key, value):
+        return len(key) + len(value) + ITEM_OVERHEAD
+
+    @staticmethod
+    def expiry_time(exptime):
+        """When an item given this exptime expires, as a timestamp (or 0
+        for never)"""
+        if exptime < 0:
+            return -1
+        if exptime == 0:
+            return 0
+        if exptime <= MAX_RELATIVE_EXPIRY:
+            return time.time() + exptime
+        return exptime
+
+    def _live(self, key):
+        """The item for key, if it exists and hasn't expired, made the most
+        recently used"""
+        item = self._items.pop(key, None)
+        if item is None:
+            return None
+        expires = item[1]
+        if expires and expires <= time.time():
+            self._bytes -= self._size(key, item[3])
+            return None
+        self._items[key] = item
+        return item
+
+    def _store(self, key, flags, expires, value):
+        old = self._items.pop(key, None)
+        if old is not None:
+            self._bytes -= self._size(key, old[3])
+        cas = self._next_cas
+        self._next_cas += 1
+        self._items[key] = (flags, expires, cas, value)
+        self._bytes += self._size(key, value)
+        while self._bytes > self.memory_limit and self._items:
+            old_key, old_item = self._items.popitem(last=False)
+            self._bytes -= self._size(old_key, old_item[3])
+            self.stats['evictions'] += 1
+
+    def get(self, key):
+        """Returns (flags, cas, value), or None"""
+        with self._lock:
+            self.stats['cmd_get'] += 1
+            item = self._live(key)
+            if item is None:
+                self.stats['get_misses'] += 1
+                return None
+            self.stats['get_hits'] += 1
+            return item[0], item[2], item[3]
+
+    def store(self, command, key, flags, exptime, value, cas_unique=None):
+        """Carries out a storage command, returning the reply"""
+        if len(value) + len(key) > self.item_size_limit:
+            return 'SERVER_ERROR object too large for cache'
+        expires = self.expiry_time(exptime)
+        with self._lock:
+            self.stats['cmd_set'] += 1
+            item = self._live(key)
+            if command == 'add' and item is not None:
+                return 'NOT_STORED'
+            if command in ('replace', 'append', 'prepend') and item is None:
+                return 'NOT_STORED'
+            if command == 'cas':
+                if item is None:
+                    return 'NOT_FOUND'
+                if item[2] != cas_unique:
+                    return 'EXISTS'
+            if command == 'append':
+                flags, expires, value = item[0], item[1], item[3] + value
+            elif command == 'prepend':
+                flags, expires, value = item[0], item[1], value + item[3]
+            if expires == -1:
+                # Stored, but already expired
+                if item is not None:
+                    self._items.pop(key)
+                    self._bytes -= self._size(key, item[3])
+                return 'STORED'
+            self._store(key, flags, expires, value)
+            return 'STORED'
+
+    def delete(self, key):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                return False
+            self._items.pop(key)
+            self._bytes -= self._size(key, item[3])
+            return True
+
+    def incr(self, key, delta):
+        """Adds delta (which may be negative) to the number stored under
+        key, returning the new value; None if there's no such item, or
+        False if it isn't a number"""
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                return None
+            try:
+                value = int(item[3])
+            except ValueError:
+                return False
+            # Like memcached: wraps at 64 bits, and stops at 0
+            value = max(0, value + delta) % 2 ** 64
+            self._store(key, item[0], item[1], str(value))
+            return value
+
+    def touch(self, key, exptime):
+        with self._lock:
+            item = self._live(key)
+            if item is None:
+                return False
+            self._items[key] = (
+                item[0], self.expiry_time(exptime), item[2], item[3]
+            )
+            return True
+
+    def flush(self):
+        with self._lock:
+            self._items.clear()
+            self._bytes = 0
+
+    def get_stats(self):
+        with self._lock:
+            stats = dict(self.stats)
+            stats['curr_items'] = len(self._items)
+            stats['bytes'] = self._bytes
+            stats['limit_maxbytes'] = self.memory_limit
+            return stats
+
+
+class MemcacheRequestHandler(SocketServer.StreamRequestHandler):
+    """One client connection, handling commands until it goes away"""
+
+    def reply(self, line, noreply=False):
+        if not noreply:
+            self.wfile.write(line + '\r\n')
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            parts = line.split()
+            if not parts:
+                self.reply('ERROR')
+                continue
+            command, args = parts[0], parts[1:]
+            handler = getattr(self, 'do_' + command, None)
+            if handler is None:
+                self.reply('ERROR')
+                continue
+            try:
+                if handler(store, args) is False:
+                    return
+            except (ValueError, IndexError):
+                self.reply('CLIENT_ERROR bad command line format')
+            self.wfile.flush()
+
+    def do_get(self, store, keys, with_cas=False):
+        for key in keys:
+            item = store.get(key)
+            if item is None:
+                continue
+            flags, cas, value = item
+            if with_cas:
+                self.reply('VALUE %s %d %d %d' % (key, flags, len(value), cas))
+            else:
+                self.reply('VALUE %s %d %d' % (key, flags, len(value)))
+            self.reply(value)
+        self.reply('END')
+
+    def do_gets(self, store, keys):
+        self.do_get(store, keys, with_cas=True)
+
+    def _store(self, store, command, args):
+        key, flags, exptime, length = args[:4]
+        cas_unique = None
+        if command == 'cas':
+            cas_unique = int(args[4])
+            args = args[5:]
+        else:
+            args = args[4:]
+        noreply = args[:1] == ['noreply']
+        value = self.rfile.read(int(length) + 2)[:-2]
+        self.reply(
+            store.store(
+                command, key, int(flags), int(exptime), value, cas_unique
+            ),
+            noreply
+        )
+
+    def do_set(self, store, args):
+        self._store(store, 'set', args)
+
+    def do_add(self, store, args):
+        self._store(store, 'add', args)
+
+    def do_replace(self, store, args):
+        self._store(store, 'replace', args)
+
+    def do_append(self, store, args):
+        self._store(store, 'append', args)
+
+    def do_prepend(self, store, args):
+        self._store(store, 'prepend', args)
+
+    def do_cas(self, store, args):
+        self._store(store, 'cas', args)
+
+    def do_delete(self, store, args):
+        noreply = args[-1:] == ['noreply']
+        self.reply(
+            'DELETED' if store.delete(args[0]) else 'NOT_FOUND', noreply
+        )
+
+    def _incr(self, store, args, sign):
+        noreply = args[2:3] == ['noreply']
+        value = store.incr(args[0], sign * int(args[1]))
+        if value is None:
+            self.reply('NOT_FOUND', noreply)
+        elif value is False:
+            self.reply(
+                'CLIENT_ERROR cannot increment or decrement non-numeric value',
+                noreply
+            )
+        else:
+            self.reply(str(value), noreply)
+
+    def do_incr(self, store, args):
+        self._incr(store, args, 1)
+
+    def do_decr(self, store, args):
+        self._incr(store, args, -1)
+
+    def do_touch(self, store, args):
+        noreply = args[2:3] == ['noreply']
+        self.reply(
+            'TOUCHED' if store.touch(args[0], int(args[1])) else 'NOT_FOUND',
+            noreply
+        )
+
+    def do_mg(self, store, args):
+        """Meta get: 'HD' (plus any flags asked for) if the item exists,
+        'EN' if not. With the v flag, 'VA <size>' and the value."""
+        key, flags = args[0], args[1:]
+        item = store.get(key)
+        if item is None:
+            self.reply('EN')
+            return
+        item_flags, cas, value = item
+        returned = []
+        for flag in flags:
+            if flag == 's':
+                returned.append('s%d' % len(value))
+            elif flag == 'f':
+                returned.append('f%d' % item_flags)
+            elif flag == 'k':
+                returned.append('k%s' % key)
+            elif flag == 'c':
+                returned.append('c%d' % cas)
+        if 'v' in flags:
+            self.reply(' '.join(['VA', str(len(value))] + returned))
+            self.reply(value)
+        else:
+            self.reply(' '.join(['HD'] + returned))
+
+    def do_flush_all(self, store, args):
+        store.flush()
+        self.reply('OK', args[-1:] == ['noreply'])
+
+    def do_stats(self, store, args):
+        for name, value in sorted(store.get_stats().items()):
+            self.reply('STAT %s %s' % (name, value))
+        self.reply('END')
+
+    def do_version(self, store, args):
+        self.reply('VERSION %s' % VERSION)
+
+    def do_quit(self, store, args):
+        return False
+
+
+class LocalMemcacheServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """A memcache server on the given (host, port) - port 0 picks a free
+    one, which is then in self.port"""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(
+            self,
+            address=('127.0.0.1', 0),
+            memory_limit=64 * 1024 * 1024,
+            item_size_limit=1024 * 1024
+        ):
+        SocketServer.TCPServer.__init__(self, address, MemcacheRequestHandler)
+        self.store = MemcacheStore(memory_limit, item_size_limit)
+        self.port = self.server_address[1]
+        self._thread = None
+
+    @property
+    def location(self):
+        """Where to point CACHES (or nginx) at"""
+        return '%s:%d' % self.server_address
+
+    def start(self):
+        """Serve in a background (daemon) thread"""
+        # A short poll interval, so stop() doesn't keep us waiting
+        self._thread = threading.Thread(
+            target=self.serve_forever,
+            kwargs={'poll_interval': 0.05},
+            name='nginx-memcache-local-server'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self._thread is not None:
+            self._thread.join()
@@ -0,0 +1,85 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nginx_memcache.nginxconf import (
+    SAMPLE_REQUESTS,
+    check_key_parity,
+    expand_samples,
+    multi_server_aliases,
+    server_config
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Prints nginx config that serves pages from memcache exactly as "
+        "they are cached with the current settings, or (with --check) "
+        "checks that nginx and Django would build the same cache keys."
+    )
+    args = '[[scheme://]host/path ...]'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--backend',
+            dest='backend',
+            default='127.0.0.1:8000',
+            help='Where nginx should proxy cache misses to '
+                 '(default 127.0.0.1:8000)'
+        ),
+        make_option(
+            '--check',
+            action='store_true',
+            dest='check',
+            default=False,
+            help='Compare the cache keys nginx and Django make for sample '
+                 'requests (or the given host/path URLs), rather than '
+                 'printing the config'
+        ),
+    )
+
+    def handle(self, *urls, **options):
+        if not options['check']:
+            for alias in multi_server_aliases():
+                self.stderr.write(
+                    "WARNING: cache alias %s has more than one memcache "
+                    "server, but nginx only looks on the first\n" % alias
+                )
+            self.stdout.write(
+                server_config(django_upstream=options['backend']) + '\n'
+            )
+            return
+
+        samples = SAMPLE_REQUESTS
+        if urls:
+            samples = []
+            for url in urls:
+                scheme, _, rest = url.rpartition('://')
+                host, slash, path = rest.partition('/')
+                sample = (host, slash + path or '/', '')
+                if scheme:
+                    sample += (scheme,)
+                samples.append(sample)
+        samples = expand_samples(samples)
+        mismatches = check_key_parity(samples)
+        if mismatches:
+            raise CommandError(
+                "nginx and Django disagree on %d of %d cache keys:\n%s" % (
+                    len(mismatches),
+                    len(samples),
+                    '\n'.join(
+                        "  %s://%s%s (Cookie: %r)\n    Django: %s\n"
+                        "    nginx:  %s" % (
+                            (sample + ('http',))[3],
+                            sample[0],
+                            sample[1],
+                            sample[2],
+                            django_key,
+                            nginx_key
+                        )
+                        for sample, django_key, nginx_key in mismatches
+                    )
+                )
+            )
+        self.stdout.write(
+            "nginx and Django agree on all %d cache keys\n" % len(samples)
+        )
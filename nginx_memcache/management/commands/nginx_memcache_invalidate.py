@@ -0,0 +1,77 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from nginx_memcache.cache import bulk_invalidate
+
+
+class Command(BaseCommand):
+    help = (
+        "Invalidates every cached page for a lookup_identifier (by default, "
+        "a host) a few at a time, so that Django isn't flooded with misses. "
+        "Shows progress as it goes; interrupt it to stop."
+    )
+    args = 'lookup_identifier'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--supplementary',
+            dest='supplementary_identifier',
+            default=None,
+            help='Only invalidate pages with this supplementary_identifier'
+        ),
+        make_option(
+            '--rate',
+            type='float',
+            dest='rate',
+            default=100,
+            help='Pages to invalidate per second (default 100)'
+        ),
+        make_option(
+            '--popular-first',
+            action='store_const',
+            const='popular',
+            dest='order',
+            default=None,
+            help='Invalidate the most requested pages first'
+        ),
+        make_option(
+            '--include-stale',
+            action='store_true',
+            dest='include_stale',
+            default=False,
+            help='Remove stale copies of the pages too'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError("Give one lookup_identifier")
+        if options['rate'] <= 0:
+            raise CommandError("--rate must be more than 0")
+        job = bulk_invalidate(
+            args[0],
+            options['supplementary_identifier'],
+            include_stale=options['include_stale'],
+            # Deleted in waves, even if pages are usually refreshed
+            refresh=False,
+            rate=options['rate'],
+            order=options['order']
+        )
+        try:
+            job.join(1)
+            while job.state == 'running':
+                self.write_progress(job)
+                job.join(1)
+        except KeyboardInterrupt:
+            job.cancel()
+            job.join()
+        self.write_progress(job)
+
+    def write_progress(self, job):
+        progress = job.progress()
+        line = "%(state)s: %(invalidated)d of %(total)d pages invalidated" % (
+            progress
+        )
+        if progress['eta'] is not None:
+            line += ", about %ds to go" % progress['eta']
+        self.stdout.write(line + "\n")
@@ -0,0 +1,117 @@
+from optparse import make_option
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from nginx_memcache.harness import (
+    NginxSimulator,
+    parse_workload,
+    run_workload,
+    use_memcache
+)
+from nginx_memcache.localmemcache import LocalMemcacheServer
+
+
+class Command(BaseCommand):
+    help = (
+        "Replays a workload of URLs (one per line: 'path', 'host path' or "
+        "'https host path') against this project, with nginx's memcache "
+        "lookup simulated in front of it, and reports the hit ratio, Django "
+        "renders avoided and throughput. Unless --server is given, runs its "
+        "own in-process memcache server, so needs nothing installed."
+    )
+    args = 'workload_file [workload_file ...]'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--repeat',
+            type='int',
+            dest='repeat',
+            default=1,
+            help='How many times to replay the workload (default 1)'
+        ),
+        make_option(
+            '--memory',
+            type='int',
+            dest='memory',
+            default=64,
+            help="The local memcache server's memory limit, in MB (default 64)"
+        ),
+        make_option(
+            '--item-size',
+            type='int',
+            dest='item_size',
+            default=1024,
+            help="The local memcache server's item size limit, in KB "
+                 "(default 1024)"
+        ),
+        make_option(
+            '--ssi',
+            action='store_true',
+            dest='ssi',
+            default=False,
+            help='Assemble SSI includes (eg cached fragments) as nginx would'
+        ),
+        make_option(
+            '--server',
+            dest='server',
+            default=None,
+            help='Use the memcache server at host:port instead of a local one'
+        ),
+    )
+
+    def handle(self, *files, **options):
+        if not files:
+            raise CommandError("Give at least one workload file")
+        workload = []
+        for name in files:
+            with open(name) as lines:
+                workload.extend(parse_workload(lines))
+        workload = workload * options['repeat']
+
+        server = None
+        location = options['server']
+        if location is None:
+            server = LocalMemcacheServer(
+                memory_limit=options['memory'] * 1024 * 1024,
+                item_size_limit=options['item_size'] * 1024
+            )
+            server.start()
+            location = server.location
+
+        try:
+            with use_memcache(location) as conf:
+                simulator = NginxSimulator(
+                    location,
+                    key_prefix=conf.get('KEY_PREFIX', ''),
+                    cookie_name=getattr(settings, 'CACHE_NGINX_COOKIE', 'pv')
+                )
+                try:
+                    report = run_workload(simulator, workload, options['ssi'])
+                finally:
+                    simulator.close()
+        finally:
+            if server is not None:
+                server.stop()
+
+        self.stdout.write("requests:            %d\n" % report['requests'])
+        self.stdout.write("memcache hits:       %d\n" % report['hits'])
+        self.stdout.write("Django renders:      %d\n" % report['misses'])
+        self.stdout.write(
+            "renders avoided:     %d\n" % report['renders_avoided']
+        )
+        self.stdout.write(
+            "hit ratio:           %.1f%%\n" % (report['hit_ratio'] * 100)
+        )
+        self.stdout.write("non-200 responses:   %d\n" % report['errors'])
+        self.stdout.write(
+            "throughput:          %.1f requests/second\n" % (
+                report['requests_per_second']
+            )
+        )
+        if server is not None:
+            stats = server.store.get_stats()
+            self.stdout.write(
+                "memcache:            %d items, %d bytes, %d evictions\n" % (
+                    stats['curr_items'], stats['bytes'], stats['evictions']
+                )
+            )
@@ -0,0 +1,76 @@
+import timeit
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.utils.html import strip_spaces_between_tags
+
+from nginx_memcache.minify import minify_html
+
+SAMPLE_PAGE = """<!DOCTYPE html>
+<html>
+    <head>
+        <title>  Benchmark page  </title>
+        <!--[if lt IE 9]><script src="html5shiv.js"></script><![endif]-->
+        <style>
+            body  {  margin: 0;  }
+        </style>
+    </head>
+    <body>
+        <!-- navigation -->
+        <ul>
+            <li>   <a href="/">Home</a>   </li>
+            <li>   <a href="/news/">News</a>   </li>
+        </ul>
+        <pre>
+    preformatted    text
+        </pre>
+        <p>
+            Some    text,   with <b>bold</b>    and <i>italic</i> bits.
+        </p>
+        <textarea>  keep   this  </textarea>
+        <script>
+            var  x  =  "  spaces  ";
+        </script>
+    </body>
+</html>
+"""
+
+
+class Command(BaseCommand):
+    help = (
+        "Times the HTML minifier used for cached pages against Django's "
+        "strip_spaces_between_tags, and shows how many bytes each saves."
+    )
+    args = '[html_file ...]'
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--iterations',
+            type='int',
+            dest='iterations',
+            default=1000,
+            help='How many times to minify each page (default 1000)'
+        ),
+    )
+
+    def handle(self, *files, **options):
+        iterations = options['iterations']
+        pages = [(name, open(name, 'rb').read()) for name in files]
+        if not pages:
+            pages = [('sample page', SAMPLE_PAGE * 20)]
+
+        for name, content in pages:
+            self.stdout.write("%s (%d bytes)\n" % (name, len(content)))
+            for label, fn in (
+                ('nginx_memcache', minify_html),
+                ('strip_spaces_between_tags', strip_spaces_between_tags),
+            ):
+                seconds = timeit.timeit(lambda: fn(content), number=iterations)
+                saved = len(content) - len(fn(content))
+                self.stdout.write(
+                    "  %-26s %8.3f ms/page  %7d bytes saved (%.1f%%)\n" % (
+                        label,
+                        seconds * 1000 / iterations,
+                        saved,
+                        100.0 * saved / max(len(content), 1)
+                    )
+                )
@@ -0,0 +1,57 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from nginx_memcache.reconcile import reconcile_lookup_table
+
+
+class Command(BaseCommand):
+    help = (
+        "Removes lookup table records for pages that are no longer in "
+        "memcache, so that bulk invalidation only has live pages to do."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--identifier',
+            dest='identifier',
+            default=None,
+            help='Only check pages with this parent_identifier'
+        ),
+        make_option(
+            '--chunk-size',
+            type='int',
+            dest='chunk_size',
+            default=None,
+            help='How many records to check at a time (default '
+                 'CACHE_NGINX_BULK_CHUNK_SIZE, or 1000)'
+        ),
+        make_option(
+            '--pause',
+            type='float',
+            dest='pause',
+            default=0,
+            help='Seconds to wait between chunks (default 0)'
+        ),
+        make_option(
+            '--dry-run',
+            action='store_true',
+            dest='dry_run',
+            default=False,
+            help="Only count the dead records; don't remove them"
+        ),
+    )
+
+    def handle(self, *args, **options):
+        totals = reconcile_lookup_table(
+            lookup_identifier=options['identifier'],
+            chunk_size=options['chunk_size'],
+            pause=options['pause'],
+            dry_run=options['dry_run']
+        )
+        line = (
+            "Checked %(checked)d records: %(dead)d dead, %(removed)d removed"
+            % totals
+        )
+        if totals['skipped']:
+            line += "; %(skipped)d skipped, memcache not answering" % totals
+        self.stdout.write(line + "\n")
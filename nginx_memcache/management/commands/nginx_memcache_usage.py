@@ -0,0 +1,55 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from nginx_memcache.usage import usage_report
+
+
+class Command(BaseCommand):
+    help = (
+        "Shows how many bytes of cached pages each lookup identifier (or "
+        "supplementary identifier) has in memcache, according to the "
+        "lookup table."
+    )
+    option_list = BaseCommand.option_list + (
+        make_option(
+            '--by-supplementary',
+            action='store_true',
+            dest='by_supplementary',
+            default=False,
+            help='Group by supplementary_identifier, not parent_identifier'
+        ),
+        make_option(
+            '--identifier',
+            dest='identifier',
+            default=None,
+            help='Only report on pages with this parent_identifier'
+        ),
+        make_option(
+            '--limit',
+            type='int',
+            dest='limit',
+            default=None,
+            help='Only show this many of the biggest users'
+        ),
+    )
+
+    def handle(self, *args, **options):
+        rows = usage_report(
+            group_by=(
+                'supplementary_identifier' if options['by_supplementary']
+                else 'parent_identifier'
+            ),
+            lookup_identifier=options['identifier'],
+            limit=options['limit']
+        )
+        self.stdout.write("%-45s %10s %14s %12s\n" % (
+            'identifier', 'pages', 'total bytes', 'avg bytes'
+        ))
+        for row in rows:
+            self.stdout.write("%-45s %10d %14d %12d\n" % (
+                row['identifier'],
+                row['pages'],
+                row['total_bytes'],
+                row['average_bytes']
+            ))
@@ -1,8 +1,23 @@
 import logging
 
 from django.conf import settings
+from django.http import HttpResponse
 
-from .cache import cache_response
+from .cache import (
+    CACHE_NGINX_DEFAULT_COOKIE,
+    cache_response,
+    get_cached_or_stale_page,
+    get_cached_page,
+    get_nginx_cache,
+    get_request_cache_key,
+    get_request_scheme
+)
+from .refresh import refresh_request, render_page
+from .routing import get_cache_alias
+from .stale import start_revalidation
+
+# Added to responses served from the cache by Django rather than nginx
+READ_THROUGH_HEADER = 'X-Nginx-Memcache'
 
 
 class UpdateCacheMiddleware(object):
@@ -25,7 +40,15 @@ class UpdateCacheMiddleware(object):
             page_version_fn,
             anonymous_only,
             lookup_identifier=None,
-            supplementary_identifier=None
+            supplementary_identifier=None,
+            admission_threshold=None,
+            adaptive_ttl=None,
+            read_through=None,
+            max_stale=None,
+            tags=None,
+            variants=None,
+            pinned=None,
+            content_type=None
         ):
         """Initialize middleware. Args:
             * cache_timeout - seconds after which the cached response expires
@@ -38,14 +61,168 @@ class UpdateCacheMiddleware(object):
                 thing to use anyway.
             * supplementary_identifier - entirely optional scoping variable.
                 For populating the lookup table; see models.CachedPageRecord
+            * admission_threshold - only cache the page once it has been
+                requested this many times recently; see admission.py.
+                Defaults to settings.CACHE_NGINX_ADMISSION_THRESHOLD
+            * adaptive_ttl - let the page's invalidation history adjust
+                cache_timeout; see ttl.py. Defaults to
+                settings.CACHE_NGINX_ADAPTIVE_TTL
+            * read_through - serve the page from the cache when a request
+                that nginx didn't look up reaches Django; see
+                process_request. Defaults to settings.CACHE_NGINX_READ_THROUGH
+            * max_stale - also keep a copy of the page for this many seconds,
+                to serve while it is re-rendered once it has expired or been
+                invalidated; see stale.py. Defaults to
+                settings.CACHE_NGINX_MAX_STALE
+            * tags - a list of tags for the page in the lookup table, or a
+                function taking the request and returning one; see
+                models.CachedPageTag and cache.invalidate_tags
+            * variants - a variants.VariantSpec, for pages that vary by
+                cookies and headers; replaces page_version_fn
+            * pinned - cache the page in the pinned pool, which long-tail
+                pages can't evict it from; see pinning.py. Defaults to
+                whether the path matches settings.CACHE_NGINX_PINNED_URLS
+            * content_type - the Content-Type of the page when Django serves
+                it from the cache (memcache only holds the body), as nginx's
+                default_type does. Defaults to
+                settings.CACHE_NGINX_READ_THROUGH_CONTENT_TYPE
 
         """
 
         self.cache_timeout = cache_timeout
+        self.variants = variants
+        if variants is not None:
+            page_version_fn = variants.page_version
         self.page_version_fn = page_version_fn
         self.anonymous_only = anonymous_only
         self.lookup_identifier = lookup_identifier
         self.supplementary_identifier = supplementary_identifier
+        self.admission_threshold = admission_threshold
+        self.adaptive_ttl = adaptive_ttl
+        self.read_through = read_through
+        self.max_stale = max_stale
+        self.tags = tags
+        self.pinned = pinned
+        self.content_type = content_type
+
+    def process_request(self, request):
+        """Serves the page straight from the cache, if read-through is on and
+        the page is there. This catches requests that reached Django without
+        nginx looking in memcache first - eg HTTPS requests, in the example
+        nginx config, or requests that bypass nginx altogether.
+
+        With stale copies on, process_view() looks for the page instead,
+        along with its stale copy, in one round trip."""
+
+        if not self._use_read_through() or self._get_max_stale() > 0:
+            return None
+        if not self._may_serve_from_cache(request):
+            return None
+
+        content = get_cached_page(
+            request,
+            page_version_fn=self.page_version_fn,
+            lookup_identifier=self.lookup_identifier
+        )
+        if content is None:
+            return None
+
+        logging.info("Serving %s from the cache" % request.get_full_path())
+        return self._cached_response(content, 'django-hit')
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        """Serves the stale copy of the page, if there is one and the page
+        itself isn't cached, and has the page re-rendered in the background.
+        See stale.py. The page itself is only served from here if
+        read-through is on, as in process_request()."""
+
+        if self._get_max_stale() <= 0 or not self._may_serve_from_cache(
+            request):
+            return None
+
+        content, is_stale = get_cached_or_stale_page(
+            request,
+            page_version_fn=self.page_version_fn,
+            lookup_identifier=self.lookup_identifier
+        )
+        if content is None:
+            return None
+        if not is_stale:
+            if not self._use_read_through():
+                return None
+            # nginx didn't look for it (eg it's an HTTPS request)
+            return self._cached_response(content, 'django-hit')
+
+        # Re-rendered from an anonymous request of its own, as refresh.py
+        # does - this one is on its way back to the client - so through
+        # the page's decorated view
+        fresh_request = refresh_request(
+            request.get_host(),
+            request.get_full_path(),
+            self.page_version_fn(request) if self.page_version_fn else '',
+            CACHE_NGINX_DEFAULT_COOKIE,
+            get_request_scheme(request)
+        )
+
+        def render():
+            render_page(fresh_request)
+
+        start_revalidation(
+            get_nginx_cache(
+                get_cache_alias(self.lookup_identifier or request.get_host())
+            ),
+            get_request_cache_key(request, self.page_version_fn),
+            render
+        )
+        logging.info("Serving a stale copy of %s" % request.get_full_path())
+        return self._cached_response(content, 'django-stale')
+
+    def _use_read_through(self):
+        if self.read_through is None:
+            return getattr(settings, 'CACHE_NGINX_READ_THROUGH', False)
+        return self.read_through
+
+    def _get_max_stale(self):
+        if self.max_stale is None:
+            return getattr(settings, 'CACHE_NGINX_MAX_STALE', 0)
+        return self.max_stale
+
+    def _may_serve_from_cache(self, request):
+        """Whether this request may be given the cached copy of the page"""
+
+        if not getattr(settings, 'CACHE_NGINX', True):
+            return False
+
+        # It's being re-rendered to replace the cached copy; see refresh.py
+        if getattr(request, 'nginx_memcache_refresh', False):
+            return False
+
+        if request.method not in ('GET', 'HEAD'):
+            return False
+
+        # Cached pages are only for anonymous users if anonymous_only is set
+        if self.anonymous_only and request.user.is_authenticated():
+            return False
+
+        # If HTTPS pages aren't cached, what's in the cache is the
+        # HTTP version, which we shouldn't serve over HTTPS
+        do_cache_https = getattr(settings, 'CACHE_NGINX_INCLUDE_HTTPS', True)
+        if not do_cache_https and is_secure_request(request):
+            return False
+
+        return True
+
+    def _cached_response(self, content, source):
+        response = HttpResponse(
+            content,
+            content_type=self.content_type or getattr(
+                settings,
+                'CACHE_NGINX_READ_THROUGH_CONTENT_TYPE',
+                'text/html; charset=utf-8'
+            )
+        )
+        response[READ_THROUGH_HEADER] = source
+        return response
 
     def process_response(self, request, response):
         """Sets the cache, if needed."""
@@ -56,15 +233,6 @@ class UpdateCacheMiddleware(object):
 
         do_cache_https = getattr(settings, 'CACHE_NGINX_INCLUDE_HTTPS', True)
 
-        https_headers_to_check = getattr(
-            settings,
-            'CACHE_NGINX_ALTERNATIVE_SSL_HEADERS',
-            (
-                ('X-Forwarded-Proto', 'HTTPS'),
-                ('X-Forwarded-SSL', 'on')
-            )
-        )
-
         if not is_enabled or request.method != 'GET' or (
             response.status_code != 200):
             # HTTPMiddleware, throws the body of a HEAD-request away before
@@ -76,32 +244,9 @@ class UpdateCacheMiddleware(object):
             return response
 
         logging.info("do_cache_https: %s" % do_cache_https)
-        if not do_cache_https:
-            # If cacheing of pages accessed over https, skip cacheing
-            if request.is_secure():
-                logging.info("request.is_secure() == True")
-                return response
-            else:
-                logging.info("request.is_secure() == False")
-
-            # As of Django 1.4, request.is_secure() checks for things like
-            # X-Forwarded-Proto and X-Forwarded-Proto-Forwarded-SSL, but this caters for
-            # pre-1.4 projects:
-
-            for header, significant_value in https_headers_to_check:
-                # convert header to Django's request.META format
-                _header = 'HTTP_' + header.upper().replace('-', '_')
-                logging.info('_header: %s' % _header)
-                logging.info('request.GET %s' % request.GET)
-                logging.info('request.META %s' % request.META)
-                logging.info("Trying header: %s request val:%s significant_value: %s " % (
-                    _header,
-                    request.META.get(_header, "").lower(),
-                    significant_value.lower())
-                )
-                if request.META.get(_header, "").lower() == significant_value.lower():
-                    logging.info("Not cacheing because found appropriate post-HTTPS header")
-                    return response
+        if not do_cache_https and is_secure_request(request):
+            logging.info("Not cacheing because request was made over HTTPS")
+            return response
 
         # Otherwise, we do want to cache the response.
         cache_response(
@@ -110,8 +255,51 @@ class UpdateCacheMiddleware(object):
             cache_timeout=self.cache_timeout,
             page_version_fn=self.page_version_fn,
             lookup_identifier=self.lookup_identifier,
-            supplementary_identifier=self.supplementary_identifier
+            supplementary_identifier=self.supplementary_identifier,
+            admission_threshold=self.admission_threshold,
+            adaptive_ttl=self.adaptive_ttl,
+            max_stale=self._get_max_stale(),
+            tags=self.tags,
+            variants=self.variants,
+            pinned=self.pinned
         )
         logging.info("Response cached")
 
         return response
+
+
+def is_secure_request(request):
+    """True if the request was made over HTTPS, either as far as Django
+    knows, or according to one of CACHE_NGINX_ALTERNATIVE_SSL_HEADERS (eg
+    where SSL was terminated before the request reached us)"""
+
+    if request.is_secure():
+        logging.info("request.is_secure() == True")
+        return True
+    logging.info("request.is_secure() == False")
+
+    https_headers_to_check = getattr(
+        settings,
+        'CACHE_NGINX_ALTERNATIVE_SSL_HEADERS',
+        (
+            ('X-Forwarded-Proto', 'HTTPS'),
+            ('X-Forwarded-SSL', 'on')
+        )
+    )
+
+    # As of Django 1.4, request.is_secure() checks for things like
+    # X-Forwarded-Proto and X-Forwarded-Proto-Forwarded-SSL, but this caters for
+    # pre-1.4 projects:
+
+    for header, significant_value in https_headers_to_check:
+        # convert header to Django's request.META format
+        _header = 'HTTP_' + header.upper().replace('-', '_')
+        logging.info("Trying header: %s request val:%s significant_value: %s " % (
+            _header,
+            request.META.get(_header, "").lower(),
+            significant_value.lower())
+        )
+        if request.META.get(_header, "").lower() == significant_value.lower():
+            logging.info("Found appropriate post-HTTPS header")
+            return True
+    return False
@@ -0,0 +1,104 @@
+"""HTML minification for cached pages.
+
+minify_html() works directly on the encoded response body (bytes), so it
+never has to decode - or give up on - a page in an unexpected charset:
+
+    * runs of whitespace are collapsed to a single space, or removed entirely
+      between two tags (as Django's strip_spaces_between_tags does)
+    * comments are dropped, except IE conditional comments and nginx SSI
+      directives (<!--# ... -->), which both mean something to someone
+    * the contents of <pre>, <textarea>, <script> and <style>, and quoted
+      attribute values, are left exactly as they are
+
+The totals in minify_stats (see get_minify_stats()) show how much it's
+saving, and ./manage.py nginx_memcache_minify_benchmark shows how long
+it takes.
+
+"""
+
+import re
+import threading
+
+# Things minification mustn't touch: raw-text elements, and comments
+# (which are either kept whole or dropped whole) - plus start tags, which
+# are minified apart from their quoted attribute values
+_PROTECTED = re.compile(
+    r"""
+    <(?:
+        (?P<tag>pre|textarea|script|style)(?=[\s>/]).*?</(?P=tag)\s*>
+        | !--(?P<comment>.*?)-->
+        | (?P<start>[a-z][^\s/>]*(?:[^>"']|"[^"]*"|'[^']*')*>)
+    )
+    """,
+    re.IGNORECASE | re.DOTALL | re.VERBOSE
+)
+_BETWEEN_TAGS = re.compile(r'>\s+<')
+_WHITESPACE = re.compile(r'\s+')
+_TAG_WHITESPACE = re.compile(r'("[^"]*"|\'[^\']*\')|\s+')
+
+# Comments which have to survive minification
+_KEEP_COMMENTS = ('[if', '<![endif]', '#')
+
+_stats_lock = threading.Lock()
+minify_stats = {
+    'responses': 0,
+    'bytes_in': 0,
+    'bytes_out': 0,
+}
+
+
+def _minify_text(text):
+    """Minify a stretch of HTML that lies between two protected blocks or
+    start tags (or the start/end of the page), which always end/start with
+    a tag"""
+    text = _BETWEEN_TAGS.sub('><', text)
+    stripped = text.lstrip()
+    if not stripped or stripped[0] == '<':
+        text = stripped
+    stripped = text.rstrip()
+    if not stripped or stripped[-1] == '>':
+        text = stripped
+    return _WHITESPACE.sub(' ', text)
+
+
+def _minify_tag(tag):
+    """Collapse the whitespace in a start tag, outside its quoted
+    attribute values"""
+    return _TAG_WHITESPACE.sub(lambda match: match.group(1) or ' ', tag)
+
+
+def minify_html(content):
+    """Returns a minified copy of the HTML in content (a str of bytes)"""
+    pieces = []
+    position = 0
+    for match in _PROTECTED.finditer(content):
+        start, end = match.span()
+        pieces.append(_minify_text(content[position:start]))
+        comment = match.group('comment')
+        if match.group('start') is not None:
+            pieces.append(_minify_tag(match.group(0)))
+        elif comment is None or comment.startswith(_KEEP_COMMENTS):
+            pieces.append(match.group(0))
+        position = end
+    pieces.append(_minify_text(content[position:]))
+    minified = ''.join(pieces).strip()
+
+    with _stats_lock:
+        minify_stats['responses'] += 1
+        minify_stats['bytes_in'] += len(content)
+        minify_stats['bytes_out'] += len(minified)
+    return minified
+
+
+def get_minify_stats():
+    """Returns a copy of the running totals, plus bytes_saved"""
+    with _stats_lock:
+        stats = dict(minify_stats)
+    stats['bytes_saved'] = stats['bytes_in'] - stats['bytes_out']
+    return stats
+
+
+def reset_minify_stats():
+    with _stats_lock:
+        for key in minify_stats:
+            minify_stats[key] = 0
@@ -1,6 +1,8 @@
 from django.conf import settings
 from django.db import models
 
+from .routing import get_cache_alias
+
 
 class CachedPageRecord(models.Model):
     """When a page is cached, the user has the option (via the decorator) to
@@ -49,6 +51,38 @@ class CachedPageRecord(models.Model):
         )
     )
 
+    stored_bytes = models.PositiveIntegerField(
+        blank=True,
+        null=True,
+        help_text=(
+            "Size of the page body as last stored in memcache, in bytes. " +
+            "See nginx_memcache.usage for reports built on this."
+        )
+    )
+
+    request_host = models.CharField(
+        blank=True,
+        null=True,
+        max_length=255,
+        help_text=(
+            "The host the page was requested on, so that it can be " +
+            "re-rendered. See nginx_memcache.refresh."
+        )
+    )
+
+    request_path = models.TextField(
+        blank=True,
+        null=True,
+        help_text="The page's path, including any query string"
+    )
+
+    page_version = models.CharField(
+        blank=True,
+        null=True,
+        max_length=100,
+        help_text="The page version the page was cached for"
+    )
+
     class Meta:
         unique_together = (
             (
@@ -73,9 +107,42 @@ class CachedPageRecord(models.Model):
 
         """
 
-        CACHE_ALIAS = getattr(settings, 'CACHE_NGINX_ALIAS', 'default')
+        alias = get_cache_alias(self.parent_identifier)
         return "%s:%s:%s" % (
-            settings.CACHES[CACHE_ALIAS].get('KEY_PREFIX'),
+            settings.CACHES[alias].get('KEY_PREFIX'),
             1,  # CACHE_VERSION defaults to 1 and nginx only ever seeks that
             self.base_cache_key
         )
+
+
+class CachedPageTag(models.Model):
+    """A tag on a cached page - one row per page per tag, so that a page
+    can have any number of them. Pages are tagged via the tags argument to
+    the decorator (which needs the lookup table), and invalidated by tag
+    with cache.invalidate_tags().
+
+    """
+
+    page = models.ForeignKey(
+        CachedPageRecord,
+        related_name='tags',
+        help_text="The cached page this tag is on"
+    )
+
+    tag = models.CharField(
+        max_length=100,
+        help_text=(
+            "Any string you want to invalidate pages by - eg 'article:42' " +
+            "or 'author:7'. 100 chars max."
+        )
+    )
+
+    class Meta:
+        # NB: tag comes first, so this also serves as the index for
+        # finding the pages with a given tag
+        unique_together = (
+            ('tag', 'page'),
+        )
+
+    def __unicode__(self):
+        return "%s/%s" % (self.page_id, self.tag)
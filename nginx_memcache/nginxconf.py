@@ -0,0 +1,480 @@
+"""Writing nginx config that matches this app's settings, and checking
+that nginx and Django agree on cache keys.
+
+nginx has to build exactly the key get_cache_key() does, or it never finds
+anything - silently. server_config() writes the locations that do that
+from the live settings, and check_key_parity() runs sample requests through
+both get_cache_key() and nginx_cache_key(), a reimplementation of the nginx
+variables that config uses, and reports every request they disagree on.
+./manage.py nginx_memcache_config does both.
+
+"""
+
+import hashlib
+import posixpath
+import re
+import urllib
+
+from django.conf import settings
+
+from .pinning import get_pinned_alias
+from .routing import get_all_aliases
+
+# What nginx hashes for the key: the same as get_cache_key(), given
+# request.get_host() and request.get_full_path() - which includes the query
+# string, so $uri alone isn't enough
+KEY_TEMPLATE = '$http_host$uri$is_args$args&%s=$page_version'
+
+# ...and with settings.CACHE_NGINX_KEY_INCLUDES_SCHEME, the scheme first:
+# $cache_scheme is https if the request was made over HTTPS, whether to
+# nginx or to whatever terminated SSL in front of it (see
+# CACHE_NGINX_ALTERNATIVE_SSL_HEADERS)
+SCHEME_KEY_TEMPLATE = '$cache_scheme://' + KEY_TEMPLATE
+
+# Finds the page version cookie in the Cookie header - and not one whose
+# name merely ends with the same letters
+PAGE_VERSION_COOKIE_RE = r'(?:^|;) *%s=([^;]+)'
+
+# Requests check_key_parity() tries by default: (Host header, path,
+# Cookie header)
+SAMPLE_REQUESTS = (
+    ('example.com', '/', ''),
+    ('example.com', '/news/2013/some-story/', ''),
+    ('example.com', '/news', ''),
+    ('example.com:8000', '/about/', ''),
+    ('Example.com', '/about/', ''),
+    ('example.com', '/search/?q=nginx&page=2', ''),
+    ('example.com', '/search/?q=a+b%20c', ''),
+    ('example.com', '/caf%C3%A9/', ''),
+    ('example.com', '/a%20b/', ''),
+    ('example.com', '/', 'pv=members'),
+    ('example.com', '/', 'sessionid=abc; pv=members; csrftoken=def'),
+    ('example.com', '/', 'xpv=other; pv=members'),
+    ('example.com', '/', 'pv=members; xpv=other'),
+)
+
+
+def default_key_template(cookie_name):
+    """What nginx hashes for the key, with the current settings"""
+    if getattr(settings, 'CACHE_NGINX_KEY_INCLUDES_SCHEME', False):
+        return SCHEME_KEY_TEMPLATE % cookie_name
+    return KEY_TEMPLATE % cookie_name
+
+
+def _ssl_checks():
+    """(nginx variable, value) pairs, any of which means the request was
+    made over HTTPS, as middleware.is_secure_request() decides"""
+    ssl_headers = getattr(
+        settings,
+        'CACHE_NGINX_ALTERNATIVE_SSL_HEADERS',
+        (('X-Forwarded-Proto', 'HTTPS'), ('X-Forwarded-SSL', 'on'))
+    )
+    return [('$https', 'on')] + [
+        ('$http_%s' % header.lower().replace('-', '_'), value)
+        for header, value in ssl_headers
+    ]
+
+
+def _locations(alias):
+    location = settings.CACHES[alias].get('LOCATION', '127.0.0.1:11211')
+    if isinstance(location, basestring):
+        location = location.split(';')
+    return [server.strip() for server in location]
+
+
+def upstream_name(alias):
+    return 'nginx_memcache_%s' % alias.replace('-', '_')
+
+
+def upstream_map():
+    """Returns nginx config routing each host to its memcache pool, and
+    the key prefix used in that pool, as settings.CACHE_NGINX_ALIAS_ROUTES
+    does. Include it at the http level, then use $memcache_upstream in
+    memcached_pass and $memcache_key_prefix in place of the fixed prefix:
+
+        set $memcached_key $memcache_key_prefix:1:$hash_key;
+        memcached_pass $memcache_upstream;
+
+    Hosts routed by a CACHE_NGINX_ROUTER function have to be added by hand.
+
+    """
+    default = getattr(settings, 'CACHE_NGINX_ALIAS', 'default')
+    routes = getattr(settings, 'CACHE_NGINX_ALIAS_ROUTES', {})
+    lines = []
+
+    for alias in get_all_aliases():
+        servers = _locations(alias)
+        lines.append('upstream %s {' % upstream_name(alias))
+        if len(servers) > 1:
+            lines.append(
+                '    # NB: nginx picks a server per request, not per key, so '
+                'with several'
+            )
+            lines.append(
+                '    # servers a page may be looked for on the wrong one. '
+                'Prefer one server per alias.'
+            )
+        for server in servers:
+            if server.startswith('unix:'):
+                server = 'unix:%s' % server[5:]
+            lines.append('    server %s;' % server)
+        lines.append('}')
+        lines.append('')
+
+    for variable, value_for in (
+        ('$memcache_upstream', upstream_name),
+        (
+            '$memcache_key_prefix',
+            lambda alias: settings.CACHES[alias].get('KEY_PREFIX') or '""'
+        ),
+    ):
+        lines.append('map $host %s {' % variable)
+        lines.append('    default %s;' % value_for(default))
+        for host in sorted(routes):
+            lines.append('    %s %s;' % (host, value_for(routes[host])))
+        lines.append('}')
+        lines.append('')
+
+    return '\n'.join(lines)
+
+
+def variant_map(spec):
+    """Returns nginx config that works out the page version for a
+    variants.VariantSpec as the app does: a map block per dimension (for
+    the http level), and the set line that replaces the pv cookie lookup
+    in @memcache_check, for the locations serving those pages"""
+    lines = []
+    variables = []
+    for dimension in spec.dimensions:
+        variable = 'nm_%s_%s' % (spec.name, dimension.name)
+        variables.append(variable)
+        lines.append('map $%s $%s {' % (dimension.nginx_variable, variable))
+        for pattern, regex, value in dimension.rules:
+            lines.append('    "~*%s" %s;' % (
+                pattern.replace('"', '\\"'), value
+            ))
+        lines.append('    default %s;' % dimension.default)
+        lines.append('}')
+        lines.append('')
+    lines.append(
+        '# In the locations serving %s pages, in place of the ' % spec.name +
+        'page version cookie:'
+    )
+    lines.append('set $page_version "%s";' % '.'.join(
+        '${%s}' % variable for variable in variables
+    ))
+    return '\n'.join(lines)
+
+
+def nginx_uri(path):
+    """nginx's $uri for the request path: decoded, without the query
+    string, with repeated slashes merged and . and .. segments resolved"""
+    # Not urlsplit(), which takes a path starting // to be a host
+    uri = urllib.unquote(path.partition('?')[0])
+    uri = re.sub('/{2,}', '/', uri)
+    if '/.' in uri:
+        trailing = uri.endswith('/') or uri.endswith('/.')
+        uri = posixpath.normpath(uri)
+        if trailing and uri != '/':
+            uri += '/'
+    return uri
+
+
+def nginx_cache_key(
+        host,
+        path,
+        cookie_header='',
+        cookie_name='pv',
+        key_prefix='',
+        version=1,
+        key_template=None,
+        scheme='http'
+    ):
+    """The memcache key nginx looks a request up under, with the config
+    server_config() writes (or another key_template): the nginx variables
+    worked out as nginx does, substituted into the template and md5'd.
+    scheme is the one the request was made with, to nginx or in front of
+    it."""
+    match = re.search(PAGE_VERSION_COOKIE_RE % cookie_name, cookie_header)
+    args = path.partition('?')[2]
+    variables = {
+        'http_host': host,
+        'host': host.split(':')[0].lower(),
+        'uri': nginx_uri(path),
+        'args': args,
+        'is_args': '?' if args else '',
+        'page_version': match.group(1) if match else '',
+        'scheme': scheme,
+        'cache_scheme': scheme,
+    }
+    template = key_template or default_key_template(cookie_name)
+    raw_key = re.sub(
+        r'\$(\w+)',
+        lambda variable: variables[variable.group(1)],
+        template
+    )
+    return '%s:%s:%s' % (
+        key_prefix, version, hashlib.md5(raw_key).hexdigest()
+    )
+
+
+def django_cache_key(
+        host,
+        path,
+        cookie_header='',
+        alias=None,
+        scheme='http'
+    ):
+    """The memcache key Django caches the page for a request under, if its
+    page version is the one in the cookie"""
+    # Avoid a circular import: cache.py uses routing.py, as we do
+    from django.test.client import RequestFactory
+    from .cache import get_nginx_cache, get_request_cache_key
+    from .routing import get_cache_alias
+
+    cookie_name = getattr(settings, 'CACHE_NGINX_COOKIE', 'pv')
+    request = RequestFactory().get(
+        path,
+        HTTP_HOST=host,
+        HTTP_COOKIE=cookie_header,
+        **{'wsgi.url_scheme': scheme}
+    )
+    cache_key = get_request_cache_key(
+        request,
+        page_version_fn=lambda request: request.COOKIES.get(cookie_name, ''),
+        cookie_name=cookie_name
+    )
+    alias = alias or get_cache_alias(request.get_host())
+    return get_nginx_cache(alias).make_key(cache_key)
+
+
+def _alias_conf(alias):
+    return settings.CACHES[alias]
+
+
+def expand_samples(samples):
+    """The samples - each (host, path, cookie header), optionally with the
+    scheme after - with any that don't give a scheme tried over both HTTP
+    and HTTPS, if the scheme is part of the key"""
+    # Avoid a circular import: cache.py uses routing.py, as we do
+    from .cache import key_schemes
+
+    expanded = []
+    for sample in samples:
+        schemes = key_schemes()
+        if len(sample) == 4 or len(schemes) == 1:
+            expanded.append(tuple(sample))
+        else:
+            expanded.extend(tuple(sample) + (scheme,) for scheme in schemes)
+    return expanded
+
+
+def check_key_parity(samples=SAMPLE_REQUESTS, key_template=None):
+    """Runs each (host, path, cookie header[, scheme]) through both
+    Django's and nginx's key pipelines. Returns a list of (sample,
+    django_key, nginx_key) for every sample they disagree on - see
+    expand_samples() - with an error message in place of a key that
+    couldn't be made at all. Samples without a scheme are made over HTTP.
+
+    Paths nginx normalises - repeated slashes, . and .. segments - never
+    match, whatever the config: Django caches them under the path as
+    given, and nginx looks them up under its $uri. Their nginx_key says so.
+
+    key_template checks a hand-written config's set_md5 line, rather than
+    the one server_config() writes."""
+    from .routing import get_cache_alias
+
+    cookie_name = getattr(settings, 'CACHE_NGINX_COOKIE', 'pv')
+    mismatches = []
+    for sample in expand_samples(samples):
+        host, path, cookie_header, scheme = (sample + ('http',))[:4]
+        alias = get_cache_alias(host)
+        try:
+            django_key = django_cache_key(
+                host, path, cookie_header, alias, scheme
+            )
+        except Exception, e:
+            django_key = 'error: %s' % e
+        conf = _alias_conf(alias)
+        nginx_key = nginx_cache_key(
+            host,
+            path,
+            cookie_header,
+            cookie_name,
+            key_prefix=conf.get('KEY_PREFIX', ''),
+            version=conf.get('VERSION', 1),
+            key_template=key_template,
+            scheme=scheme
+        )
+        if django_key != nginx_key:
+            uri = nginx_uri(path)
+            if uri != urllib.unquote(path.partition('?')[0]):
+                nginx_key += (
+                    " (nginx normalises the path to %s, so this page is "
+                    "never served from the cache)" % uri
+                )
+            mismatches.append((sample, django_key, nginx_key))
+    return mismatches
+
+
+def _nginx_server(server):
+    if server.startswith('unix:'):
+        return 'unix:%s' % server[5:]
+    return server
+
+
+def _memcache_location(
+        name,
+        cookie_name,
+        key_prefix,
+        version,
+        memcache,
+        fallback
+    ):
+    """The lines of a named location looking the page up in one memcache
+    pool, and passing misses on to fallback"""
+    lines = ['location @%s {' % name]
+    if getattr(settings, 'CACHE_NGINX_KEY_INCLUDES_SCHEME', False):
+        lines.append('    set $cache_scheme $scheme;')
+        for variable, value in _ssl_checks():
+            lines.extend([
+                '    if (%s ~* ^%s$) {' % (variable, re.escape(value)),
+                '        set $cache_scheme https;',
+                '    }',
+            ])
+    lines += [
+        '    set $page_version "";',
+        '    if ($http_cookie ~ "%s") {' % (
+            PAGE_VERSION_COOKIE_RE % cookie_name
+        ),
+        '        set $page_version $1;',
+        '    }',
+        '    set_md5 $hash_key "%s";' % default_key_template(cookie_name),
+        '    set $memcached_key "%s:%s:$hash_key";' % (key_prefix, version),
+        '    default_type %s;' % getattr(
+            settings,
+            'CACHE_NGINX_READ_THROUGH_CONTENT_TYPE',
+            'text/html; charset=utf-8'
+        ).split(';')[0],
+        '    memcached_pass %s;' % memcache,
+    ]
+    if fallback != '@django':
+        # So that a miss here can be passed on again
+        lines.append('    recursive_error_pages on;')
+    lines.extend([
+        '    error_page 404 502 504 = %s;' % fallback,
+        '}',
+        '',
+    ])
+    return lines
+
+
+def multi_server_aliases(routed=True):
+    """The cache aliases nginx is configured to use whose LOCATION has more
+    than one server. Django spreads keys across them, but nginx only ever
+    looks on one, so most pages in such an alias are never found. Those
+    routed to by upstream_map(), which warns about them itself, are left
+    out unless routed is True."""
+    default = getattr(settings, 'CACHE_NGINX_ALIAS', 'default')
+    if getattr(settings, 'CACHE_NGINX_ALIAS_ROUTES', {}):
+        aliases = list(get_all_aliases()) if routed else []
+    else:
+        aliases = [default]
+    pinned_alias = get_pinned_alias()
+    if pinned_alias and pinned_alias not in aliases:
+        aliases.append(pinned_alias)
+    return [alias for alias in aliases if len(_locations(alias)) > 1]
+
+
+def server_config(django_upstream='127.0.0.1:8000'):
+    """Returns the locations for a server block that serve pages from
+    memcache exactly as this app caches them, falling back to Django at
+    django_upstream. With a pinned pool (see pinning.py), pages are looked
+    for there first, then in their own pool.
+
+    Every alias used should have a single memcache server: with more, the
+    config carries a warning (see multi_server_aliases()) - here, or in
+    upstream_map() for routed aliases."""
+    cookie_name = getattr(settings, 'CACHE_NGINX_COOKIE', 'pv')
+    default = getattr(settings, 'CACHE_NGINX_ALIAS', 'default')
+    routed = bool(getattr(settings, 'CACHE_NGINX_ALIAS_ROUTES', {}))
+    conf = _alias_conf(default)
+    if routed:
+        # See upstream_map(), which must be included at the http level
+        key_prefix = '$memcache_key_prefix'
+        memcache = '$memcache_upstream'
+    else:
+        key_prefix = conf.get('KEY_PREFIX', '')
+        memcache = _nginx_server(_locations(default)[0])
+
+    memcache_locations = _memcache_location(
+        'memcache_check', cookie_name, key_prefix, conf.get('VERSION', 1),
+        memcache, '@django'
+    )
+    pinned_alias = get_pinned_alias()
+    if pinned_alias:
+        # Pinned pages first, then the general pool. See pinning.py
+        pinned_conf = _alias_conf(pinned_alias)
+        memcache_locations = _memcache_location(
+            'memcache_check',
+            cookie_name,
+            pinned_conf.get('KEY_PREFIX', ''),
+            pinned_conf.get('VERSION', 1),
+            _nginx_server(_locations(pinned_alias)[0]),
+            '@memcache_general'
+        ) + _memcache_location(
+            'memcache_general', cookie_name, key_prefix,
+            conf.get('VERSION', 1), memcache, '@django'
+        )
+
+    lines = [
+        '# Generated by ./manage.py nginx_memcache_config - regenerate it, '
+        'rather than',
+        '# editing it, when the cache settings change.',
+        '',
+        'location @django {',
+        '    proxy_set_header Host $http_host;',
+        '    proxy_set_header X-Forwarded-For $proxy_add_x_forwarded_for;',
+        '    proxy_redirect off;',
+        '    proxy_pass http://%s;' % django_upstream,
+        '}',
+        '',
+    ] + memcache_locations + [
+        'location / {',
+        '    # So that a memcache miss can be passed on again',
+        '    recursive_error_pages on;',
+        '    error_page 418 = @memcache_check;',
+        '    error_page 419 = @django;',
+        '    if ($request_method !~ ^(GET|HEAD)$) {',
+        '        return 419;',
+        '    }',
+    ]
+    if not getattr(settings, 'CACHE_NGINX_INCLUDE_HTTPS', True):
+        # The cache only has the HTTP versions of pages
+        for variable, value in _ssl_checks():
+            lines.extend([
+                '    if (%s ~* ^%s$) {' % (variable, re.escape(value)),
+                '        return 419;',
+                '    }',
+            ])
+    lines.extend([
+        '    return 418;',
+        '}',
+    ])
+    if routed:
+        lines[3:3] = [
+            '# Include the output of nginx_memcache.nginxconf.upstream_map()',
+            '# at the http level, for $memcache_upstream and '
+            '$memcache_key_prefix.',
+            '',
+        ]
+    multi_server = multi_server_aliases(routed=False)
+    if multi_server:
+        lines[3:3] = [
+            '# WARNING: more than one memcache server in cache alias(es) '
+            '%s, but nginx' % ', '.join(multi_server),
+            "# only looks on one: most pages cached there won't be found. "
+            "Use one server per alias.",
+            '',
+        ]
+    return '\n'.join(lines)
@@ -0,0 +1,74 @@
+"""Pinning high-value pages into a memcache pool of their own.
+
+Homepages and section fronts share memcache's LRU with every long-tail
+page, and under a spike of requests for pages nobody has seen in a while
+they can be evicted - just when they're needed most. With
+settings.CACHE_NGINX_PINNED_ALIAS set to an alias in settings.CACHES (a
+small pool, sized to hold every pinned page), pinned pages are cached there
+instead, where only other pinned pages compete for the space.
+
+A page is pinned if its view is decorated with pinned=True, or if, unless
+the decorator says pinned=False, its path (with the query string) matches
+one of settings.CACHE_NGINX_PINNED_URLS, a list of regexes - eg
+[r'^/$', r'^/news/$']. Pinned pages:
+
+    * are cached for settings.CACHE_NGINX_PINNED_TIME seconds, if set,
+      rather than the view's cache_timeout - and never adaptively (see
+      ttl.py)
+    * skip the admission filter (see admission.py): they're known to be
+      popular
+
+Whether a page was pinned by its decorator isn't known when it's
+invalidated, so every invalidation also deletes the page from the pinned
+pool - an extra delete per alias, not per page. Reads look in the pinned
+pool first, then the page's own, as nginx does with the config
+nginxconf.server_config() writes.
+
+"""
+
+import re
+
+from django.conf import settings
+
+from .routing import get_cache_alias
+
+_compiled = (None, [])
+
+
+def get_pinned_alias():
+    """The alias pinned pages are cached in, or None if pinning is off"""
+    return getattr(settings, 'CACHE_NGINX_PINNED_ALIAS', None)
+
+
+def _url_rules():
+    global _compiled
+    rules = tuple(getattr(settings, 'CACHE_NGINX_PINNED_URLS', ()))
+    if _compiled[0] != rules:
+        _compiled = (rules, [re.compile(rule) for rule in rules])
+    return _compiled[1]
+
+
+def is_pinned(request_path, pinned=None):
+    """Whether the page at request_path (with its query string) is cached
+    in the pinned pool: as pinned says, if it isn't None, otherwise as
+    settings.CACHE_NGINX_PINNED_URLS does. Never, if pinning is off."""
+    if not get_pinned_alias():
+        return False
+    if pinned is not None:
+        return pinned
+    return any(rule.search(request_path) for rule in _url_rules())
+
+
+def pinned_timeout(cache_timeout):
+    """How long a pinned page is cached for"""
+    return getattr(settings, 'CACHE_NGINX_PINNED_TIME', None) or cache_timeout
+
+
+def get_page_aliases(identifier=None):
+    """Every alias a page belonging to identifier may be cached in: the
+    pinned pool first, if there is one, then the page's own"""
+    alias = get_cache_alias(identifier)
+    pinned_alias = get_pinned_alias()
+    if pinned_alias and pinned_alias != alias:
+        return [pinned_alias, alias]
+    return [alias]
@@ -0,0 +1,146 @@
+"""Reconciling the lookup table with what's actually in memcache.
+
+CachedPageRecords are never removed when their pages expire or are evicted,
+so over time most of the lookup table can describe pages that are long gone
+- and bulk_invalidate() spends most of its time deleting them again.
+
+reconcile_lookup_table() walks the table in chunks of
+settings.CACHE_NGINX_BULK_CHUNK_SIZE, asks memcache which of each chunk's
+pages (or their stale copies; see stale.py) still exist, and deletes the
+records - and tags - of those that don't. memcache is asked with the meta
+command mg where the server supports it (memcached 1.6+), which doesn't
+fetch the pages themselves; otherwise with a get_many. A pause between
+chunks keeps the load on memcache and the database down.
+
+Django's memcached backends answer a get_many with {} when memcache is
+down, which would make every page look dead. So when none of a chunk's pages
+are found that way, a sentinel key is written and read back first: if it
+can't be, memcache isn't answering, and the chunk is skipped rather than
+deleted.
+
+NB: a page cached between it being found missing and its record being
+deleted loses its record until it is next cached, so it won't be reached
+by bulk_invalidate() in the meantime. Records are re-checked just before
+they're deleted, to keep that window small.
+
+./manage.py nginx_memcache_reconcile runs this.
+
+"""
+
+import logging
+import time
+
+from django.conf import settings
+
+from .cache import get_nginx_cache, iter_key_chunks
+from .client import MemcacheError, UnsupportedCommand
+from .models import CachedPageRecord
+from .pinning import get_page_aliases
+from .stale import get_stale_key
+
+SENTINEL_KEY = 'nmreconcile:sentinel'
+
+
+def _answering(client):
+    """Whether memcache can be seen to store a key and give it back"""
+    client.set(SENTINEL_KEY, 1, 60)
+    return client.get(SENTINEL_KEY) == 1
+
+
+def live_keys(client, cache_keys):
+    """Returns the set of the given (base) cache keys whose page, or stale
+    copy of the page, is in memcache. Raises MemcacheError if memcache
+    can't be seen to answer."""
+    probe = dict((cache_key, cache_key) for cache_key in cache_keys)
+    probe.update(
+        (get_stale_key(cache_key), cache_key) for cache_key in cache_keys
+    )
+    exists_many = getattr(client, 'exists_many', None)
+    found = None
+    if exists_many is not None:
+        try:
+            found = exists_many(probe.keys())
+        except UnsupportedCommand:
+            pass
+    if found is None:
+        found = client.get_many(probe.keys())
+        if not found and cache_keys and not _answering(client):
+            raise MemcacheError(
+                "memcache isn't answering, so it can't say which pages exist"
+            )
+    return set(probe[key] for key in found)
+
+
+def dead_keys(clients, cache_keys):
+    """Returns the set of the given (base) cache keys that live_keys()
+    finds with none of the clients"""
+    dead = set(cache_keys)
+    for client in clients:
+        if dead:
+            dead -= live_keys(client, list(dead))
+    return dead
+
+
+def reconcile_lookup_table(
+        lookup_identifier=None,
+        chunk_size=None,
+        pause=0,
+        dry_run=False
+    ):
+    """Deletes the records of pages that are no longer in memcache (only
+    for lookup_identifier, if given), pausing for pause seconds between
+    chunks. With dry_run, just counts them. Returns a dict of how many
+    records were checked, found dead and removed - and skipped, because
+    memcache couldn't be asked about them."""
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+    records = CachedPageRecord.objects.all()
+    if lookup_identifier is not None:
+        records = records.filter(parent_identifier=lookup_identifier)
+        identifiers = [lookup_identifier]
+    else:
+        identifiers = records.values_list(
+            'parent_identifier', flat=True
+        ).distinct()
+
+    totals = {'checked': 0, 'dead': 0, 'removed': 0, 'skipped': 0}
+    first = True
+    for identifier in identifiers:
+        # Each identifier's pages may be in a different cache alias
+        # Pinned pages (see pinning.py) are in the pinned pool
+        clients = [
+            get_nginx_cache(alias) for alias in get_page_aliases(identifier)
+        ]
+        for keys in iter_key_chunks(
+            records.filter(parent_identifier=identifier),
+            chunk_size
+        ):
+            if pause and not first:
+                time.sleep(pause)
+            first = False
+
+            try:
+                dead = dead_keys(clients, keys)
+                if dead and not dry_run:
+                    # Check again, in case any were cached in the meantime
+                    recheck = dead_keys(clients, dead)
+            except MemcacheError:
+                logging.exception(
+                    "Couldn't reconcile %d lookup records for %s" % (
+                        len(keys), identifier
+                    )
+                )
+                totals['skipped'] += len(keys)
+                continue
+            totals['checked'] += len(keys)
+            totals['dead'] += len(dead)
+            if dead and not dry_run:
+                dead = recheck
+                CachedPageRecord.objects.filter(
+                    base_cache_key__in=dead
+                ).delete()
+                totals['removed'] += len(dead)
+            logging.info("Reconciled %d lookup records for %s: %d dead" % (
+                len(keys), identifier, len(dead))
+            )
+    return totals
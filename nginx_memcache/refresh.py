@@ -0,0 +1,241 @@
+"""Refreshing cached pages on invalidation, rather than deleting them.
+
+Deleting a page's key means the next request for it - and, until it has
+been re-rendered, every other one - misses and waits for Django. With
+settings.CACHE_NGINX_REFRESH on (or refresh=True passed to invalidate(),
+bulk_invalidate() or invalidate_tags()), the page is re-rendered in this
+process instead, and the new copy overwrites the old one with a single
+set, so nginx serves the old page right up until it serves the new one.
+
+To do that, the page's URL has to be known: invalidate() is given it, and
+the lookup table records it (request_host, request_path and page_version)
+for each page it caches. Pages are rendered by calling their view with an
+anonymous GET request carrying just the page version cookie, so none of
+the request middleware runs; a page is deleted, as before, if:
+
+    * its view can't be found, raises an exception or doesn't return a 200
+    * rendering it doesn't cache it under the same key - eg its page
+      version depends on more than the cookie (see variants.py)
+    * it was recorded before the lookup table kept URLs
+
+Bulk refreshes are spread over settings.CACHE_NGINX_REFRESH_WORKERS
+threads (default 4), each of which closes its database connection after
+every page.
+
+"""
+
+import logging
+from multiprocessing.pool import ThreadPool
+
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.core.urlresolvers import resolve
+from django.db import connection
+from django.http import Http404
+from django.test.client import RequestFactory
+
+from .cache import (
+    CACHE_NGINX_DEFAULT_COOKIE,
+    _dispatch,
+    get_cache_key,
+    get_nginx_cache,
+    invalidate_keys,
+    iter_key_chunks,
+    key_schemes
+)
+from .churn import (
+    counter_keys,
+    record_invalidation as record_churn_invalidation
+)
+from .pinning import get_page_aliases
+from .routing import get_cache_alias
+from .stale import get_stale_key
+from .ttl import record_invalidation, ttl_scope
+
+
+def refresh_request(
+        request_host,
+        request_path,
+        page_version='',
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE,
+        scheme='http'
+    ):
+    """An anonymous GET request for the page, as nginx would pass it on"""
+    headers = {'HTTP_HOST': request_host, 'wsgi.url_scheme': scheme}
+    if page_version:
+        # As a header, as nginx would pass it on: bytes, not unicode
+        headers['HTTP_COOKIE'] = (
+            u'%s=%s' % (cookie_name, page_version)
+        ).encode('utf-8')
+    request = RequestFactory().get(request_path, **headers)
+    request.user = AnonymousUser()
+    # Tells the middleware to render the page, rather than serve the copy
+    # it's replacing, and cache it whatever the admission filter says
+    request.nginx_memcache_refresh = True
+    return request
+
+
+def render_page(request):
+    """Renders the page for request through its (cache_page_nginx
+    decorated) view, which caches it. Returns the key it was cached
+    under, or None if it wasn't."""
+    view_func, view_args, view_kwargs = resolve(request.path_info)
+    response = view_func(request, *view_args, **view_kwargs)
+    if not getattr(response, 'is_rendered', True):
+        response.render()
+    if response.status_code != 200:
+        return None
+    # Streamed pages are only cached once the stream has been read
+    for chunk in response:
+        pass
+    return getattr(request, 'nginx_memcache_cached_key', None)
+
+
+def refresh_page(
+        request_host,
+        request_path,
+        page_version='',
+        cookie_name=CACHE_NGINX_DEFAULT_COOKIE,
+        lookup_identifier=None,
+        include_stale=False,
+        scheme=None
+    ):
+    """Re-render the page and overwrite its cached copy, or - if it can't
+    be - delete it, as invalidate() would. Returns True if the page was
+    refreshed.
+
+    With settings.CACHE_NGINX_KEY_INCLUDES_SCHEME, both the HTTP and HTTPS
+    copies are refreshed, unless scheme says which."""
+    schemes = key_schemes(scheme)
+    if len(schemes) > 1:
+        return all([
+            refresh_page(
+                request_host,
+                request_path,
+                page_version,
+                cookie_name,
+                lookup_identifier,
+                include_stale,
+                key_scheme
+            )
+            for key_scheme in schemes
+        ])
+    scheme = schemes[0]
+    cache_key = get_cache_key(
+        request_host=request_host,
+        request_path=request_path,
+        page_version=page_version or '',
+        cookie_name=cookie_name,
+        scheme=scheme
+    )
+    lookup_identifier = lookup_identifier or request_host
+    record_invalidation([ttl_scope(cache_key, lookup_identifier)])
+    # The page will be re-cached, as it would be after a delete
+    record_churn_invalidation([cache_key])
+    client = get_nginx_cache(get_cache_alias(lookup_identifier))
+    churn_counters = counter_keys([cache_key])
+    if churn_counters:
+        _dispatch(client, 'delete_many', churn_counters)
+    try:
+        cached_key = render_page(refresh_request(
+            request_host, request_path, page_version, cookie_name, scheme
+        ))
+    except Http404:
+        # Including there being no view for it at all
+        logging.info("%s%s has gone" % (request_host, request_path))
+        cached_key = None
+    except Exception:
+        logging.exception("Couldn't refresh %s%s" % (
+            request_host, request_path)
+        )
+        cached_key = None
+
+    if cached_key == cache_key:
+        logging.info("Refreshed key '%s'" % cache_key)
+        return True
+    logging.info("Couldn't refresh key '%s'; invalidating it" % cache_key)
+    cache_keys = [cache_key]
+    if include_stale:
+        cache_keys.append(get_stale_key(cache_key))
+    # Including the pinned pool, if any. See pinning.py
+    for alias in get_page_aliases(lookup_identifier):
+        _dispatch(get_nginx_cache(alias), 'delete_many', cache_keys)
+    return False
+
+
+def _refresh_in_worker(args):
+    try:
+        return refresh_page(*args)
+    finally:
+        connection.close()
+
+
+def refresh_pages(pages):
+    """Refreshes each page - given as a tuple of refresh_page() arguments -
+    over settings.CACHE_NGINX_REFRESH_WORKERS threads, deleting any that
+    can't be. Returns (refreshed, deleted) counts."""
+    pages = list(pages)
+    workers = min(
+        getattr(settings, 'CACHE_NGINX_REFRESH_WORKERS', 4), len(pages)
+    )
+    if workers > 1:
+        pool = ThreadPool(workers)
+        try:
+            results = pool.map(_refresh_in_worker, pages)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        results = [refresh_page(*page) for page in pages]
+    return results.count(True), results.count(False)
+
+
+def _record_scheme(cache_key, host, path, page_version, cookie_name):
+    for scheme in key_schemes():
+        if cache_key == get_cache_key(
+                host, path, page_version or '', cookie_name, scheme):
+            return scheme
+    # Cached with another cookie name: refresh_page() will delete it
+    return 'http'
+
+
+def refresh_records(records, lookup_identifier, include_stale=False):
+    """Refreshes the pages for the given CachedPageRecord queryset, all
+    belonging to lookup_identifier, deleting any that can't be. Returns
+    (refreshed, deleted) counts."""
+    cookie_name = getattr(settings, 'CACHE_NGINX_COOKIE', 'pv')
+    chunk_size = getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+    refreshed = deleted = 0
+    for keys in iter_key_chunks(records, chunk_size):
+        pages = []
+        unknown = set(keys)
+        for cache_key, host, path, page_version in records.filter(
+            base_cache_key__in=keys,
+            request_path__isnull=False
+        ).values_list(
+            'base_cache_key', 'request_host', 'request_path', 'page_version'
+        ):
+            unknown.discard(cache_key)
+            pages.append((
+                host,
+                path,
+                page_version,
+                cookie_name,
+                lookup_identifier,
+                include_stale,
+                # The record is for the HTTP or the HTTPS copy
+                _record_scheme(
+                    cache_key, host, path, page_version, cookie_name
+                )
+            ))
+        if unknown:
+            # Cached before the lookup table kept URLs
+            invalidate_keys(list(unknown), lookup_identifier, include_stale)
+            deleted += len(unknown)
+        chunk_refreshed, chunk_deleted = refresh_pages(pages)
+        refreshed += chunk_refreshed
+        deleted += chunk_deleted
+    logging.info("Refreshed %d pages for %s; invalidated %d" % (
+        refreshed, lookup_identifier, deleted)
+    )
+    return refreshed, deleted
@@ -0,0 +1,64 @@
+"""Routing cached pages to cache aliases, so that big or noisy sites can
+have memcache pools of their own.
+
+Every page belongs to an identifier: its lookup_identifier, or - unless one
+was given to the decorator - the host it was served from. The identifier is
+mapped to an alias in settings.CACHES by, in order:
+
+    1. settings.CACHE_NGINX_ROUTER, the dotted path of a function taking the
+       identifier and returning an alias (or None, to carry on)
+    2. settings.CACHE_NGINX_ALIAS_ROUTES, a dict of identifier (or hostname,
+       without a port) to alias
+    3. settings.CACHE_NGINX_ALIAS, as before
+
+cache_response, invalidate, bulk_invalidate and
+CachedPageRecord.memcached_key all route this way, so a page is always
+looked for where it was put.
+
+nginx only knows the host it's serving, so for nginx to find pages in the
+right pool, hosts must be routed to the same alias as their pages'
+identifiers. nginxconf.upstream_map() writes the matching nginx config.
+
+"""
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+
+def _get_router():
+    path = getattr(settings, 'CACHE_NGINX_ROUTER', None)
+    if not path:
+        return None
+    module, _, name = path.rpartition('.')
+    return getattr(import_module(module), name)
+
+
+def get_cache_alias(identifier=None):
+    """Returns the alias, in settings.CACHES, that pages for the given
+    identifier (by default, the hostname) are cached in"""
+    default = getattr(settings, 'CACHE_NGINX_ALIAS', 'default')
+    if identifier is None:
+        return default
+
+    router = _get_router()
+    if router is not None:
+        alias = router(identifier)
+        if alias:
+            return alias
+
+    routes = getattr(settings, 'CACHE_NGINX_ALIAS_ROUTES', {})
+    if identifier in routes:
+        return routes[identifier]
+    # Hosts may come with a port, which nginx's $host doesn't have
+    hostname = identifier.split(':')[0].lower()
+    return routes.get(hostname, default)
+
+
+def get_all_aliases():
+    """Every alias pages might be cached in, default first"""
+    aliases = [getattr(settings, 'CACHE_NGINX_ALIAS', 'default')]
+    routes = getattr(settings, 'CACHE_NGINX_ALIAS_ROUTES', {})
+    for alias in sorted(set(routes.values())):
+        if alias not in aliases:
+            aliases.append(alias)
+    return aliases
@@ -5,7 +5,12 @@ invalidation functions
 
 from django.dispatch import Signal, receiver
 
-from .cache import invalidate, bulk_invalidate
+from .cache import (
+    invalidate,
+    bulk_invalidate,
+    invalidate_many,
+    invalidate_tags
+)
 
 # Signals
 invalidate_single_page = Signal(
@@ -13,7 +18,18 @@ invalidate_single_page = Signal(
         "request_host",
         "request_path",
         "page_version",
-        "cookie_name"
+        "cookie_name",
+        "include_stale",
+        "refresh",
+    ]
+)
+
+# Several pages at once: see cache.invalidate_many
+invalidate_pages = Signal(
+    providing_args=[
+        "pages",
+        "include_stale",
+        "refresh",
     ]
 )
 
@@ -21,6 +37,19 @@ invalidate_many_pages = Signal(
     providing_args=[
         "lookup_identifier",
         "supplementary_identifier",
+        "include_stale",
+        "refresh",
+        "rate",
+        "order",
+    ]
+)
+
+invalidate_tagged_pages = Signal(
+    providing_args=[
+        "tags",
+        "match",
+        "include_stale",
+        "refresh",
     ]
 )
 
@@ -32,6 +61,16 @@ def handle_single_page_invalidation(sender, signal, **provided_args):
     invalidate(**provided_args)  # Hand it on with just the core things in there
 
 
+@receiver(invalidate_pages)
+def handle_page_list_invalidation(sender, signal, **provided_args):
+    invalidate_many(**provided_args)
+
+
 @receiver(invalidate_many_pages)
 def handle_multiple_page_invalidation(sender, signal, **provided_args):
     bulk_invalidate(**provided_args)
+
+
+@receiver(invalidate_tagged_pages)
+def handle_tagged_page_invalidation(sender, signal, **provided_args):
+    invalidate_tags(**provided_args)
@@ -0,0 +1,237 @@
+"""Staggered bulk invalidation.
+
+bulk_invalidate() deletes every page for an identifier at once, so every
+one of them misses at once, and Django gets the whole site's traffic in one
+go. With a rate (keys per second; the rate argument to bulk_invalidate(),
+or settings.CACHE_NGINX_INVALIDATION_RATE), pages are deleted in waves
+instead - one every settings.CACHE_NGINX_INVALIDATION_WAVE_INTERVAL
+seconds (default 1), or less often if the rate is under a key a wave - by a
+background thread, so the load on Django ramps up rather than arriving all
+at once. The thread reads the lookup table a wave at a time, as it goes.
+
+With order='popular', the most requested pages go first (so the pages most
+people see are fresh soonest), by the admission filter's counts - see
+admission.py, which only counts while an admission threshold is set.
+
+Each run is an InvalidationJob, which reports its progress and can be
+cancelled; get_job() and get_jobs() find the ones in this process, and
+./manage.py nginx_memcache_invalidate runs one from the command line.
+
+NB: a job lives only in the process that started it. If that process exits
+- or is restarted - the waves still to go are lost, and those pages stay
+cached until they expire or are invalidated again.
+
+"""
+
+import logging
+import threading
+import time
+import uuid
+from collections import OrderedDict
+
+from django.conf import settings
+from django.db import connection
+from django.db.models.query import QuerySet
+
+from .admission import popularity
+
+# How many finished jobs to remember, for get_jobs()
+MAX_FINISHED_JOBS = 100
+
+
+class InvalidationJob(object):
+    """Deletes cache_keys - all belonging to lookup_identifier - rate per
+    second, in waves, on a daemon thread. cache_keys is a list of (base)
+    cache keys, or a CachedPageRecord queryset, which is read a wave at a
+    time - or, in order of popularity (see order_keys()), all at once when
+    the job starts."""
+
+    def __init__(
+            self,
+            cache_keys,
+            lookup_identifier,
+            rate,
+            include_stale=False,
+            wave_interval=None,
+            order=None
+        ):
+        if rate <= 0:
+            raise ValueError("rate must be more than 0, not %r" % rate)
+        self.id = uuid.uuid4().hex
+        if isinstance(cache_keys, QuerySet):
+            self.records = cache_keys
+            self.total = cache_keys.count()
+        else:
+            self.records = None
+            cache_keys = list(cache_keys)
+            self.total = len(cache_keys)
+        self._cache_keys = cache_keys
+        self.order = order
+        self.lookup_identifier = lookup_identifier
+        self.rate = rate
+        self.include_stale = include_stale
+        if wave_interval is None:
+            wave_interval = getattr(
+                settings, 'CACHE_NGINX_INVALIDATION_WAVE_INTERVAL', 1.0
+            )
+        # At least a key a wave, without going over the rate
+        self.wave_interval = max(wave_interval, 1.0 / rate)
+        self.wave_size = max(1, int(rate * self.wave_interval))
+        self.invalidated = 0
+        self.waves = 0
+        self.state = 'pending'
+        self.started = None
+        self.finished = None
+        self._cancelled = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self.started = time.time()
+        self.state = 'running'
+        self._thread = threading.Thread(
+            target=self.run,
+            name='nginx-memcache-invalidate'
+        )
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def _waves(self):
+        # Avoid a circular import: cache.py uses this module
+        from .cache import iter_key_chunks
+        cache_keys = self._cache_keys
+        if self.records is not None:
+            if self.order is None:
+                for wave in iter_key_chunks(self.records, self.wave_size):
+                    yield wave
+                return
+            # Every key is needed to sort them
+            cache_keys = [
+                cache_key
+                for chunk in iter_key_chunks(
+                    self.records,
+                    getattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE', 1000)
+                )
+                for cache_key in chunk
+            ]
+        cache_keys = order_keys(cache_keys, self.order)
+        for start in range(0, len(cache_keys), self.wave_size):
+            yield cache_keys[start:start + self.wave_size]
+
+    def run(self):
+        # Avoid a circular import: cache.py uses this module
+        from .cache import invalidate_keys
+        try:
+            for wave in self._waves():
+                if self.waves:
+                    # Waits for the next wave, unless cancelled first
+                    self._cancelled.wait(self.wave_interval)
+                if self._cancelled.is_set():
+                    self.state = 'cancelled'
+                    break
+                invalidate_keys(wave, self.lookup_identifier, self.include_stale)
+                self.invalidated += len(wave)
+                self.waves += 1
+                logging.info("Invalidated %d of %d pages for %s" % (
+                    self.invalidated, self.total, self.lookup_identifier)
+                )
+            else:
+                self.state = 'finished'
+        except Exception:
+            logging.exception(
+                "Staggered invalidation of %s failed" % self.lookup_identifier
+            )
+            self.state = 'failed'
+        finally:
+            self.finished = time.time()
+            # Don't leave this thread's database connection open
+            connection.close()
+
+    def cancel(self):
+        """Stop before the next wave. Pages already invalidated stay so"""
+        self._cancelled.set()
+
+    def join(self, timeout=None):
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def progress(self):
+        """A dict of how far the job has got"""
+        total = self.total
+        eta = None
+        if self.state == 'running':
+            # Seconds, roughly: a wave interval per wave still to do
+            remaining = total - self.invalidated
+            eta = -(-remaining // self.wave_size) * self.wave_interval
+        return {
+            'id': self.id,
+            'lookup_identifier': self.lookup_identifier,
+            'state': self.state,
+            'total': total,
+            'invalidated': self.invalidated,
+            'waves': self.waves,
+            'rate': self.rate,
+            'started': self.started,
+            'finished': self.finished,
+            'eta': eta,
+        }
+
+
+_jobs = OrderedDict()
+_jobs_lock = threading.Lock()
+
+
+def _register(job):
+    with _jobs_lock:
+        finished = [
+            job_id for job_id, old_job in _jobs.items()
+            if old_job.state not in ('pending', 'running')
+        ]
+        for job_id in finished[:max(0, len(finished) - MAX_FINISHED_JOBS)]:
+            del _jobs[job_id]
+        _jobs[job.id] = job
+
+
+def get_job(job_id):
+    """The InvalidationJob with this id, or None"""
+    with _jobs_lock:
+        return _jobs.get(job_id)
+
+
+def get_jobs():
+    """Every InvalidationJob running in this process, and the most recently
+    finished ones, oldest first"""
+    with _jobs_lock:
+        return _jobs.values()
+
+
+def order_keys(cache_keys, order=None):
+    """cache_keys in the order they should be invalidated: as they are, or
+    most requested first if order is 'popular'"""
+    cache_keys = list(cache_keys)
+    if order is None:
+        return cache_keys
+    if order != 'popular':
+        raise ValueError("order must be None or 'popular', not %r" % order)
+    counts = popularity(cache_keys)
+    # sorted() is stable, so equally popular pages keep their order
+    return sorted(cache_keys, key=lambda key: -counts[key])
+
+
+def staggered_invalidate(
+        records,
+        lookup_identifier,
+        rate,
+        order=None,
+        include_stale=False
+    ):
+    """Starts an InvalidationJob for the pages in the given CachedPageRecord
+    queryset, all belonging to lookup_identifier, and returns it. Only the
+    pages are counted now; their keys are read by the job's thread."""
+    if order not in (None, 'popular'):
+        raise ValueError("order must be None or 'popular', not %r" % order)
+    job = InvalidationJob(
+        records, lookup_identifier, rate, include_stale, order=order
+    )
+    _register(job)
+    return job.start()
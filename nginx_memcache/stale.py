@@ -0,0 +1,68 @@
+"""Stale-while-revalidate for cached pages.
+
+Invalidating a popular page means everyone who asks for it before it has
+been re-rendered waits for the render. With max_stale set (on the decorator,
+or settings.CACHE_NGINX_MAX_STALE), every page cached is also stored under a
+second, "stale" key, which invalidation leaves alone and which lives for
+max_stale seconds. nginx only ever looks for the normal key, so on a miss the
+request reaches Django, which:
+
+    * returns the stale copy straight away, if there is one
+    * re-renders the page in a background thread, which puts it back under
+      the normal key - only one process does this at a time per page,
+      thanks to a lock in memcache. As with refresh.py, the page is
+      rendered from an anonymous request of its own, through its
+      cache_page_nginx decorated view
+
+So no page is ever served more than max_stale seconds after it was
+rendered, and nobody waits for a render while a stale copy exists.
+
+"""
+
+import logging
+import threading
+
+from django.conf import settings
+from django.db import connection
+
+STALE_KEY_PREFIX = 'stale:'
+LOCK_KEY_PREFIX = 'nmrevalidate:'
+
+
+def get_stale_key(cache_key):
+    """The key the stale copy of the page cached under cache_key is kept
+    under"""
+    return STALE_KEY_PREFIX + cache_key
+
+
+def start_revalidation(client, cache_key, render):
+    """Call render() - which should re-render and re-cache the page cached
+    under cache_key - in a background thread, unless another thread (or
+    process) is already doing so. Returns the thread, or None if it wasn't
+    started."""
+    # Avoid a circular import: cache.py uses this module
+    from .cache import _call_memcache
+    lock_key = LOCK_KEY_PREFIX + cache_key
+    lock_timeout = getattr(settings, 'CACHE_NGINX_REVALIDATE_LOCK_TIMEOUT', 30)
+    # Not locked - so not started - if memcache couldn't be asked, either
+    if not _call_memcache(client, 'add', lock_key, 1, lock_timeout):
+        return None
+
+    def revalidate():
+        try:
+            render()
+        except Exception:
+            logging.exception("Couldn't re-render %s" % cache_key)
+        finally:
+            # Let a failed re-render be retried straight away, and don't
+            # leave this thread's database connection open
+            _call_memcache(client, 'delete', lock_key)
+            connection.close()
+
+    thread = threading.Thread(
+        target=revalidate,
+        name='nginx-memcache-revalidate'
+    )
+    thread.daemon = True
+    thread.start()
+    return thread
@@ -0,0 +1,55 @@
+"""Support for cacheing streamed responses.
+
+A streamed response's body isn't known until it has been sent, so instead
+of reading it up front (which would either break the stream or buffer the
+whole thing before the first byte goes out) we wrap its iterator in a tee:
+chunks go to the client untouched, and a copy is collected on the side.
+Only if the stream finishes successfully - and stayed under the size cap -
+is the collected body handed on to be cached.
+
+"""
+
+import logging
+
+from django.utils.encoding import smart_str
+
+
+def is_streaming(response):
+    """True for a StreamingHttpResponse (Django 1.5+), or an HttpResponse
+    built from an iterator (earlier versions)"""
+    return bool(
+        getattr(response, 'streaming', False) or
+        getattr(response, '_base_content_is_iter', False)
+    )
+
+
+def tee(chunks, on_complete, max_size):
+    """Yields chunks unchanged, calling on_complete(body) once they have all
+    been yielded, unless the body grew beyond max_size bytes"""
+    collected = []
+    size = 0
+    for chunk in chunks:
+        chunk = smart_str(chunk)
+        if collected is not None:
+            size += len(chunk)
+            if size > max_size:
+                logging.info(
+                    "Streamed response over %d bytes; not cacheing" % max_size
+                )
+                collected = None
+            else:
+                collected.append(chunk)
+        yield chunk
+    # If the client went away, or the iterator raised, we never get here
+    if collected is not None:
+        on_complete(''.join(collected))
+
+
+def tee_streaming_response(response, on_complete, max_size):
+    """Wrap the body of a streaming response in a tee(). See is_streaming()"""
+    if getattr(response, 'streaming', False):
+        response.streaming_content = tee(
+            response.streaming_content, on_complete, max_size
+        )
+    else:
+        response._container = tee(response._container, on_complete, max_size)
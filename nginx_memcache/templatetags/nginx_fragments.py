@@ -0,0 +1,16 @@
+from django import template
+from django.conf import settings
+from django.utils.safestring import mark_safe
+
+from nginx_memcache.fragments import render_fragment, ssi_include
+
+register = template.Library()
+
+
+@register.simple_tag(takes_context=True)
+def nginx_fragment(context, name):
+    """An SSI include of the named fragment (see fragments.py) for nginx to
+    fill in, or - with settings.CACHE_NGINX_SSI off - the fragment itself"""
+    if getattr(settings, 'CACHE_NGINX_SSI', True):
+        return mark_safe(ssi_include(name))
+    return mark_safe(render_fragment(context.get('request'), name))
@@ -1,3 +1,28 @@
 from .decorators import CachePageDecoratorTests, CachePageDecoratorHTTPSTests, CachePageDecoratorHTTPSSkipCacheTests
 from .cache import CachedPageRecordTests
-from .signals import CacheSignalTests
\ No newline at end of file
+from .signals import CacheSignalTests
+from .writer import BackgroundWriterTests
+from .client import NginxCacheClientTests, MemcacheClientTests, ConnectionPoolTests
+from .minify import MinifyHTMLTests
+from .streaming import StreamingResponseTests
+from .admission import CountMinSketchTests, AdmissionTests
+from .ttl import AdaptiveTTLPolicyTests, AdaptiveTTLTests
+from .usage import UsageReportTests
+from .admin import CachedPageRecordAdminTests
+from .routing import CacheAliasRoutingTests
+from .readthrough import ReadThroughTests
+from .stale import StaleWhileRevalidateTests
+from .tags import CachedPageTagTests
+from .timing import StageTimingTests
+from .localmemcache import LocalMemcacheServerTests, LoadHarnessTests
+from .reconcile import ReconcileTests
+from .fragments import FragmentTests
+from .variants import VariantSpecTests
+from .nginxconf import NginxConfigTests
+from .refresh import RefreshTests
+from .staggered import StaggeredInvalidationTests
+from .churn import ChurnTrackerTests, ChurnDetectionTests
+from .batch import BatchTests
+from .breaker import CircuitBreakerTests, CacheCircuitBreakerTests, OperationDeadlineTests
+from .pinning import PinnedPageTests
+from .scheme import SchemeKeyTests
@@ -0,0 +1,87 @@
+"""Tests for the CachedPageRecord admin"""
+
+from django.contrib.auth.models import User
+from django.test import TestCase
+
+from nginx_memcache.admin import EstimatedCountPaginator
+from nginx_memcache.cache import nginx_cache as cache
+from nginx_memcache.models import CachedPageRecord
+
+CHANGELIST_URL = '/admin/nginx_memcache/cachedpagerecord/'
+
+
+class CachedPageRecordAdminTests(TestCase):
+    urls = 'nginx_memcache.tests.urls'
+
+    def setUp(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'pw')
+        self.client.login(username='admin', password='pw')
+        cache.clear()
+        for i in range(5):
+            key = '%032x' % i
+            CachedPageRecord.objects.create(
+                base_cache_key=key,
+                parent_identifier='site%d.example.com' % (i % 2),
+                supplementary_identifier='news'
+            )
+            cache.set(key, 'content')
+
+    def changelist_keys(self, **params):
+        response = self.client.get(CHANGELIST_URL, params)
+        self.assertEqual(response.status_code, 200)
+        return [record.pk for record in response.context['cl'].result_list]
+
+    def test_search_by_exact_key_or_identifier_prefix(self):
+        self.assertEqual(self.changelist_keys(q='%032x' % 3), ['%032x' % 3])
+        self.assertEqual(
+            self.changelist_keys(q='site1.'),
+            ['%032x' % 1, '%032x' % 3]
+        )
+        # No substring matching
+        self.assertEqual(self.changelist_keys(q='example.com'), [])
+
+    def test_keyset_pagination(self):
+        response = self.client.get(CHANGELIST_URL, {'after': '%032x' % 2})
+        self.assertEqual(
+            [record.pk for record in response.context['cl'].result_list],
+            ['%032x' % 3, '%032x' % 4]
+        )
+
+    def test_next_page_link_continues_from_last_key(self):
+        from nginx_memcache.admin import CachedPageRecordAdmin
+        CachedPageRecordAdmin.list_per_page = 2
+        try:
+            response = self.client.get(CHANGELIST_URL)
+            self.assertEqual(
+                response.context['cl'].next_page_url,
+                '?after=%032x' % 1
+            )
+        finally:
+            CachedPageRecordAdmin.list_per_page = 100
+
+    def test_invalidate_selected_action(self):
+        self.client.post(CHANGELIST_URL, {
+            'action': 'invalidate_selected',
+            '_selected_action': ['%032x' % 0, '%032x' % 1],
+        })
+        self.assertEqual(cache.get('%032x' % 0), None)
+        self.assertEqual(cache.get('%032x' % 1), None)
+        self.assertEqual(cache.get('%032x' % 2), 'content')
+
+    def test_invalidate_selected_identifiers_action(self):
+        self.client.post(CHANGELIST_URL, {
+            'action': 'invalidate_selected_identifiers',
+            '_selected_action': ['%032x' % 1],
+        })
+        for i in range(5):
+            if i % 2:
+                self.assertEqual(cache.get('%032x' % i), None)
+            else:
+                self.assertEqual(cache.get('%032x' % i), 'content')
+
+    def test_paginator_counts_filtered_results(self):
+        paginator = EstimatedCountPaginator(
+            CachedPageRecord.objects.filter(parent_identifier='site0.example.com'),
+            100
+        )
+        self.assertEqual(paginator.count, 3)
@@ -0,0 +1,142 @@
+"""Tests for the frequency-based cache admission filter"""
+
+import hashlib
+import threading
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.admission import (
+    CountMinSketch,
+    get_admission_stats,
+    reset_admission
+)
+from nginx_memcache import cache as cache_module
+from nginx_memcache.cache import nginx_cache as cache, get_cache_key
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.writer import get_writer
+
+
+class CountMinSketchTests(TestCase):
+
+    def test_counts_never_underestimated(self):
+        sketch = CountMinSketch(width=64, depth=4)
+        for i in range(50):
+            for _ in range(i % 5):
+                sketch.increment('key-%d' % i)
+        for i in range(50):
+            self.assertTrue(sketch.estimate('key-%d' % i) >= i % 5)
+
+    def test_rows_are_independent(self):
+        # Keys like real cache keys: all 32 hex digits
+        def key(i):
+            return hashlib.md5('page-%d' % i).hexdigest()
+        sketch = CountMinSketch(width=1024, depth=4)
+        for i in range(500):
+            sketch.increment(key(i))
+        # A key never seen only looks seen if it collides with a seen
+        # key in every row - rarely, unless the rows hash alike
+        overestimated = [
+            i for i in range(500, 700) if sketch.estimate(key(i)) > 0
+        ]
+        self.assertTrue(len(overestimated) < 20)
+
+    def test_counts_aged(self):
+        sketch = CountMinSketch(width=64, depth=4, sample_size=8)
+        for _ in range(7):
+            sketch.increment('hot')
+        self.assertEqual(sketch.estimate('hot'), 7)
+        # The eighth increment triggers halving of every counter
+        sketch.increment('hot')
+        self.assertEqual(sketch.estimate('hot'), 4)
+
+
+class AdmissionTests(TestCase):
+
+    def setUp(self):
+        reset_admission()
+        self.factory = RequestFactory()
+        self.request = self.factory.get('/', SERVER_NAME="example1.com")
+        cache.clear()
+        self.cache_key = get_cache_key(
+            self.request.get_host(),
+            self.request.get_full_path()
+        )
+
+    def tearDown(self):
+        for name in (
+            'CACHE_NGINX_ADMISSION_THRESHOLD',
+            'CACHE_NGINX_ADMISSION_BACKEND',
+            'CACHE_NGINX_BACKGROUND_WRITES'
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def test_page_cached_only_once_threshold_reached(self):
+        my_view_cached = cache_page_nginx(self.my_view, admission_threshold=3)
+        my_view_cached(self.request)
+        my_view_cached(self.request)
+        self.assertEqual(cache.get(self.cache_key), None)
+        my_view_cached(self.request)
+        self.assertEqual(cache.get(self.cache_key), 'content')
+
+        self.assertEqual(
+            get_admission_stats(),
+            {'admitted': 1, 'rejected': 2}
+        )
+
+    def test_threshold_from_settings(self):
+        settings.CACHE_NGINX_ADMISSION_THRESHOLD = 2
+        my_view_cached = cache_page_nginx(self.my_view)
+        my_view_cached(self.request)
+        self.assertEqual(cache.get(self.cache_key), None)
+        my_view_cached(self.request)
+        self.assertEqual(cache.get(self.cache_key), 'content')
+
+    def test_per_view_threshold_overrides_settings(self):
+        settings.CACHE_NGINX_ADMISSION_THRESHOLD = 5
+        my_view_cached = cache_page_nginx(self.my_view, admission_threshold=1)
+        my_view_cached(self.request)
+        self.assertEqual(cache.get(self.cache_key), 'content')
+
+    def test_counts_shared_via_memcache(self):
+        settings.CACHE_NGINX_ADMISSION_BACKEND = 'memcache'
+        my_view_cached = cache_page_nginx(self.my_view, admission_threshold=2)
+        my_view_cached(self.request)
+        # A fresh local sketch makes no difference to the shared count
+        reset_admission()
+        my_view_cached(self.request)
+        self.assertEqual(cache.get(self.cache_key), 'content')
+
+    def test_memcache_counts_bumped_in_background(self):
+        settings.CACHE_NGINX_ADMISSION_BACKEND = 'memcache'
+        settings.CACHE_NGINX_BACKGROUND_WRITES = True
+        counted_by = []
+        call_memcache = cache_module._call_memcache
+
+        def record(client, method, *args, **kwargs):
+            if method in ('add', 'incr'):
+                counted_by.append(threading.current_thread())
+            return call_memcache(client, method, *args, **kwargs)
+
+        cache_module._call_memcache = record
+        try:
+            my_view_cached = cache_page_nginx(
+                self.my_view, admission_threshold=2
+            )
+            my_view_cached(self.request)
+            get_writer().flush()
+            self.assertEqual(cache.get(self.cache_key), None)
+            # The last count seen, plus this request
+            my_view_cached(self.request)
+            get_writer().flush()
+            self.assertEqual(cache.get(self.cache_key), 'content')
+        finally:
+            cache_module._call_memcache = call_memcache
+        self.assertEqual(len(counted_by), 3)
+        self.assertFalse(threading.current_thread() in counted_by)
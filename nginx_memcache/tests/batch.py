@@ -0,0 +1,173 @@
+"""Tests for cacheing and invalidating many pages at once"""
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    cache_many,
+    get_cache_key,
+    get_nginx_cache,
+    invalidate_many,
+    nginx_cache as cache,
+    reset_nginx_cache
+)
+from nginx_memcache.signals import invalidate_pages
+from nginx_memcache.stale import get_stale_key
+from nginx_memcache.tests.urls import page_contents
+
+
+class BatchTests(TestCase):
+
+    urls = 'nginx_memcache.tests.urls'
+
+    def setUp(self):
+        self._caches = settings.CACHES
+        settings.CACHES = dict(self._caches, bigtenant={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'bigtenant',
+            'KEY_PREFIX': 'big',
+        })
+        settings.CACHE_NGINX_ALIAS_ROUTES = {'big.example.com': 'bigtenant'}
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = False
+        reset_nginx_cache()
+        self.calls = []
+        self.depth = 0
+        for alias in ('default', 'bigtenant'):
+            client = get_nginx_cache(alias)
+            client.clear()
+            for method in ('set', 'set_many', 'delete', 'delete_many'):
+                setattr(client, method, self.recorder(alias, client, method))
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        settings.CACHES = self._caches
+        del settings.CACHE_NGINX_ALIAS_ROUTES
+        if hasattr(settings, 'CACHE_NGINX_BULK_CHUNK_SIZE'):
+            del settings.CACHE_NGINX_BULK_CHUNK_SIZE
+        page_contents.clear()
+        reset_nginx_cache()
+
+    def recorder(self, alias, client, method):
+        original = getattr(client, method)
+
+        def record(*args, **kwargs):
+            # LocMemCache's set_many and delete_many call its set and
+            # delete, which aren't round trips of their own
+            if self.depth == 0:
+                self.calls.append((alias, method))
+            self.depth += 1
+            try:
+                return original(*args, **kwargs)
+            finally:
+                self.depth -= 1
+        return record
+
+    def pair(self, path, host='example.com'):
+        request = self.factory.get(path, HTTP_HOST=host)
+        request.user = AnonymousUser()
+        return request, HttpResponse('content of %s' % path)
+
+    def test_cache_many(self):
+        cache_many([self.pair('/%d/' % number) for number in range(5)] + [
+            self.pair('/big/', 'big.example.com')
+        ])
+        self.assertEqual(self.calls, [
+            ('default', 'set_many'), ('bigtenant', 'set_many')
+        ])
+        for number in range(5):
+            path = '/%d/' % number
+            self.assertEqual(
+                cache.get(get_cache_key('example.com', path)),
+                'content of %s' % path
+            )
+        self.assertEqual(
+            get_nginx_cache('bigtenant').get(
+                get_cache_key('big.example.com', '/big/')
+            ),
+            'content of /big/'
+        )
+
+    def test_cache_many_chunks_and_groups_by_timeout(self):
+        settings.CACHE_NGINX_BULK_CHUNK_SIZE = 2
+        cache_many(
+            [self.pair('/%d/' % number) for number in range(3)],
+            max_stale=600,
+            page_version_fn=lambda request: 'v1'
+        )
+        # The pages, then their stale copies (which live for max_stale)
+        self.assertEqual(self.calls, [('default', 'set_many')] * 4)
+        cache_key = get_cache_key('example.com', '/2/', 'v1')
+        self.assertEqual(cache.get(cache_key), 'content of /2/')
+        self.assertEqual(cache.get(get_stale_key(cache_key)), 'content of /2/')
+
+    def test_cache_many_writes_pages_cached_before_an_error(self):
+        def pairs():
+            yield self.pair('/1/')
+            raise ValueError
+        self.assertRaises(ValueError, cache_many, pairs())
+        self.assertEqual(
+            cache.get(get_cache_key('example.com', '/1/')), 'content of /1/'
+        )
+        # And writes go back to normal afterwards
+        cache_many([])
+        self.calls = []
+        request, response = self.pair('/2/')
+        cache_many([(request, response)])
+        self.assertEqual(self.calls, [('default', 'set_many')])
+
+    def test_invalidate_many(self):
+        settings.CACHE_NGINX_BULK_CHUNK_SIZE = 2
+        keys = [get_cache_key('example.com', '/%d/' % n) for n in range(3)]
+        keys.append(get_cache_key('example.com', '/v/', 'v1'))
+        for key in keys:
+            cache.set(key, 'content')
+            cache.set(get_stale_key(key), 'content')
+        big_key = get_cache_key('big.example.com', '/')
+        get_nginx_cache('bigtenant').set(big_key, 'content')
+        self.calls = []
+
+        invalidated = invalidate_many([
+            ('example.com', '/0/'),
+            ('example.com', '/1/'),
+            {'request_host': 'example.com', 'request_path': '/2/'},
+            ('example.com', '/v/', 'v1'),
+            ('big.example.com', '/'),
+        ], include_stale=True)
+        self.assertEqual(invalidated, 5)
+        self.assertEqual(self.calls, [
+            ('default', 'delete_many'),
+            ('default', 'delete_many'),
+            ('bigtenant', 'delete_many'),
+        ])
+        self.assertEqual(cache.get_many(keys), {})
+        self.assertEqual(
+            cache.get_many([get_stale_key(key) for key in keys]), {}
+        )
+        self.assertEqual(get_nginx_cache('bigtenant').get(big_key), None)
+
+    def test_invalidate_pages_signal(self):
+        key = get_cache_key('example.com', '/a/')
+        cache.set(key, 'content')
+        invalidate_pages.send(sender=self, pages=[('example.com', '/a/')])
+        self.assertEqual(cache.get(key), None)
+
+    def test_invalidate_many_refresh(self):
+        settings.CACHE_NGINX_REFRESH_WORKERS = 1
+        page_contents.update({'a': 'new a', 'b': 'new b'})
+        try:
+            self.assertEqual(invalidate_many([
+                ('example.com', '/editable/a/'),
+                ('example.com', '/editable/b/', 'members'),
+            ], refresh=True), 2)
+        finally:
+            del settings.CACHE_NGINX_REFRESH_WORKERS
+        self.assertEqual(
+            cache.get(get_cache_key('example.com', '/editable/a/')), 'new a'
+        )
+        self.assertEqual(
+            cache.get(get_cache_key('example.com', '/editable/b/', 'members')),
+            'new b'
+        )
@@ -0,0 +1,255 @@
+"""Tests for the circuit breaker around the nginx cache, and the client's
+per-operation deadline"""
+
+import socket
+import threading
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.admission import get_admission_stats, reset_admission
+from nginx_memcache.breaker import (
+    CLOSED,
+    HALF_OPEN,
+    OPEN,
+    CircuitBreaker,
+    get_breaker,
+    get_breaker_states,
+    reset_breakers
+)
+from nginx_memcache.cache import (
+    cache_response,
+    get_cache_key,
+    get_cached_page,
+    get_nginx_cache,
+    invalidate,
+    reset_nginx_cache
+)
+from nginx_memcache.churn import reset_churn
+from nginx_memcache.client import MemcacheClient, MemcacheError
+from nginx_memcache.stale import start_revalidation
+
+
+class CircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        self.breaker = CircuitBreaker(
+            'default', failure_threshold=3, reset_timeout=10, max_queued=3
+        )
+
+    def test_opens_after_failures_in_a_row(self):
+        self.breaker.record_failure(now=0)
+        self.breaker.record_failure(now=0)
+        self.breaker.record_success()
+        self.breaker.record_failure(now=0)
+        self.breaker.record_failure(now=0)
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertTrue(self.breaker.allow(now=0))
+        self.breaker.record_failure(now=0)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow(now=9))
+        self.assertEqual(self.breaker.stats()['rejected'], 1)
+        self.assertEqual(self.breaker.stats()['total_failures'], 5)
+
+    def test_half_open_probe(self):
+        for _ in range(3):
+            self.breaker.record_failure(now=0)
+        # One probe at a time, once the cool-down is over
+        self.assertTrue(self.breaker.allow(now=10))
+        self.assertEqual(self.breaker.state, HALF_OPEN)
+        self.assertFalse(self.breaker.allow(now=10))
+
+        # A failed probe opens it for another cool-down...
+        self.breaker.record_failure(now=11)
+        self.assertEqual(self.breaker.state, OPEN)
+        self.assertFalse(self.breaker.allow(now=20))
+        # ...and a successful one closes it
+        self.assertTrue(self.breaker.allow(now=21))
+        self.assertTrue(self.breaker.record_success())
+        self.assertEqual(self.breaker.state, CLOSED)
+        self.assertFalse(self.breaker.record_success())
+        self.assertTrue(self.breaker.allow(now=21))
+
+    def test_queue_is_bounded(self):
+        self.breaker.queue_deletes(['a', 'b'])
+        self.breaker.queue_deletes(['a', 'c', 'd'])
+        self.assertEqual(self.breaker.stats()['queued'], 3)
+        self.assertEqual(self.breaker.stats()['dropped'], 1)
+        # The oldest is dropped; a key queued again counts as new
+        self.assertEqual(self.breaker.take_queued(), ['a', 'c', 'd'])
+        self.assertEqual(self.breaker.take_queued(), [])
+
+
+class CacheCircuitBreakerTests(TestCase):
+
+    def setUp(self):
+        settings.CACHE_NGINX_BREAKER_FAILURES = 2
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = False
+        reset_nginx_cache()
+        reset_breakers()
+        self.client = get_nginx_cache()
+        self.client.clear()
+        self.down = False
+        self.calls = []
+        for method in (
+            'get', 'set', 'add', 'incr', 'delete', 'delete_many'
+        ):
+            setattr(self.client, method, self.flaky(method))
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        for name in (
+            'CACHE_NGINX_BREAKER',
+            'CACHE_NGINX_BREAKER_FAILURES',
+            'CACHE_NGINX_CHURN',
+            'CACHE_NGINX_CHURN_BACKEND',
+            'CACHE_NGINX_ADMISSION_BACKEND',
+            'CACHE_NGINX_ADMISSION_THRESHOLD',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        reset_nginx_cache()
+        reset_breakers()
+        reset_admission()
+        reset_churn()
+
+    def flaky(self, method):
+        original = getattr(self.client, method)
+
+        def call(*args, **kwargs):
+            self.calls.append(method)
+            if self.down:
+                raise MemcacheError("Timed out talking to memcache")
+            return original(*args, **kwargs)
+        return call
+
+    def cache_page(self, path, content):
+        request = self.factory.get(path, HTTP_HOST='example.com')
+        request.user = AnonymousUser()
+        cache_response(request, HttpResponse(content))
+        return get_cache_key('example.com', path)
+
+    def test_failures_open_the_breaker(self):
+        self.down = True
+        # Failures don't reach the response
+        self.cache_page('/a/', 'A')
+        self.cache_page('/b/', 'B')
+        self.assertEqual(get_breaker('default').state, OPEN)
+        self.assertEqual(self.calls, ['set', 'set'])
+
+        # While it's open, memcache isn't tried at all
+        self.cache_page('/c/', 'C')
+        request = self.factory.get('/c/', HTTP_HOST='example.com')
+        self.assertEqual(get_cached_page(request), None)
+        self.assertEqual(self.calls, ['set', 'set'])
+        self.assertEqual(get_breaker_states()['default']['rejected'], 2)
+
+    def test_missed_invalidations_are_replayed(self):
+        key_a = self.cache_page('/a/', 'A')
+        key_b = self.cache_page('/b/', 'B')
+        self.down = True
+        invalidate('example.com', '/a/')
+        invalidate('example.com', '/a/')
+        # Not even attempted, but queued
+        invalidate('example.com', '/b/')
+        self.assertEqual(self.calls.count('delete'), 2)
+        self.assertEqual(get_breaker_states()['default']['queued'], 2)
+
+        # A probe after the cool-down, once memcache is back, closes the
+        # breaker and replays the invalidations
+        self.down = False
+        get_breaker('default').opened_at -= 30
+        request = self.factory.get('/c/', HTTP_HOST='example.com')
+        self.assertEqual(get_cached_page(request), None)
+        self.assertEqual(get_breaker('default').state, CLOSED)
+        self.assertEqual(self.client.get(key_a), None)
+        self.assertEqual(self.client.get(key_b), None)
+        self.assertEqual(get_breaker_states()['default']['queued'], 0)
+
+    def test_shared_counters(self):
+        settings.CACHE_NGINX_CHURN = True
+        settings.CACHE_NGINX_CHURN_BACKEND = 'memcache'
+        settings.CACHE_NGINX_ADMISSION_BACKEND = 'memcache'
+        settings.CACHE_NGINX_ADMISSION_THRESHOLD = 2
+        self.down = True
+        # A count that can't be made doesn't hold a page back, or reach
+        # the response
+        self.cache_page('/a/', 'A')
+        self.assertEqual(get_breaker('default').state, OPEN)
+        self.assertEqual(self.calls, ['add', 'set'])
+        self.cache_page('/b/', 'B')
+        self.assertEqual(self.calls, ['add', 'set'])
+        self.assertEqual(get_admission_stats()['admitted'], 2)
+
+        # Nor does the revalidation lock: the page isn't re-rendered
+        rendered = []
+        self.assertEqual(
+            start_revalidation(self.client, 'key', lambda: rendered.append(1)),
+            None
+        )
+        self.assertEqual(rendered, [])
+
+        # Once memcache is back, pages are counted again
+        self.down = False
+        get_breaker('default').opened_at -= 30
+        self.cache_page('/c/', 'C')
+        self.assertEqual(get_breaker('default').state, CLOSED)
+        self.assertEqual(self.calls[2:], ['add'])
+        self.assertEqual(get_admission_stats()['rejected'], 1)
+
+    def test_breaker_off(self):
+        settings.CACHE_NGINX_BREAKER = False
+        self.down = True
+        # Every call is tried, and failures still don't reach the response
+        for _ in range(3):
+            self.cache_page('/a/', 'A')
+            invalidate('example.com', '/a/')
+        request = self.factory.get('/a/', HTTP_HOST='example.com')
+        self.assertEqual(get_cached_page(request), None)
+        self.assertEqual(self.calls, ['set', 'delete'] * 3 + ['get'])
+        self.assertEqual(get_breaker_states(), {})
+
+
+class OperationDeadlineTests(TestCase):
+
+    def setUp(self):
+        # A server that trickles out a reply, a byte at a time, quickly
+        # enough that no single read times out
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.bind(('127.0.0.1', 0))
+        self.listener.listen(1)
+        self.stopped = threading.Event()
+        thread = threading.Thread(target=self.trickle)
+        thread.daemon = True
+        thread.start()
+
+    def tearDown(self):
+        self.stopped.set()
+        self.listener.close()
+
+    def trickle(self):
+        connection, _ = self.listener.accept()
+        try:
+            connection.recv(1024)
+            connection.sendall('VALUE t:1:key 0 100\r\n')
+            while not self.stopped.wait(0.02):
+                connection.sendall('x')
+        except socket.error:
+            pass
+        finally:
+            connection.close()
+
+    def test_operation_timeout(self):
+        client = MemcacheClient(
+            '127.0.0.1:%d' % self.listener.getsockname()[1],
+            key_prefix='t',
+            io_timeout=1.0,
+            operation_timeout=0.2
+        )
+        started = time.time()
+        self.assertRaises(MemcacheError, client.get, 'key')
+        self.assertTrue(time.time() - started < 1.0)
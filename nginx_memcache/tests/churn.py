@@ -0,0 +1,176 @@
+"""Tests for spotting pages that are re-cached over and over"""
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    get_cache_key,
+    invalidate,
+    nginx_cache as cache
+)
+from nginx_memcache.churn import (
+    COUNTER_KEY_PREFIX,
+    ChurnTracker,
+    get_churn_report,
+    reset_churn
+)
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.writer import get_writer
+
+alerts = []
+
+
+def record_alert(entry):
+    alerts.append(entry)
+
+
+class ChurnTrackerTests(TestCase):
+
+    def setUp(self):
+        self.tracker = ChurnTracker(threshold=3, min_caches=3)
+
+    def record(self, now, key='a', timeout=100):
+        return self.tracker.record_cache(
+            key, 'example.com', '/a/', 'members', timeout, now=now
+        )
+
+    def test_cached_once_per_timeout_is_fine(self):
+        for now in range(0, 1000, 100):
+            self.assertEqual(self.record(now), None)
+        self.assertEqual(self.tracker.report(), [])
+        entry, = self.tracker.report(churning_only=False)
+        self.assertEqual(entry['caches'], 10)
+        self.assertAlmostEqual(entry['ratio'], 1.0)
+
+    def test_cached_over_and_over_is_churning(self):
+        self.assertEqual(self.record(0), None)
+        self.assertEqual(self.record(1), None)
+        entry = self.record(2)
+        self.assertEqual(entry['caches'], 3)
+        self.assertEqual(entry['request_host'], 'example.com')
+        self.assertEqual(entry['request_path'], '/a/')
+        self.assertEqual(entry['page_version'], 'members')
+        self.assertTrue(entry['ratio'] > 2.9)
+        # Only reported as it starts churning
+        self.assertEqual(self.record(3), None)
+        self.assertEqual(
+            [entry['cache_key'] for entry in self.tracker.report()], ['a']
+        )
+
+    def test_invalidations_are_allowed_for(self):
+        for now in range(5):
+            self.tracker.record_invalidation(['a'])
+            self.assertEqual(self.record(now), None)
+
+    def test_shared_count(self):
+        # Other processes' caches count too, towards min_caches
+        tracker = ChurnTracker(threshold=3, min_caches=5)
+        for count in (3, 4):
+            self.assertEqual(tracker.record_cache(
+                'a', 'example.com', '/a/', '', 100, shared_count=count
+            ), None)
+        entry = tracker.record_cache(
+            'a', 'example.com', '/a/', '', 100, shared_count=5
+        )
+        self.assertEqual(entry['caches'], 3)
+        self.assertEqual(entry['shared_caches'], 5)
+
+    def test_oldest_page_forgotten(self):
+        tracker = ChurnTracker(max_entries=2)
+        for key in 'abc':
+            tracker.record_cache(key, 'example.com', '/', '', 100)
+        self.assertEqual(
+            sorted(entry['cache_key'] for entry in tracker.report(False)),
+            ['b', 'c']
+        )
+
+
+class ChurnDetectionTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        reset_churn()
+        del alerts[:]
+        settings.CACHE_NGINX_CHURN = True
+        settings.CACHE_NGINX_CHURN_MIN_CACHES = 3
+        settings.CACHE_NGINX_CHURN_CALLBACK = (
+            'nginx_memcache.tests.churn.record_alert'
+        )
+        self.factory = RequestFactory()
+        self.view = cache_page_nginx(self.my_view, cache_timeout=3600)
+
+    def tearDown(self):
+        for name in (
+            'CACHE_NGINX_CHURN',
+            'CACHE_NGINX_CHURN_MIN_CACHES',
+            'CACHE_NGINX_CHURN_CALLBACK',
+            'CACHE_NGINX_CHURN_BACKEND',
+            'CACHE_NGINX_BACKGROUND_WRITES',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        reset_churn()
+        del alerts[:]
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def get(self, path='/a/?b=c'):
+        request = self.factory.get(path)
+        request.user = AnonymousUser()
+        return self.view(request)
+
+    def test_off_by_default(self):
+        del settings.CACHE_NGINX_CHURN
+        for _ in range(5):
+            self.get()
+        self.assertEqual(get_churn_report(churning_only=False), [])
+
+    def test_churning_page_reported(self):
+        for _ in range(5):
+            self.get()
+        entry, = get_churn_report()
+        self.assertEqual(entry['request_host'], 'testserver')
+        self.assertEqual(entry['request_path'], '/a/?b=c')
+        self.assertEqual(entry['page_version'], '')
+        self.assertEqual(entry['cache_key'], get_cache_key(
+            'testserver', '/a/?b=c'
+        ))
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(alerts[0]['caches'], 3)
+
+    def test_invalidated_page_not_churning(self):
+        for _ in range(5):
+            self.get()
+            invalidate('testserver', '/a/?b=c')
+        self.assertEqual(get_churn_report(), [])
+        self.assertEqual(alerts, [])
+
+    def test_memcache_counter(self):
+        settings.CACHE_NGINX_CHURN_BACKEND = 'memcache'
+        counter_key = COUNTER_KEY_PREFIX + get_cache_key('testserver', '/')
+        self.get('/')
+        self.get('/')
+        self.assertEqual(cache.get(counter_key), 2)
+        # Invalidating the page resets its counter
+        invalidate('testserver', '/')
+        self.assertEqual(cache.get(counter_key), None)
+        for _ in range(3):
+            self.get('/')
+        self.assertEqual(cache.get(counter_key), 3)
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(alerts[0]['shared_caches'], 3)
+
+    def test_memcache_counter_in_background(self):
+        settings.CACHE_NGINX_CHURN_BACKEND = 'memcache'
+        settings.CACHE_NGINX_BACKGROUND_WRITES = True
+        counter_key = COUNTER_KEY_PREFIX + get_cache_key('testserver', '/')
+        for _ in range(3):
+            self.get('/')
+        get_writer().flush()
+        self.assertEqual(cache.get(counter_key), 3)
+        self.assertEqual(len(alerts), 1)
+        self.assertEqual(alerts[0]['shared_caches'], 3)
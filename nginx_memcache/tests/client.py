@@ -0,0 +1,142 @@
+"""Tests for the lazily-created, per-process nginx cache client
+and its connection pool
+"""
+
+import threading
+
+from django.test import TestCase
+from django.conf import settings
+
+from nginx_memcache import cache as cache_module
+from nginx_memcache.cache import get_nginx_cache, reset_nginx_cache
+from nginx_memcache.client import (
+    ConnectionPool,
+    MemcacheClient,
+    PoolTimeout,
+    parse_server
+)
+
+
+class FakeConnection(object):
+    closed = False
+
+    def close(self):
+        self.closed = True
+
+
+class NginxCacheClientTests(TestCase):
+
+    def setUp(self):
+        reset_nginx_cache()
+        self._getpid = cache_module.os.getpid
+
+    def tearDown(self):
+        cache_module.os.getpid = self._getpid
+        reset_nginx_cache()
+
+    def test_client_is_created_once_per_process(self):
+        self.assertTrue(get_nginx_cache() is get_nginx_cache())
+
+    def test_forked_process_gets_a_new_client(self):
+        parent_client = get_nginx_cache()
+        # Pretend we're now in a forked child process
+        cache_module.os.getpid = lambda: -1
+        child_client = get_nginx_cache()
+        self.assertFalse(parent_client is child_client)
+        self.assertTrue(child_client is get_nginx_cache())
+
+    def test_reset_hook_forgets_client(self):
+        client = get_nginx_cache()
+        reset_nginx_cache()
+        self.assertFalse(client is get_nginx_cache())
+
+    def test_pooled_client_has_a_deadline(self):
+        caches = settings.CACHES
+        settings.CACHES = dict(caches, memcached={
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': '127.0.0.1:11211',
+        })
+        try:
+            client = cache_module._build_client('memcached')
+            self.assertTrue(isinstance(client, MemcacheClient))
+            self.assertEqual(client.operation_timeout, 1.0)
+            settings.CACHE_NGINX_CLIENT_OPTIONS = {'operation_timeout': None}
+            client = cache_module._build_client('memcached')
+            self.assertEqual(client.operation_timeout, None)
+        finally:
+            settings.CACHES = caches
+            if hasattr(settings, 'CACHE_NGINX_CLIENT_OPTIONS'):
+                del settings.CACHE_NGINX_CLIENT_OPTIONS
+
+    def test_lazy_global_passes_through(self):
+        cache_module.nginx_cache.set('lazy', 'value')
+        self.assertEqual(get_nginx_cache().get('lazy'), 'value')
+
+
+class MemcacheClientTests(TestCase):
+
+    def test_keys_made_as_django_does(self):
+        client = MemcacheClient('127.0.0.1:11211', key_prefix='ps')
+        self.assertEqual(client.make_key('abc'), 'ps:1:abc')
+        self.assertEqual(client.make_key(u'abc'), 'ps:1:abc')
+
+    def test_parse_server(self):
+        self.assertEqual(parse_server('10.0.0.1:11212'), ('10.0.0.1', 11212))
+        self.assertEqual(parse_server('10.0.0.1'), ('10.0.0.1', 11211))
+        self.assertEqual(parse_server('unix:/tmp/mc.sock'), '/tmp/mc.sock')
+
+    def test_values_encoded_as_python_memcached_does(self):
+        client = MemcacheClient('127.0.0.1:11211')
+        self.assertEqual(client._encode('<html>'), (0, '<html>'))
+        self.assertEqual(client._encode(u'caf\xe9'), (0, 'caf\xc3\xa9'))
+        self.assertEqual(client._encode(5), (2, '5'))
+        flags, data = client._encode({'a': 1})
+        self.assertEqual(client._decode(flags, data), {'a': 1})
+
+
+class ConnectionPoolTests(TestCase):
+
+    def test_pool_reuses_released_connections(self):
+        made = []
+        pool = ConnectionPool(lambda: made.append(FakeConnection()) or made[-1])
+        connection = pool.acquire()
+        pool.release(connection)
+        self.assertTrue(pool.acquire() is connection)
+        self.assertEqual(len(made), 1)
+
+    def test_pool_is_bounded(self):
+        pool = ConnectionPool(FakeConnection, max_size=2, pool_timeout=0.01)
+        pool.acquire()
+        pool.acquire()
+        self.assertRaises(PoolTimeout, pool.acquire)
+
+    def test_waiting_thread_gets_released_connection(self):
+        pool = ConnectionPool(FakeConnection, max_size=1, pool_timeout=5)
+        connection = pool.acquire()
+        got = []
+        waiter = threading.Thread(target=lambda: got.append(pool.acquire()))
+        waiter.start()
+        pool.release(connection)
+        waiter.join()
+        self.assertTrue(got[0] is connection)
+
+    def test_discarded_connection_frees_a_slot(self):
+        pool = ConnectionPool(FakeConnection, max_size=1, pool_timeout=0.01)
+        connection = pool.acquire()
+        pool.discard(connection)
+        self.assertTrue(connection.closed)
+        self.assertFalse(pool.acquire() is connection)
+
+    def test_close_keeps_checked_out_connections_counted(self):
+        pool = ConnectionPool(FakeConnection, max_size=2, pool_timeout=0.01)
+        idle = pool.acquire()
+        busy = pool.acquire()
+        pool.release(idle)
+        pool.close()
+        self.assertTrue(idle.closed)
+        self.assertFalse(busy.closed)
+        # busy still holds one of the two slots
+        pool.acquire()
+        self.assertRaises(PoolTimeout, pool.acquire)
+        pool.discard(busy)
+        pool.acquire()
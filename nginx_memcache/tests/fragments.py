@@ -0,0 +1,159 @@
+"""Tests for cacheing fragments, assembled by nginx with SSI"""
+
+from django.http import Http404
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import get_cache_key, nginx_cache as cache
+from nginx_memcache.fragments import (
+    fragment,
+    fragment_path,
+    fragment_view,
+    invalidate_fragment,
+    register_fragment,
+    ssi_include
+)
+from nginx_memcache.harness import (
+    NginxSimulator,
+    SSIError,
+    assemble_ssi,
+    use_memcache
+)
+from nginx_memcache.localmemcache import LocalMemcacheServer
+from nginx_memcache.models import CachedPageTag
+
+renders = {'news': 0, 'greeting': 0}
+
+
+@fragment('news', timeout=60)
+def news(request):
+    renders['news'] += 1
+    return '<p>news %d</p>' % renders['news']
+
+
+@fragment('greeting', personal=True)
+def greeting(request):
+    renders['greeting'] += 1
+    return '<p>hello %s</p>' % request.COOKIES.get('name', 'stranger')
+
+
+class FragmentTests(TestCase):
+
+    urls = 'nginx_memcache.tests.urls'
+
+    def setUp(self):
+        cache.clear()
+        for name in renders:
+            renders[name] = 0
+        self._use_lookup_table = getattr(
+            settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', False
+        )
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = True
+
+    def tearDown(self):
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = self._use_lookup_table
+        if hasattr(settings, 'CACHE_NGINX_SSI'):
+            del settings.CACHE_NGINX_SSI
+
+    def test_shell_has_includes(self):
+        response = self.client.get('/shell/')
+        self.assertEqual(
+            response.content,
+            '<div>%s</div><div>%s</div>' % (
+                ssi_include('news'), ssi_include('greeting')
+            )
+        )
+        self.assertEqual(
+            ssi_include('news'),
+            '<!--# include virtual="/_fragment/news" -->'
+        )
+        self.assertEqual(renders['news'], 0)
+
+    def test_inline_without_ssi(self):
+        settings.CACHE_NGINX_SSI = False
+        response = self.client.get('/shell/')
+        self.assertEqual(
+            response.content,
+            '<div><p>news 1</p></div><div><p>hello stranger</p></div>'
+        )
+
+    def test_shared_fragment_cached(self):
+        response = self.client.get('/_fragment/news')
+        self.assertEqual(response.content, '<p>news 1</p>')
+        key = get_cache_key('testserver', fragment_path('news'))
+        self.assertEqual(cache.get(key), '<p>news 1</p>')
+        self.assertEqual(
+            list(CachedPageTag.objects.values_list('tag', flat=True)),
+            ['fragment:news']
+        )
+
+    def test_fragment_keyed_by_page_version_cookie(self):
+        self.client.cookies['pv'] = 'members'
+        self.client.get('/_fragment/news')
+        key = get_cache_key('testserver', fragment_path('news'), 'members')
+        self.assertEqual(cache.get(key), '<p>news 1</p>')
+
+    def test_personal_fragment_not_cached(self):
+        self.client.get('/_fragment/greeting')
+        key = get_cache_key('testserver', fragment_path('greeting'))
+        self.assertEqual(cache.get(key), None)
+
+    def test_unknown_fragment(self):
+        request = RequestFactory().get('/_fragment/nope')
+        self.assertRaises(Http404, fragment_view, request, 'nope')
+
+    def test_invalidate_fragment(self):
+        self.client.get('/_fragment/news', HTTP_HOST='a.example.com')
+        self.client.get('/_fragment/news', HTTP_HOST='b.example.com')
+        a = get_cache_key('a.example.com', fragment_path('news'))
+        b = get_cache_key('b.example.com', fragment_path('news'))
+
+        invalidate_fragment('news', 'a.example.com')
+        self.assertEqual(cache.get(a), None)
+        self.assertNotEqual(cache.get(b), None)
+
+        invalidate_fragment('news')
+        self.assertEqual(cache.get(b), None)
+
+    def test_assembled_by_simulated_nginx(self):
+        server = LocalMemcacheServer()
+        server.start()
+        try:
+            with use_memcache(server.location) as conf:
+                simulator = NginxSimulator(
+                    server.location, key_prefix=conf.get('KEY_PREFIX', '')
+                )
+                simulator.django.cookies['name'] = 'sam'
+                for i in range(3):
+                    source, status, content = simulator.request_assembled(
+                        '/shell/'
+                    )
+                    self.assertEqual(
+                        content,
+                        '<div><p>news 1</p></div><div><p>hello sam</p></div>'
+                    )
+                simulator.close()
+        finally:
+            server.stop()
+        self.assertEqual(source, 'memcache')
+        # The shell and news were only rendered once; the greeting each time
+        self.assertEqual(renders, {'news': 1, 'greeting': 3})
+        self.assertEqual(simulator.hits, 4)
+        self.assertEqual(simulator.misses, 5)
+
+    def test_assemble_ssi(self):
+        pages = {
+            '/a': 'a<!--# include virtual="/b" -->',
+            '/b': 'b<!--#include virtual="/c"-->',
+            '/c': 'c',
+            '/loop': '<!--# include virtual="/loop" -->',
+        }
+        self.assertEqual(
+            assemble_ssi(pages['/a'], pages.get), 'abc'
+        )
+        self.assertRaises(SSIError, assemble_ssi, pages['/loop'], pages.get)
+
+    def test_register_fragment(self):
+        render = lambda request: 'x'
+        self.assertTrue(register_fragment('x', render) is render)
@@ -0,0 +1,183 @@
+"""Tests for the local memcache server, and the load harness built on it"""
+
+import time
+
+from django.core.management import call_command
+from django.test import TestCase
+from django.conf import settings
+
+from nginx_memcache.cache import get_cache_key, get_nginx_cache
+from nginx_memcache.client import Connection, MemcacheClient, MemcacheError
+from nginx_memcache.harness import (
+    NginxSimulator,
+    nginx_cache_key,
+    parse_workload,
+    run_workload,
+    use_memcache
+)
+from nginx_memcache.localmemcache import LocalMemcacheServer
+
+
+class LocalMemcacheServerTests(TestCase):
+
+    def setUp(self):
+        self.server = LocalMemcacheServer(
+            memory_limit=2000, item_size_limit=500
+        )
+        self.server.start()
+        self.client = MemcacheClient(self.server.location, key_prefix='t')
+
+    def tearDown(self):
+        self.client.disconnect_all()
+        self.server.stop()
+
+    def raw(self, command):
+        connection = Connection(('127.0.0.1', self.server.port))
+        try:
+            connection.send(command)
+            return connection.readline()
+        finally:
+            connection.close()
+
+    def test_values_and_flags(self):
+        self.client.set('str', 'value')
+        self.client.set('int', 42)
+        self.client.set('dict', {'a': 1})
+        self.assertEqual(
+            self.client.get_many(['str', 'int', 'dict', 'missing']),
+            {'str': 'value', 'int': 42, 'dict': {'a': 1}}
+        )
+
+    def test_add_incr_delete(self):
+        self.assertTrue(self.client.add('counter', 1))
+        self.assertFalse(self.client.add('counter', 5))
+        self.assertEqual(self.client.incr('counter', 2), 3)
+        self.assertRaises(ValueError, self.client.incr, 'missing')
+        self.client.delete('counter')
+        self.assertEqual(self.client.get('counter'), None)
+
+    def test_expiry(self):
+        self.client.set('gone', 'value', -1)
+        self.assertEqual(self.client.get('gone'), None)
+        store = self.server.store
+        store.store('set', 'soon', 0, 1, 'value')
+        self.assertNotEqual(store.get('soon'), None)
+        store._items['soon'] = (0, time.time() - 1, 1, 'value')
+        self.assertEqual(store.get('soon'), None)
+
+    def test_lru_eviction(self):
+        for i in range(10):
+            self.client.set('key%d' % i, 'x' * 200)
+            # Keep key0 in use
+            self.client.get('key0')
+        stats = self.server.store.get_stats()
+        self.assertTrue(stats['bytes'] <= 2000)
+        self.assertTrue(stats['evictions'] > 0)
+        self.assertEqual(self.client.get('key0'), 'x' * 200)
+        self.assertEqual(self.client.get('key1'), None)
+        self.assertEqual(self.client.get('key9'), 'x' * 200)
+
+    def test_item_size_limit(self):
+        self.assertRaises(MemcacheError, self.client.set, 'big', 'x' * 600)
+        self.assertEqual(self.client.get('big'), None)
+
+    def test_meta_get(self):
+        self.client.set('here', 'value')
+        self.assertEqual(self.raw('mg t:1:here s\r\n'), 'HD s5')
+        self.assertEqual(self.raw('mg t:1:missing\r\n'), 'EN')
+
+    def test_unknown_command(self):
+        self.assertEqual(self.raw('bogus\r\n'), 'ERROR')
+
+    def test_flush(self):
+        self.client.set('key', 'value')
+        self.client.clear()
+        self.assertEqual(self.client.get('key'), None)
+
+
+class LoadHarnessTests(TestCase):
+
+    urls = 'nginx_memcache.tests.urls'
+
+    def setUp(self):
+        self.server = LocalMemcacheServer()
+        self.server.start()
+        self._use_lookup_table = getattr(
+            settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', False
+        )
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = False
+
+    def tearDown(self):
+        self.server.stop()
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = self._use_lookup_table
+
+    def test_nginx_key_matches_django_key(self):
+        self.assertEqual(
+            nginx_cache_key('example.com', '/a/', 'x=1; pv=v2', key_prefix='ps'),
+            'ps:1:' + get_cache_key('example.com', '/a/', 'v2')
+        )
+        self.assertEqual(
+            nginx_cache_key('example.com', '/a/?b=c'),
+            ':1:' + get_cache_key('example.com', '/a/?b=c')
+        )
+        # The README's original config had $uri, without the query string
+        self.assertEqual(
+            nginx_cache_key(
+                'example.com',
+                '/a/?b=c',
+                key_template='$http_host$uri&pv=$page_version'
+            ),
+            ':1:' + get_cache_key('example.com', '/a/')
+        )
+
+    def test_parse_workload(self):
+        self.assertEqual(
+            list(parse_workload([
+                '/a/', '', '# comment', 'example.com /b/  # b',
+                'https example.com /c/'
+            ])),
+            [
+                ('testserver', '/a/', False),
+                ('example.com', '/b/', False),
+                ('example.com', '/c/', True),
+            ]
+        )
+
+    def test_replay(self):
+        with use_memcache(self.server.location) as conf:
+            self.assertTrue(isinstance(get_nginx_cache(), MemcacheClient))
+            simulator = NginxSimulator(
+                self.server.location, key_prefix=conf.get('KEY_PREFIX', '')
+            )
+            report = run_workload(simulator, [
+                ('testserver', '/cached/1/', False),
+                ('testserver', '/cached/1/', False),
+                ('testserver', '/cached/2/', False),
+                ('testserver', '/cached/1/', True),
+                ('testserver', '/cached/2/?page=2', False),
+                ('testserver', '/cached/2/?page=2', False),
+            ])
+            simulator.close()
+        self.assertEqual(report['requests'], 6)
+        self.assertEqual(report['hits'], 2)
+        self.assertEqual(report['misses'], 4)
+        self.assertEqual(report['renders_avoided'], 2)
+        self.assertEqual(report['errors'], 0)
+        self.assertAlmostEqual(report['hit_ratio'], 2 / 6.0)
+        self.assertFalse(isinstance(get_nginx_cache(), MemcacheClient))
+
+    def test_command(self):
+        import tempfile
+        from StringIO import StringIO
+        workload = tempfile.NamedTemporaryFile(suffix='.txt')
+        workload.write('/cached/1/\n/cached/1/\n')
+        workload.flush()
+        out = StringIO()
+        call_command(
+            'nginx_memcache_loadtest',
+            workload.name,
+            repeat=2,
+            server=self.server.location,
+            stdout=out
+        )
+        self.assertTrue('hit ratio:           75.0%' in out.getvalue())
@@ -0,0 +1,83 @@
+"""Tests for the HTML minifier applied to cached pages"""
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from nginx_memcache import cache as cache_module
+from nginx_memcache.cache import nginx_cache as cache, get_cache_key
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.minify import (
+    minify_html,
+    get_minify_stats,
+    reset_minify_stats
+)
+
+
+class MinifyHTMLTests(TestCase):
+
+    def test_whitespace_collapsed_and_removed_between_tags(self):
+        self.assertEqual(
+            minify_html('  <ul>\n  <li>a   b</li>\n</ul>  '),
+            '<ul><li>a b</li></ul>'
+        )
+
+    def test_preformatted_content_preserved(self):
+        for tag in ('pre', 'textarea', 'script', 'style', 'PRE'):
+            html = '<div>\n <%s class="x">  a\n   b  </%s>\n</div>' % (tag, tag)
+            self.assertEqual(
+                minify_html(html),
+                '<div><%s class="x">  a\n   b  </%s></div>' % (tag, tag)
+            )
+
+    def test_quoted_attribute_values_preserved(self):
+        self.assertEqual(
+            minify_html(
+                '<p>\n<a   title="a  b"\n  data-x=\'c\n d\' >a   b</a></p>'
+            ),
+            '<p><a title="a  b" data-x=\'c\n d\' >a b</a></p>'
+        )
+
+    def test_only_whole_tag_names_preserved(self):
+        self.assertEqual(
+            minify_html('<pre-x>  a  </pre-x><script-foo>  b  </script-foo>'),
+            '<pre-x> a </pre-x><script-foo> b </script-foo>'
+        )
+
+    def test_comments_dropped(self):
+        self.assertEqual(minify_html('<p>a<!-- b\n c -->d</p>'), '<p>ad</p>')
+
+    def test_conditional_and_ssi_comments_kept(self):
+        conditional = '<!--[if IE]><p>IE</p><![endif]-->'
+        revealed = '<!--[if !IE]><!--><p>not IE</p><!--<![endif]-->'
+        ssi = '<!--# include virtual="/_fragment/nav" -->'
+        for comment in (conditional, revealed, ssi):
+            self.assertEqual(minify_html(comment), comment)
+
+    def test_bytes_in_bytes_out(self):
+        minified = minify_html('<p>caf\xc3\xa9   \xc3\xa9t\xc3\xa9</p>')
+        self.assertEqual(minified, '<p>caf\xc3\xa9 \xc3\xa9t\xc3\xa9</p>')
+        self.assertTrue(isinstance(minified, str))
+
+    def test_bytes_saved_recorded(self):
+        reset_minify_stats()
+        minify_html('<p>   </p>')
+        stats = get_minify_stats()
+        self.assertEqual(stats['responses'], 1)
+        self.assertEqual(stats['bytes_saved'], 3)
+
+    def test_cached_page_is_minified(self):
+        setattr(cache_module, 'CACHE_MINIFY_HTML', True)
+        try:
+            request = RequestFactory().get('/')
+            cache.clear()
+            my_view_cached = cache_page_nginx(
+                lambda request: HttpResponse('<p>\n  a  </p>\n')
+            )
+            my_view_cached(request)
+            self.assertEqual(
+                cache.get(get_cache_key(request.get_host(), request.path)),
+                '<p> a </p>'
+            )
+        finally:
+            setattr(cache_module, 'CACHE_MINIFY_HTML', False)
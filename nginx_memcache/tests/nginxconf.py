@@ -0,0 +1,156 @@
+"""Tests for the nginx config generator and key parity checks"""
+
+from StringIO import StringIO
+
+import django
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase
+from django.conf import settings
+
+from nginx_memcache.cache import get_cache_key
+from nginx_memcache.nginxconf import (
+    KEY_TEMPLATE,
+    check_key_parity,
+    django_cache_key,
+    nginx_cache_key,
+    multi_server_aliases,
+    nginx_uri,
+    server_config,
+    upstream_map
+)
+
+
+class NginxConfigTests(TestCase):
+
+    def tearDown(self):
+        for name in ('CACHE_NGINX_COOKIE', 'CACHE_NGINX_INCLUDE_HTTPS'):
+            if hasattr(settings, name):
+                delattr(settings, name)
+
+    def test_nginx_uri(self):
+        self.assertEqual(nginx_uri('/a/?b=c'), '/a/')
+        self.assertEqual(nginx_uri('/caf%C3%A9/'), '/caf\xc3\xa9/')
+        self.assertEqual(nginx_uri('//a/./b/../c/'), '/a/c/')
+
+    def test_keys_match(self):
+        self.assertEqual(check_key_parity(), [])
+        self.assertEqual(
+            django_cache_key('example.com', '/caf%C3%A9/?q=1', 'pv=members'),
+            nginx_cache_key(
+                'example.com',
+                '/caf%C3%A9/?q=1',
+                'pv=members',
+                key_prefix='ps'
+            )
+        )
+
+    def test_keys_match_with_another_cookie(self):
+        settings.CACHE_NGINX_COOKIE = 'variant'
+        self.assertEqual(check_key_parity(), [])
+        self.assertEqual(
+            nginx_cache_key('example.com', '/', 'pv=x; variant=y', 'variant'),
+            ':1:' + get_cache_key('example.com', '/', 'y', 'variant')
+        )
+
+    def test_page_version_cookie_is_matched_by_whole_name(self):
+        self.assertEqual(
+            nginx_cache_key('example.com', '/', 'xpv=other'),
+            ':1:' + get_cache_key('example.com', '/')
+        )
+        self.assertEqual(
+            nginx_cache_key('example.com', '/', 'xpv=other; pv=members'),
+            ':1:' + get_cache_key('example.com', '/', 'members')
+        )
+
+    def test_mismatches_are_reported(self):
+        # The set_md5 line the README used to suggest ignores query strings
+        samples = [
+            ('example.com', '/news/', ''),
+            ('example.com', '/news/?page=2', ''),
+        ]
+        mismatches = check_key_parity(
+            samples, key_template='$http_host$uri&pv=$page_version'
+        )
+        self.assertEqual([sample for sample, _, _ in mismatches], samples[1:])
+        # nginx normalises the path; Django doesn't
+        mismatches = check_key_parity([('example.com', '//news/./', '')])
+        self.assertEqual(len(mismatches), 1)
+        self.assertTrue(mismatches[0][2].endswith(
+            ' (nginx normalises the path to /news/, so this page is never '
+            'served from the cache)'
+        ))
+
+    def test_server_config(self):
+        config = server_config('127.0.0.1:9000')
+        self.assertIn('proxy_pass http://127.0.0.1:9000;', config)
+        self.assertIn('set_md5 $hash_key "%s";' % (KEY_TEMPLATE % 'pv'), config)
+        self.assertIn('set $memcached_key "ps:1:$hash_key";', config)
+        self.assertIn('memcached_pass 127.0.0.1:11211;', config)
+        self.assertIn('error_page 404 502 504 = @django;', config)
+        self.assertNotIn('$https', config)
+
+    def test_server_config_with_several_servers(self):
+        caches = settings.CACHES
+        settings.CACHES = dict(caches, default=dict(
+            caches['default'], LOCATION='10.0.0.1:11211;10.0.0.2:11211'
+        ))
+        try:
+            self.assertEqual(multi_server_aliases(), ['default'])
+            config = server_config()
+            # Routed, the upstream map warns instead - just once
+            settings.CACHE_NGINX_ALIAS_ROUTES = {'example.com': 'default'}
+            self.assertEqual(multi_server_aliases(), ['default'])
+            self.assertEqual(multi_server_aliases(routed=False), [])
+            self.assertNotIn('WARNING', server_config())
+            self.assertEqual(upstream_map().count('# NB: '), 1)
+        finally:
+            settings.CACHES = caches
+            del settings.CACHE_NGINX_ALIAS_ROUTES
+        self.assertIn(
+            '# WARNING: more than one memcache server in cache alias(es) '
+            'default, but nginx',
+            config
+        )
+        self.assertEqual(multi_server_aliases(), [])
+        self.assertNotIn('WARNING', server_config())
+
+    def test_server_config_without_https(self):
+        settings.CACHE_NGINX_INCLUDE_HTTPS = False
+        config = server_config()
+        self.assertIn('if ($https ~* ^on$) {', config)
+        self.assertIn('if ($http_x_forwarded_proto ~* ^HTTPS$) {', config)
+
+    def test_command(self):
+        output = StringIO()
+        call_command('nginx_memcache_config', stdout=output)
+        self.assertIn('location @memcache_check {', output.getvalue())
+
+        output = StringIO()
+        call_command(
+            'nginx_memcache_config',
+            'example.com/a/?b=c',
+            check=True,
+            stdout=output
+        )
+        self.assertEqual(
+            output.getvalue(), 'nginx and Django agree on all 1 cache keys\n'
+        )
+        # Django 1.4 reports the CommandError and exits; later versions
+        # raise it
+        if django.VERSION < (1, 5):
+            expected = SystemExit
+        else:
+            expected = CommandError
+        self.assertRaises(
+            expected,
+            call_command,
+            'nginx_memcache_config',
+            'example.com//a/',
+            check=True,
+            stdout=StringIO(),
+            stderr=StringIO()
+        )
+        self.assertEqual(
+            len(check_key_parity([('example.com', '//a/', '')])), 1
+        )
@@ -0,0 +1,135 @@
+"""Tests for pinning high-value pages into a memcache pool of their own"""
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.admission import reset_admission
+from nginx_memcache.cache import (
+    bulk_invalidate,
+    get_cache_key,
+    get_cached_page,
+    get_nginx_cache,
+    invalidate,
+    invalidate_many,
+    reset_nginx_cache
+)
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.nginxconf import server_config
+from nginx_memcache.pinning import get_page_aliases, is_pinned
+from nginx_memcache.reconcile import reconcile_lookup_table
+
+
+class PinnedPageTests(TestCase):
+
+    def setUp(self):
+        self._caches = settings.CACHES
+        settings.CACHES = dict(self._caches, pinned={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'pinned',
+            'KEY_PREFIX': 'pin',
+        })
+        settings.CACHE_NGINX_PINNED_ALIAS = 'pinned'
+        settings.CACHE_NGINX_PINNED_URLS = [r'^/$', r'^/news/$']
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = True
+        reset_nginx_cache()
+        self.general = get_nginx_cache('default')
+        self.pinned = get_nginx_cache('pinned')
+        self.general.clear()
+        self.pinned.clear()
+        self.timeouts = []
+        original_set = self.pinned.set
+
+        def set(key, value, timeout=None, **kwargs):
+            self.timeouts.append(timeout)
+            return original_set(key, value, timeout, **kwargs)
+        self.pinned.set = set
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        settings.CACHES = self._caches
+        for name in (
+            'CACHE_NGINX_PINNED_ALIAS',
+            'CACHE_NGINX_PINNED_URLS',
+            'CACHE_NGINX_PINNED_TIME',
+            'CACHE_NGINX_ADMISSION_THRESHOLD',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        reset_admission()
+        reset_nginx_cache()
+
+    def get(self, path, pinned=None):
+        request = self.factory.get(path, HTTP_HOST='example.com')
+        request.user = AnonymousUser()
+
+        @cache_page_nginx(pinned=pinned)
+        def view(request):
+            return HttpResponse('content of %s' % path)
+        view(request)
+        return get_cache_key('example.com', path)
+
+    def test_is_pinned(self):
+        self.assertTrue(is_pinned('/'))
+        self.assertTrue(is_pinned('/news/'))
+        self.assertFalse(is_pinned('/news/?page=2'))
+        self.assertFalse(is_pinned('/', pinned=False))
+        self.assertTrue(is_pinned('/story/', pinned=True))
+        del settings.CACHE_NGINX_PINNED_ALIAS
+        self.assertFalse(is_pinned('/', pinned=True))
+        self.assertEqual(get_page_aliases('example.com'), ['default'])
+
+    def test_pinned_pages_go_in_the_pinned_pool(self):
+        home = self.get('/')
+        story = self.get('/story/')
+        section = self.get('/section/', pinned=True)
+        self.assertEqual(self.pinned.get(home), 'content of /')
+        self.assertEqual(self.general.get(home), None)
+        self.assertEqual(self.general.get(story), 'content of /story/')
+        self.assertEqual(self.pinned.get(story), None)
+        self.assertEqual(self.pinned.get(section), 'content of /section/')
+
+    def test_pinned_pages_have_their_own_timeout(self):
+        settings.CACHE_NGINX_PINNED_TIME = 60
+        settings.CACHE_NGINX_ADMISSION_THRESHOLD = 3
+        home = self.get('/')
+        # Not held back by the admission filter, either
+        self.assertEqual(self.pinned.get(home), 'content of /')
+        self.assertEqual(self.timeouts, [60])
+        self.assertEqual(self.general.get(self.get('/story/')), None)
+
+    def test_pinned_pages_are_read_and_invalidated(self):
+        home = self.get('/')
+        section = self.get('/section/', pinned=True)
+        request = self.factory.get('/', HTTP_HOST='example.com')
+        self.assertEqual(get_cached_page(request), 'content of /')
+
+        invalidate('example.com', '/')
+        self.assertEqual(self.pinned.get(home), None)
+        # The URL rules don't know it's pinned, but it's deleted anyway
+        invalidate_many([('example.com', '/section/')])
+        self.assertEqual(self.pinned.get(section), None)
+
+        home = self.get('/')
+        story = self.get('/story/')
+        bulk_invalidate('example.com')
+        self.assertEqual(self.pinned.get(home), None)
+        self.assertEqual(self.general.get(story), None)
+
+    def test_reconcile_finds_pinned_pages(self):
+        self.get('/')
+        self.get('/story/')
+        self.general.clear()
+        totals = reconcile_lookup_table()
+        self.assertEqual((totals['checked'], totals['removed']), (2, 1))
+
+    def test_server_config_looks_in_the_pinned_pool_first(self):
+        config = server_config()
+        pinned = config.index('location @memcache_check {')
+        general = config.index('location @memcache_general {')
+        self.assertTrue(pinned < general)
+        self.assertIn('set $memcached_key "pin:1:$hash_key";', config)
+        self.assertIn('error_page 404 502 504 = @memcache_general;', config)
+        self.assertIn('error_page 404 502 504 = @django;', config)
@@ -0,0 +1,118 @@
+"""Tests for Django serving cached pages itself, when nginx didn't"""
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    get_cache_key,
+    get_cached_page,
+    nginx_cache as cache
+)
+from nginx_memcache.decorators import cache_page_nginx
+
+
+class ReadThroughTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+        self.renders = 0
+        settings.CACHE_NGINX_READ_THROUGH = True
+
+    def tearDown(self):
+        if hasattr(settings, 'CACHE_NGINX_READ_THROUGH'):
+            del settings.CACHE_NGINX_READ_THROUGH
+        if hasattr(settings, 'CACHE_NGINX_INCLUDE_HTTPS'):
+            del settings.CACHE_NGINX_INCLUDE_HTTPS
+
+    def my_view(self, request):
+        self.renders += 1
+        return HttpResponse('content %d' % self.renders)
+
+    def get(self, path='/', **extra):
+        request = self.factory.get(path, **extra)
+        request.user = AnonymousUser()
+        return request
+
+    def test_second_request_served_from_cache(self):
+        view = cache_page_nginx(self.my_view)
+        first = view(self.get())
+        second = view(self.get())
+        self.assertEqual(self.renders, 1)
+        self.assertEqual(second.content, first.content)
+        self.assertEqual(second['X-Nginx-Memcache'], 'django-hit')
+        self.assertFalse(first.has_header('X-Nginx-Memcache'))
+
+    def test_content_type(self):
+        view = cache_page_nginx(self.my_view)
+        view(self.get())
+        self.assertEqual(
+            view(self.get())['Content-Type'], 'text/html; charset=utf-8'
+        )
+        view = cache_page_nginx(self.my_view, content_type='application/json')
+        self.assertEqual(
+            view(self.get())['Content-Type'], 'application/json'
+        )
+
+    def test_off_unless_asked_for(self):
+        del settings.CACHE_NGINX_READ_THROUGH
+        view = cache_page_nginx(self.my_view)
+        view(self.get())
+        view(self.get())
+        self.assertEqual(self.renders, 2)
+
+        view = cache_page_nginx(self.my_view, read_through=True)
+        view(self.get())
+        self.assertEqual(self.renders, 2)
+
+    def test_decorator_can_turn_it_off(self):
+        view = cache_page_nginx(self.my_view, read_through=False)
+        view(self.get())
+        view(self.get())
+        self.assertEqual(self.renders, 2)
+
+    def test_respects_page_version(self):
+        view = cache_page_nginx(
+            self.my_view,
+            page_version_fn=lambda request: request.GET.get('v', '')
+        )
+        view(self.get('/'))
+        cache.set(get_cache_key('testserver', '/?v=2', '2'), 'version 2')
+        self.assertEqual(view(self.get('/?v=2')).content, 'version 2')
+        self.assertEqual(self.renders, 1)
+
+    def test_authenticated_users_not_served_when_anonymous_only(self):
+        view = cache_page_nginx(self.my_view, anonymous_only=True)
+        view(self.get())
+        request = self.get()
+        request.user = User(username='someone')
+        view(request)
+        self.assertEqual(self.renders, 2)
+
+    def test_https_not_served_http_copy(self):
+        settings.CACHE_NGINX_INCLUDE_HTTPS = False
+        view = cache_page_nginx(self.my_view)
+        view(self.get())
+        response = view(self.get(HTTP_X_FORWARDED_PROTO='https'))
+        self.assertEqual(self.renders, 2)
+        self.assertFalse(response.has_header('X-Nginx-Memcache'))
+        # ...but HTTP requests still are
+        view(self.get())
+        self.assertEqual(self.renders, 2)
+
+    def test_only_get_and_head(self):
+        view = cache_page_nginx(self.my_view)
+        view(self.get())
+        request = self.factory.post('/')
+        request.user = AnonymousUser()
+        view(request)
+        self.assertEqual(self.renders, 2)
+
+    def test_get_cached_page(self):
+        request = self.get()
+        self.assertEqual(get_cached_page(request), None)
+        cache.set(get_cache_key('testserver', '/'), 'cached')
+        self.assertEqual(get_cached_page(request), 'cached')
@@ -0,0 +1,139 @@
+"""Tests for reconciling the lookup table with memcache"""
+
+from django.core.management import call_command
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    get_cache_key,
+    get_nginx_cache,
+    nginx_cache as cache
+)
+from nginx_memcache.client import UnsupportedCommand
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.harness import use_memcache
+from nginx_memcache.localmemcache import (
+    LocalMemcacheServer,
+    MemcacheRequestHandler
+)
+from nginx_memcache.models import CachedPageRecord, CachedPageTag
+from nginx_memcache.reconcile import live_keys, reconcile_lookup_table
+from nginx_memcache.stale import get_stale_key
+
+
+class OldMemcacheRequestHandler(MemcacheRequestHandler):
+    # As memcached before 1.6
+    do_mg = None
+
+
+class ReconcileTests(TestCase):
+
+    def setUp(self):
+        setattr(settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', True)
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def cache_pages(self, count, host='example1.com'):
+        keys = []
+        for i in range(count):
+            request = self.factory.get('/%d/' % i, SERVER_NAME=host)
+            cache_page_nginx(self.my_view, tags=['t'])(request)
+            keys.append(get_cache_key(host, '/%d/' % i))
+        return keys
+
+    def expire(self, keys):
+        for key in keys:
+            get_nginx_cache().delete(key)
+
+    def test_dead_records_removed(self):
+        keys = self.cache_pages(5)
+        self.expire(keys[:3])
+        totals = reconcile_lookup_table(chunk_size=2)
+        self.assertEqual(totals, {
+            'checked': 5, 'dead': 3, 'removed': 3, 'skipped': 0
+        })
+        self.assertEqual(
+            sorted(CachedPageRecord.objects.values_list('pk', flat=True)),
+            sorted(keys[3:])
+        )
+        self.assertEqual(CachedPageTag.objects.count(), 2)
+
+    def test_dry_run(self):
+        keys = self.cache_pages(3)
+        self.expire(keys)
+        totals = reconcile_lookup_table(dry_run=True)
+        self.assertEqual(totals, {
+            'checked': 3, 'dead': 3, 'removed': 0, 'skipped': 0
+        })
+        self.assertEqual(CachedPageRecord.objects.count(), 3)
+
+    def test_one_identifier_only(self):
+        keys = self.cache_pages(2) + self.cache_pages(2, 'example2.com')
+        self.expire(keys)
+        reconcile_lookup_table(lookup_identifier='example2.com')
+        self.assertEqual(
+            sorted(CachedPageRecord.objects.values_list('pk', flat=True)),
+            sorted(keys[:2])
+        )
+
+    def test_stale_copies_keep_records(self):
+        keys = self.cache_pages(2)
+        self.expire(keys)
+        get_nginx_cache().set(get_stale_key(keys[0]), 'stale')
+        self.assertEqual(live_keys(get_nginx_cache(), keys), set(keys[:1]))
+        reconcile_lookup_table()
+        self.assertEqual(CachedPageRecord.objects.count(), 1)
+
+    def test_command(self):
+        from StringIO import StringIO
+        keys = self.cache_pages(2)
+        self.expire(keys[:1])
+        out = StringIO()
+        call_command('nginx_memcache_reconcile', pause=0.01, stdout=out)
+        self.assertEqual(
+            out.getvalue(), "Checked 2 records: 1 dead, 1 removed\n"
+        )
+
+    def test_memcache_down(self):
+        keys = self.cache_pages(3)
+        client = get_nginx_cache()
+        # As Django's memcached backends behave with no server to talk to
+        client.get_many = lambda keys: {}
+        client.get = lambda key, default=None: default
+        client.set = lambda key, value, timeout=None: None
+        try:
+            totals = reconcile_lookup_table(chunk_size=2)
+        finally:
+            del client.get_many, client.get, client.set
+        self.assertEqual(totals, {
+            'checked': 0, 'dead': 0, 'removed': 0, 'skipped': 3
+        })
+        self.assertEqual(CachedPageRecord.objects.count(), 3)
+
+        # Whereas pages that really have all gone are removed
+        self.expire(keys)
+        self.assertEqual(reconcile_lookup_table()['removed'], 3)
+
+    def test_meta_probe(self):
+        server = LocalMemcacheServer()
+        server.start()
+        try:
+            with use_memcache(server.location):
+                keys = self.cache_pages(3)
+                client = get_nginx_cache()
+                self.expire(keys[:1])
+                self.assertEqual(client.exists_many(keys), set(keys[1:]))
+                self.assertEqual(live_keys(client, keys), set(keys[1:]))
+
+                server.RequestHandlerClass = OldMemcacheRequestHandler
+                client.disconnect_all()
+                self.assertRaises(UnsupportedCommand, client.exists_many, keys)
+                # Falls back to get_many
+                self.assertEqual(live_keys(client, keys), set(keys[1:]))
+        finally:
+            server.stop()
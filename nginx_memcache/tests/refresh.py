@@ -0,0 +1,157 @@
+"""Tests for refreshing cached pages rather than deleting them"""
+
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.admission import reset_admission
+from nginx_memcache.cache import (
+    bulk_invalidate,
+    get_cache_key,
+    invalidate,
+    invalidate_tags,
+    nginx_cache as cache
+)
+from nginx_memcache.models import CachedPageRecord
+from nginx_memcache.refresh import refresh_page
+from nginx_memcache.signals import invalidate_single_page
+from nginx_memcache.stale import get_stale_key
+from nginx_memcache.tests.urls import editable_page, page_contents
+
+
+class RefreshTests(TestCase):
+
+    urls = 'nginx_memcache.tests.urls'
+
+    def setUp(self):
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = True
+        settings.CACHE_NGINX_REFRESH_WORKERS = 1
+        cache.clear()
+        page_contents.clear()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        page_contents.clear()
+        for name in (
+            'CACHE_NGINX_REFRESH',
+            'CACHE_NGINX_REFRESH_WORKERS',
+            'CACHE_NGINX_READ_THROUGH',
+            'CACHE_NGINX_ADMISSION_THRESHOLD',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        reset_admission()
+
+    def cache_page(self, slug, content, page_version='', query=''):
+        page_contents[slug] = content
+        path = '/editable/%s/%s' % (slug, query)
+        request = self.factory.get(
+            path,
+            HTTP_HOST='example.com',
+            HTTP_COOKIE='pv=%s' % page_version
+        )
+        request.user = AnonymousUser()
+        editable_page(request, slug)
+        cache_key = get_cache_key('example.com', path, page_version)
+        self.assertEqual(cache.get(cache_key), content)
+        return path, cache_key
+
+    def test_lookup_table_records_url(self):
+        path, cache_key = self.cache_page('a', 'A', 'members', '?page=2')
+        record = CachedPageRecord.objects.get(pk=cache_key)
+        self.assertEqual(record.request_host, 'example.com')
+        self.assertEqual(record.request_path, '/editable/a/?page=2')
+        self.assertEqual(record.page_version, 'members')
+
+    def test_invalidate_refreshes(self):
+        path, cache_key = self.cache_page('a', 'old', 'members', '?page=2')
+        page_contents['a'] = 'new'
+        invalidate('example.com', path, 'members', refresh=True)
+        self.assertEqual(cache.get(cache_key), 'new')
+
+    def test_refresh_setting(self):
+        path, cache_key = self.cache_page('a', 'old')
+        page_contents['a'] = 'new'
+        invalidate('example.com', path)
+        self.assertEqual(cache.get(cache_key), None)
+
+        self.cache_page('a', 'old')
+        page_contents['a'] = 'new'
+        settings.CACHE_NGINX_REFRESH = True
+        invalidate_single_page.send(
+            sender=self,
+            request_host='example.com',
+            request_path=path
+        )
+        self.assertEqual(cache.get(cache_key), 'new')
+
+    def test_failed_refresh_deletes(self):
+        path, cache_key = self.cache_page('a', 'old')
+        del page_contents['a']  # the view now 404s
+        self.assertFalse(refresh_page('example.com', path))
+        self.assertEqual(cache.get(cache_key), None)
+
+        # Nor is there a view for this
+        cache.set(get_cache_key('example.com', '/gone/'), 'old')
+        self.assertFalse(refresh_page('example.com', '/gone/'))
+        self.assertEqual(cache.get(get_cache_key('example.com', '/gone/')), None)
+
+    def test_refresh_under_another_key_deletes(self):
+        # Cached for a page version the view no longer gives it
+        cache_key = get_cache_key(
+            'example.com', '/editable/a/', 'old-version', 'version'
+        )
+        cache.set(cache_key, 'old')
+        cache.set(get_stale_key(cache_key), 'old')
+        page_contents['a'] = 'new'
+        self.assertFalse(refresh_page(
+            'example.com',
+            '/editable/a/',
+            'old-version',
+            cookie_name='version',
+            include_stale=True
+        ))
+        self.assertEqual(cache.get(cache_key), None)
+        self.assertEqual(cache.get(get_stale_key(cache_key)), None)
+
+    def test_refresh_skips_read_through_and_admission(self):
+        path, cache_key = self.cache_page('a', 'old')
+        settings.CACHE_NGINX_READ_THROUGH = True
+        settings.CACHE_NGINX_ADMISSION_THRESHOLD = 100
+        page_contents['a'] = 'new'
+        self.assertTrue(refresh_page('example.com', path))
+        self.assertEqual(cache.get(cache_key), 'new')
+
+    def test_bulk_invalidate_refreshes(self):
+        path_a, key_a = self.cache_page('a', 'old a')
+        path_b, key_b = self.cache_page('b', 'old b', 'members')
+        path_c, key_c = self.cache_page('c', 'old c')
+        # Recorded before the lookup table kept URLs
+        CachedPageRecord.objects.filter(pk=key_c).update(request_path=None)
+        page_contents.update({'a': 'new a', 'b': 'new b', 'c': 'new c'})
+
+        bulk_invalidate('example.com', refresh=True)
+        self.assertEqual(cache.get(key_a), 'new a')
+        self.assertEqual(cache.get(key_b), 'new b')
+        self.assertEqual(cache.get(key_c), None)
+
+    def test_bulk_refresh_in_worker_threads(self):
+        keys = [self.cache_page(slug, 'old')[1] for slug in 'abcdef']
+        for slug in 'abcdef':
+            page_contents[slug] = 'new ' + slug
+        settings.CACHE_NGINX_REFRESH_WORKERS = 3
+        # The workers can't see the test database
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = False
+        bulk_invalidate('example.com', refresh=True)
+        self.assertEqual(
+            [cache.get(key) for key in keys],
+            ['new ' + slug for slug in 'abcdef']
+        )
+
+    def test_invalidate_tags_refreshes(self):
+        path, cache_key = self.cache_page('a', 'old')
+        CachedPageRecord.objects.get(pk=cache_key).tags.create(tag='news')
+        page_contents['a'] = 'new'
+        self.assertEqual(invalidate_tags(['news'], refresh=True), 1)
+        self.assertEqual(cache.get(cache_key), 'new')
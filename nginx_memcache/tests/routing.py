@@ -0,0 +1,97 @@
+"""Tests for routing pages to per-site cache aliases"""
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    get_cache_key,
+    get_nginx_cache,
+    reset_nginx_cache,
+    invalidate,
+    bulk_invalidate
+)
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.models import CachedPageRecord
+from nginx_memcache.nginxconf import upstream_map
+from nginx_memcache.routing import get_cache_alias
+
+
+def route_by_prefix(identifier):
+    if identifier.startswith('tenant-'):
+        return 'bigtenant'
+
+
+class CacheAliasRoutingTests(TestCase):
+
+    def setUp(self):
+        self._caches = settings.CACHES
+        settings.CACHES = dict(self._caches, bigtenant={
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'bigtenant',
+            'KEY_PREFIX': 'big',
+        })
+        settings.CACHE_NGINX_ALIAS_ROUTES = {'big.example.com': 'bigtenant'}
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = True
+        reset_nginx_cache()
+
+        self.default_cache = get_nginx_cache('default')
+        self.big_cache = get_nginx_cache('bigtenant')
+        self.default_cache.clear()
+        self.big_cache.clear()
+
+        self.factory = RequestFactory()
+        self.request = self.factory.get('/', SERVER_NAME="big.example.com")
+        self.cache_key = get_cache_key(
+            self.request.get_host(),
+            self.request.get_full_path()
+        )
+
+    def tearDown(self):
+        settings.CACHES = self._caches
+        del settings.CACHE_NGINX_ALIAS_ROUTES
+        if hasattr(settings, 'CACHE_NGINX_ROUTER'):
+            del settings.CACHE_NGINX_ROUTER
+        reset_nginx_cache()
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def test_alias_lookup(self):
+        self.assertEqual(get_cache_alias('big.example.com'), 'bigtenant')
+        self.assertEqual(get_cache_alias('BIG.example.com:8000'), 'bigtenant')
+        self.assertEqual(get_cache_alias('small.example.com'), 'default')
+        self.assertEqual(get_cache_alias(None), 'default')
+
+    def test_router_function_consulted_first(self):
+        settings.CACHE_NGINX_ROUTER = (
+            'nginx_memcache.tests.routing.route_by_prefix'
+        )
+        self.assertEqual(get_cache_alias('tenant-42'), 'bigtenant')
+        self.assertEqual(get_cache_alias('big.example.com'), 'bigtenant')
+        self.assertEqual(get_cache_alias('other'), 'default')
+
+    def test_page_cached_and_invalidated_in_routed_alias(self):
+        cache_page_nginx(self.my_view)(self.request)
+        self.assertEqual(self.big_cache.get(self.cache_key), 'content')
+        self.assertEqual(self.default_cache.get(self.cache_key), None)
+
+        invalidate('big.example.com', '/')
+        self.assertEqual(self.big_cache.get(self.cache_key), None)
+
+    def test_bulk_invalidation_and_memcached_key_use_routed_alias(self):
+        cache_page_nginx(self.my_view)(self.request)
+        record = CachedPageRecord.objects.get()
+        self.assertEqual(record.memcached_key, 'big:1:%s' % self.cache_key)
+
+        bulk_invalidate('big.example.com')
+        self.assertEqual(self.big_cache.get(self.cache_key), None)
+
+    def test_nginx_upstream_map(self):
+        config = upstream_map()
+        self.assertTrue('upstream nginx_memcache_bigtenant {' in config)
+        self.assertTrue(
+            '    big.example.com nginx_memcache_bigtenant;' in config
+        )
+        self.assertTrue('    big.example.com big;' in config)
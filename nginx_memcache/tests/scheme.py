@@ -0,0 +1,144 @@
+"""Tests for cacheing HTTP and HTTPS pages under keys of their own"""
+
+from django.contrib.auth.models import AnonymousUser
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    get_cache_key,
+    get_cached_page,
+    invalidate,
+    invalidate_many,
+    nginx_cache as cache
+)
+from nginx_memcache.nginxconf import (
+    KEY_TEMPLATE,
+    SCHEME_KEY_TEMPLATE,
+    check_key_parity,
+    expand_samples,
+    server_config
+)
+from nginx_memcache.refresh import refresh_page
+from nginx_memcache.tests.urls import editable_page, page_contents
+
+
+class SchemeKeyTests(TestCase):
+
+    urls = 'nginx_memcache.tests.urls'
+
+    def setUp(self):
+        settings.CACHE_NGINX_KEY_INCLUDES_SCHEME = True
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = False
+        cache.clear()
+        page_contents.clear()
+        self.factory = RequestFactory()
+
+    def tearDown(self):
+        page_contents.clear()
+        for name in (
+            'CACHE_NGINX_KEY_INCLUDES_SCHEME',
+            'CACHE_NGINX_ALTERNATIVE_SSL_HEADERS',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+
+    def request(self, path, secure=False):
+        extra = {'HTTP_HOST': 'example.com'}
+        if secure:
+            # As from a load balancer that terminated SSL
+            extra['HTTP_X_FORWARDED_PROTO'] = 'https'
+        request = self.factory.get(path, **extra)
+        request.user = AnonymousUser()
+        return request
+
+    def keys(self, path):
+        return (
+            get_cache_key('example.com', path, scheme='http'),
+            get_cache_key('example.com', path, scheme='https'),
+        )
+
+    def test_keys(self):
+        http_key, https_key = self.keys('/a/')
+        self.assertNotEqual(http_key, https_key)
+        del settings.CACHE_NGINX_KEY_INCLUDES_SCHEME
+        self.assertEqual(*self.keys('/a/'))
+
+    def test_pages_are_cached_apart(self):
+        http_key, https_key = self.keys('/editable/a/')
+        page_contents['a'] = 'over http'
+        editable_page(self.request('/editable/a/'), 'a')
+        page_contents['a'] = 'over https'
+        editable_page(self.request('/editable/a/', secure=True), 'a')
+        self.assertEqual(cache.get(http_key), 'over http')
+        self.assertEqual(cache.get(https_key), 'over https')
+        self.assertEqual(
+            get_cached_page(self.request('/editable/a/', secure=True)),
+            'over https'
+        )
+
+        # Only what CACHE_NGINX_ALTERNATIVE_SSL_HEADERS says means HTTPS
+        settings.CACHE_NGINX_ALTERNATIVE_SSL_HEADERS = (
+            ('X-Forwarded-SSL', 'on'),
+        )
+        self.assertEqual(
+            get_cached_page(self.request('/editable/a/', secure=True)),
+            'over http'
+        )
+
+    def test_invalidate_both_schemes(self):
+        http_key, https_key = self.keys('/a/')
+        cache.set(http_key, 'http')
+        cache.set(https_key, 'https')
+        invalidate('example.com', '/a/', scheme='https')
+        self.assertEqual(cache.get(http_key), 'http')
+        self.assertEqual(cache.get(https_key), None)
+
+        cache.set(https_key, 'https')
+        invalidate('example.com', '/a/')
+        self.assertEqual(cache.get(http_key), None)
+        self.assertEqual(cache.get(https_key), None)
+
+        cache.set(http_key, 'http')
+        cache.set(https_key, 'https')
+        self.assertEqual(invalidate_many([('example.com', '/a/')]), 1)
+        self.assertEqual(cache.get(http_key), None)
+        self.assertEqual(cache.get(https_key), None)
+
+    def test_refresh_both_schemes(self):
+        http_key, https_key = self.keys('/editable/a/')
+        cache.set(http_key, 'old')
+        cache.set(https_key, 'old')
+        page_contents['a'] = 'new'
+        self.assertTrue(refresh_page('example.com', '/editable/a/'))
+        self.assertEqual(cache.get(http_key), 'new')
+        self.assertEqual(cache.get(https_key), 'new')
+
+    def test_nginx_config(self):
+        config = server_config()
+        self.assertIn('set $cache_scheme $scheme;', config)
+        self.assertIn('if ($http_x_forwarded_proto ~* ^HTTPS$) {', config)
+        self.assertIn('        set $cache_scheme https;', config)
+        self.assertIn(
+            'set_md5 $hash_key "%s";' % (SCHEME_KEY_TEMPLATE % 'pv'), config
+        )
+        # HTTPS requests are looked up too, rather than sent to Django
+        self.assertNotIn('if ($https ~* ^on$) {\n        return 419;', config)
+
+    def test_key_parity(self):
+        samples = expand_samples([
+            ('example.com', '/', ''),
+            ('example.com', '/', '', 'https'),
+        ])
+        self.assertEqual(samples, [
+            ('example.com', '/', '', 'http'),
+            ('example.com', '/', '', 'https'),
+            ('example.com', '/', '', 'https'),
+        ])
+        self.assertEqual(check_key_parity(), [])
+        # A config without the scheme in its key gets every page wrong
+        mismatches = check_key_parity(key_template=KEY_TEMPLATE % 'pv')
+        self.assertEqual(
+            set(sample[3] for sample, _, _ in mismatches),
+            set(['http', 'https'])
+        )
@@ -0,0 +1,161 @@
+"""Tests for invalidating pages in waves"""
+
+import time
+from StringIO import StringIO
+
+from django.core.management import call_command
+from django.db import DEFAULT_DB_ALIAS, connections
+from django.test import TestCase
+from django.conf import settings
+
+from nginx_memcache.admission import get_sketch, reset_admission
+from nginx_memcache.cache import (
+    add_key_to_lookup,
+    bulk_invalidate,
+    nginx_cache as cache
+)
+from nginx_memcache.models import CachedPageRecord
+from nginx_memcache.signals import invalidate_many_pages
+from nginx_memcache.staggered import (
+    InvalidationJob,
+    get_job,
+    get_jobs,
+    order_keys,
+    staggered_invalidate
+)
+
+
+class StaggeredInvalidationTests(TestCase):
+
+    def setUp(self):
+        # Jobs read the lookup table from threads of their own, which have
+        # to share the test's (in-memory) database
+        test_connection = connections[DEFAULT_DB_ALIAS]
+        test_connection.allow_thread_sharing = True
+        self._run = run = InvalidationJob.run
+
+        def shared_run(job):
+            connections[DEFAULT_DB_ALIAS] = test_connection
+            return run(job)
+        InvalidationJob.run = shared_run
+        cache.clear()
+        reset_admission()
+        settings.CACHE_NGINX_INVALIDATION_WAVE_INTERVAL = 0.01
+        self.keys = ['%032d' % number for number in range(10)]
+        for key in self.keys:
+            cache.set(key, 'content')
+            add_key_to_lookup(key, 'example.com', None)
+
+    def tearDown(self):
+        for name in (
+            'CACHE_NGINX_INVALIDATION_RATE',
+            'CACHE_NGINX_INVALIDATION_WAVE_INTERVAL',
+            'CACHE_NGINX_REFRESH',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        reset_admission()
+        InvalidationJob.run = self._run
+        connections[DEFAULT_DB_ALIAS].allow_thread_sharing = False
+
+    def cached(self):
+        return sorted(cache.get_many(self.keys))
+
+    def test_waves(self):
+        job = bulk_invalidate('example.com', rate=300)
+        self.assertEqual(job.wave_size, 3)
+        job.join(5)
+        self.assertEqual(self.cached(), [])
+        progress = job.progress()
+        self.assertEqual(progress['state'], 'finished')
+        self.assertEqual(progress['total'], 10)
+        self.assertEqual(progress['invalidated'], 10)
+        self.assertEqual(progress['waves'], 4)
+        self.assertEqual(progress['eta'], None)
+        self.assertTrue(get_job(job.id) is job)
+        self.assertTrue(job in get_jobs())
+
+    def test_rate_setting_and_signal(self):
+        settings.CACHE_NGINX_INVALIDATION_RATE = 1000
+        invalidate_many_pages.send(
+            sender=self, lookup_identifier='example.com'
+        )
+        get_jobs()[-1].join(5)
+        self.assertEqual(self.cached(), [])
+
+    def test_rate_wins_over_refresh_setting(self):
+        settings.CACHE_NGINX_REFRESH = True
+        job = bulk_invalidate('example.com', rate=1000)
+        job.join(5)
+        self.assertEqual(self.cached(), [])
+
+    def test_without_rate_is_all_at_once(self):
+        self.assertEqual(bulk_invalidate('example.com'), None)
+        self.assertEqual(self.cached(), [])
+
+    def test_cancel(self):
+        job = InvalidationJob(
+            self.keys, 'example.com', rate=0.4, wave_interval=5
+        )
+        self.assertEqual(job.wave_size, 2)
+        job.start()
+        job.cancel()
+        job.join(5)
+        self.assertEqual(job.state, 'cancelled')
+        # Only the first wave went
+        self.assertEqual(job.invalidated, 10 - len(self.cached()))
+        self.assertTrue(job.invalidated <= 2)
+
+    def test_rate_under_a_key_a_wave(self):
+        job = InvalidationJob(
+            self.keys, 'example.com', rate=0.2, wave_interval=1
+        )
+        # Waves are spread out, rather than sent faster than the rate
+        self.assertEqual(job.wave_size, 1)
+        self.assertEqual(job.wave_interval, 5)
+
+    def test_popular_first(self):
+        sketch = get_sketch()
+        for _ in range(3):
+            sketch.increment(self.keys[7])
+        sketch.increment(self.keys[4])
+        self.assertEqual(
+            order_keys(self.keys, 'popular')[:3],
+            [self.keys[7], self.keys[4], self.keys[0]]
+        )
+        self.assertEqual(order_keys(self.keys), self.keys)
+        self.assertRaises(ValueError, order_keys, self.keys, 'random')
+
+        settings.CACHE_NGINX_INVALIDATION_WAVE_INTERVAL = 5
+        job = staggered_invalidate(
+            CachedPageRecord.objects.all(),
+            'example.com',
+            rate=0.2,
+            order='popular'
+        )
+        for _ in range(500):
+            if job.invalidated:
+                break
+            time.sleep(0.01)
+        job.cancel()
+        job.join(5)
+        self.assertEqual(job.invalidated, 1)
+        self.assertEqual(set(self.keys) - set(self.cached()), set([
+            self.keys[7]
+        ]))
+
+    def test_command(self):
+        # Even where pages are usually refreshed
+        settings.CACHE_NGINX_REFRESH = True
+        output = StringIO()
+        call_command(
+            'nginx_memcache_invalidate',
+            'example.com',
+            rate=1000,
+            stdout=output
+        )
+        self.assertEqual(self.cached(), [])
+        self.assertEqual(
+            output.getvalue().splitlines()[-1],
+            'finished: 10 of 10 pages invalidated'
+        )
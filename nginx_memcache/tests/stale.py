@@ -0,0 +1,176 @@
+"""Tests for serving stale copies of pages while they're re-rendered"""
+
+import threading
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    get_cache_key,
+    get_nginx_cache,
+    invalidate,
+    nginx_cache as cache
+)
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.stale import get_stale_key, start_revalidation
+from nginx_memcache.tests.urls import page_contents, stale_page
+
+
+def wait_for_revalidation():
+    for thread in threading.enumerate():
+        if thread.name == 'nginx-memcache-revalidate':
+            thread.join(5)
+
+
+class StaleWhileRevalidateTests(TestCase):
+
+    urls = 'nginx_memcache.tests.urls'
+
+    def setUp(self):
+        cache.clear()
+        page_contents.clear()
+        self.factory = RequestFactory()
+        self.renders = 0
+        self.cache_key = get_cache_key('testserver', '/')
+        self.view = cache_page_nginx(self.my_view, max_stale=600)
+        # Re-renders happen in another thread, which can't see the
+        # test database
+        self._use_lookup_table = getattr(
+            settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', False
+        )
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = False
+
+    def tearDown(self):
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = self._use_lookup_table
+        page_contents.clear()
+
+    def my_view(self, request):
+        self.renders += 1
+        return HttpResponse('content %d' % self.renders)
+
+    def get(self, path='/'):
+        request = self.factory.get(path)
+        request.user = AnonymousUser()
+        return request
+
+    def test_stale_copy_kept(self):
+        self.view(self.get())
+        self.assertEqual(cache.get(self.cache_key), 'content 1')
+        self.assertEqual(cache.get(get_stale_key(self.cache_key)), 'content 1')
+
+    def test_no_stale_copy_unless_asked_for(self):
+        cache_page_nginx(self.my_view)(self.get())
+        self.assertEqual(cache.get(get_stale_key(self.cache_key)), None)
+
+    def test_stale_copy_served_and_page_rerendered(self):
+        cache_key = get_cache_key('testserver', '/stale/a/')
+        page_contents['a'] = 'old'
+        stale_page(self.get('/stale/a/'), 'a')
+        invalidate('testserver', '/stale/a/')
+        self.assertEqual(cache.get(cache_key), None)
+
+        page_contents['a'] = 'new'
+        request = self.get('/stale/a/')
+        response = stale_page(request, 'a')
+        self.assertEqual(response.content, 'old')
+        self.assertEqual(response['X-Nginx-Memcache'], 'django-stale')
+
+        wait_for_revalidation()
+        self.assertEqual(cache.get(cache_key), 'new')
+        self.assertEqual(cache.get(get_stale_key(cache_key)), 'new')
+        # Re-rendered from a request of its own, leaving the one served alone
+        self.assertFalse(hasattr(request, 'nginx_memcache_cached_key'))
+
+    def test_fresh_copy_preferred(self):
+        view = cache_page_nginx(self.my_view, max_stale=600, read_through=True)
+        view(self.get())
+        cache.set(self.cache_key, 'fresh')
+        response = view(self.get())
+        self.assertEqual(response.content, 'fresh')
+        self.assertEqual(response['X-Nginx-Memcache'], 'django-hit')
+        self.assertEqual(self.renders, 1)
+
+    def test_one_round_trip_with_read_through(self):
+        view = cache_page_nginx(self.my_view, max_stale=600, read_through=True)
+        view(self.get())
+        invalidate('testserver', '/')
+        client = get_nginx_cache()
+        request_thread = threading.current_thread()
+        calls = []
+        inside = []
+
+        def counting(method):
+            original = getattr(client, method)
+
+            def call(*args, **kwargs):
+                # Not counting the re-render's, or the gets locmem's
+                # get_many makes
+                if threading.current_thread() is not request_thread:
+                    return original(*args, **kwargs)
+                if not inside:
+                    calls.append(method)
+                inside.append(method)
+                try:
+                    return original(*args, **kwargs)
+                finally:
+                    inside.pop()
+            return call
+        client.get = counting('get')
+        client.get_many = counting('get_many')
+        try:
+            response = view(self.get())
+            wait_for_revalidation()
+        finally:
+            del client.get, client.get_many
+        self.assertEqual(response['X-Nginx-Memcache'], 'django-stale')
+        # The page and its stale copy are looked for together
+        self.assertEqual(calls, ['get_many'])
+
+    def test_fresh_copy_only_served_with_read_through(self):
+        self.view(self.get())
+        cache.set(self.cache_key, 'fresh')
+        response = self.view(self.get())
+        self.assertEqual(response.content, 'content 2')
+        self.assertFalse(response.has_header('X-Nginx-Memcache'))
+        self.assertEqual(self.renders, 2)
+
+    def test_invalidate_including_stale(self):
+        self.view(self.get())
+        invalidate('testserver', '/', include_stale=True)
+        self.assertEqual(cache.get(get_stale_key(self.cache_key)), None)
+        response = self.view(self.get())
+        self.assertEqual(response.content, 'content 2')
+        self.assertFalse(response.has_header('X-Nginx-Memcache'))
+
+    def test_setting_default(self):
+        settings.CACHE_NGINX_MAX_STALE = 600
+        try:
+            cache_page_nginx(self.my_view)(self.get())
+        finally:
+            del settings.CACHE_NGINX_MAX_STALE
+        self.assertEqual(cache.get(get_stale_key(self.cache_key)), 'content 1')
+
+    def test_one_revalidation_at_a_time(self):
+        started = threading.Event()
+        release = threading.Event()
+
+        def slow_render():
+            started.set()
+            release.wait(5)
+
+        thread = start_revalidation(cache, self.cache_key, slow_render)
+        self.assertNotEqual(thread, None)
+        started.wait(5)
+        self.assertEqual(
+            start_revalidation(cache, self.cache_key, slow_render), None
+        )
+        release.set()
+        thread.join(5)
+
+        # The lock is released once it has finished
+        thread = start_revalidation(cache, self.cache_key, lambda: None)
+        self.assertNotEqual(thread, None)
+        thread.join(5)
@@ -0,0 +1,71 @@
+"""Tests for cacheing streamed responses by teeing them to memcache"""
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import nginx_cache as cache, get_cache_key
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.streaming import tee_streaming_response
+
+
+class FakeStreamingResponse(object):
+    """Just enough of a Django 1.5+ StreamingHttpResponse"""
+    streaming = True
+
+    def __init__(self, chunks):
+        self.streaming_content = iter(chunks)
+
+
+class StreamingResponseTests(TestCase):
+
+    def setUp(self):
+        self.factory = RequestFactory()
+        self.request = self.factory.get('/export/', SERVER_NAME="example1.com")
+        cache.clear()
+        self.cache_key = get_cache_key(
+            self.request.get_host(),
+            self.request.get_full_path()
+        )
+
+    def tearDown(self):
+        if hasattr(settings, 'CACHE_NGINX_STREAMING_MAX_SIZE'):
+            del settings.CACHE_NGINX_STREAMING_MAX_SIZE
+
+    def stream_view(self, request):
+        return HttpResponse(iter(['first,', 'second,', u'third']))
+
+    def test_stream_cached_once_complete(self):
+        response = cache_page_nginx(self.stream_view)(self.request)
+
+        # Nothing is cached before the body has been sent...
+        self.assertEqual(cache.get(self.cache_key), None)
+        # ...and the client gets the body unchanged
+        self.assertEqual(''.join(response), 'first,second,third')
+        self.assertEqual(cache.get(self.cache_key), 'first,second,third')
+
+    def test_stream_over_size_cap_not_cached(self):
+        settings.CACHE_NGINX_STREAMING_MAX_SIZE = 10
+        response = cache_page_nginx(self.stream_view)(self.request)
+        self.assertEqual(''.join(response), 'first,second,third')
+        self.assertEqual(cache.get(self.cache_key), None)
+
+    def test_failed_stream_not_cached(self):
+        def broken_chunks():
+            yield 'first,'
+            raise IOError("export went wrong")
+
+        def broken_view(request):
+            return HttpResponse(broken_chunks())
+
+        response = cache_page_nginx(broken_view)(self.request)
+        self.assertRaises(IOError, lambda: ''.join(response))
+        self.assertEqual(cache.get(self.cache_key), None)
+
+    def test_streaming_content_is_teed(self):
+        stored = []
+        response = FakeStreamingResponse(['a', 'b'])
+        tee_streaming_response(response, stored.append, max_size=100)
+        self.assertEqual(list(response.streaming_content), ['a', 'b'])
+        self.assertEqual(stored, ['ab'])
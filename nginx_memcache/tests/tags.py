@@ -0,0 +1,102 @@
+"""Tests for tagging cached pages, and invalidating them by tag"""
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import (
+    add_key_to_lookup,
+    get_cache_key,
+    invalidate_tags,
+    nginx_cache as cache,
+    tagged_records
+)
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.models import CachedPageTag
+from nginx_memcache.signals import invalidate_tagged_pages
+
+
+class CachedPageTagTests(TestCase):
+
+    def setUp(self):
+        setattr(settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', True)
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def cache_page(self, path, tags):
+        request = self.factory.get(path, SERVER_NAME='example1.com')
+        cache_page_nginx(self.my_view, tags=tags)(request)
+        cache_key = get_cache_key('example1.com', path)
+        self.assertEqual(cache.get(cache_key), 'content')
+        return cache_key
+
+    def test_page_can_have_many_tags(self):
+        key = self.cache_page('/a/', ['article:1', 'author:7', 'news'])
+        self.assertEqual(
+            sorted(CachedPageTag.objects.filter(
+                page=key
+            ).values_list('tag', flat=True)),
+            ['article:1', 'author:7', 'news']
+        )
+
+    def test_recaching_adds_new_tags_only(self):
+        key = self.cache_page('/a/', ['article:1'])
+        self.cache_page('/a/', ['article:1', 'article:2'])
+        self.assertEqual(CachedPageTag.objects.filter(page=key).count(), 2)
+        add_key_to_lookup(key, 'example1.com', None, tags=['article:2'])
+        self.assertEqual(CachedPageTag.objects.filter(page=key).count(), 2)
+
+    def test_tags_from_request(self):
+        key = self.cache_page(
+            '/a/?id=3', lambda request: ['article:%s' % request.GET['id']]
+        )
+        self.assertEqual(
+            list(tagged_records(['article:3']).values_list('pk', flat=True)),
+            [key]
+        )
+
+    def test_invalidate_any(self):
+        a = self.cache_page('/a/', ['article:1', 'news'])
+        b = self.cache_page('/b/', ['article:2', 'news'])
+        c = self.cache_page('/c/', ['article:3'])
+
+        self.assertEqual(invalidate_tags(['article:1', 'article:2']), 2)
+        self.assertEqual(cache.get(a), None)
+        self.assertEqual(cache.get(b), None)
+        self.assertEqual(cache.get(c), 'content')
+
+    def test_invalidate_all(self):
+        a = self.cache_page('/a/', ['article:1', 'news'])
+        b = self.cache_page('/b/', ['article:1'])
+        c = self.cache_page('/c/', ['news'])
+
+        self.assertEqual(
+            invalidate_tags(['article:1', 'news'], match='all'), 1
+        )
+        self.assertEqual(cache.get(a), None)
+        self.assertEqual(cache.get(b), 'content')
+        self.assertEqual(cache.get(c), 'content')
+
+    def test_invalidate_in_chunks(self):
+        settings.CACHE_NGINX_BULK_CHUNK_SIZE = 2
+        try:
+            keys = [
+                self.cache_page('/%d/' % i, ['news']) for i in range(5)
+            ]
+            self.assertEqual(invalidate_tags(['news'], match='all'), 5)
+        finally:
+            del settings.CACHE_NGINX_BULK_CHUNK_SIZE
+        for key in keys:
+            self.assertEqual(cache.get(key), None)
+
+    def test_bad_match(self):
+        self.assertRaises(ValueError, tagged_records, ['news'], 'some')
+
+    def test_signal(self):
+        a = self.cache_page('/a/', ['news'])
+        invalidate_tagged_pages.send(sender=self, tags=['news'])
+        self.assertEqual(cache.get(a), None)
@@ -0,0 +1,112 @@
+"""Tests for timing the stages of cacheing a response"""
+
+from django.contrib.auth.models import AnonymousUser, User
+from django.http import HttpResponse
+from django.template import Template
+from django.template.response import TemplateResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.cache import cache_response, nginx_cache as cache
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.timing import (
+    NullTimer,
+    format_server_timing,
+    start_timer
+)
+
+timings_seen = []
+
+
+def record_timings(request, timings):
+    timings_seen.append(timings)
+
+
+class StageTimingTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        del timings_seen[:]
+        self.factory = RequestFactory()
+        settings.CACHE_NGINX_TIMING = True
+        settings.CACHE_NGINX_TIMING_CALLBACK = (
+            'nginx_memcache.tests.timing.record_timings'
+        )
+        self._use_lookup_table = getattr(
+            settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', False
+        )
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = True
+
+    def tearDown(self):
+        for name in (
+            'CACHE_NGINX_TIMING',
+            'CACHE_NGINX_TIMING_CALLBACK',
+            'CACHE_NGINX_TIMING_SAMPLE_RATE',
+            'CACHE_NGINX_SERVER_TIMING',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = self._use_lookup_table
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def my_template_view(self, request):
+        return TemplateResponse(request, Template('content'))
+
+    def get(self, user=None):
+        request = self.factory.get('/')
+        request.user = user or AnonymousUser()
+        return request
+
+    def test_stages_timed(self):
+        view = cache_page_nginx(
+            self.my_view, page_version_fn=lambda request: 'v'
+        )
+        view(self.get())
+        self.assertEqual(len(timings_seen), 1)
+        self.assertEqual(
+            [stage for stage, seconds in timings_seen[0]],
+            ['page_version', 'cache_key', 'memcache_set', 'lookup_table']
+        )
+        for stage, seconds in timings_seen[0]:
+            self.assertTrue(seconds >= 0)
+
+    def test_render_timed(self):
+        request = self.get()
+        cache_response(request, self.my_template_view(request))
+        self.assertEqual(timings_seen[0][0][0], 'render')
+
+    def test_off_by_default(self):
+        del settings.CACHE_NGINX_TIMING
+        self.assertTrue(isinstance(start_timer(self.get()), NullTimer))
+        cache_page_nginx(self.my_view)(self.get())
+        self.assertEqual(timings_seen, [])
+
+    def test_sampling(self):
+        settings.CACHE_NGINX_TIMING_SAMPLE_RATE = 0
+        cache_page_nginx(self.my_view)(self.get())
+        self.assertEqual(timings_seen, [])
+
+    def test_server_timing_header_for_staff(self):
+        view = cache_page_nginx(self.my_view)
+        response = view(self.get())
+        self.assertFalse(response.has_header('Server-Timing'))
+
+        response = view(self.get(User(username='editor', is_staff=True)))
+        self.assertTrue(response['Server-Timing'].startswith('nm-page_version;dur='))
+
+    def test_server_timing_header_modes(self):
+        view = cache_page_nginx(self.my_view)
+        settings.CACHE_NGINX_SERVER_TIMING = 'always'
+        self.assertTrue(view(self.get()).has_header('Server-Timing'))
+        settings.CACHE_NGINX_SERVER_TIMING = 'never'
+        staff = User(username='editor', is_staff=True)
+        self.assertFalse(view(self.get(staff)).has_header('Server-Timing'))
+
+    def test_format(self):
+        self.assertEqual(
+            format_server_timing([('render', 0.0012), ('cache_key', 0)]),
+            'nm-render;dur=1.200, nm-cache_key;dur=0.000'
+        )
@@ -0,0 +1,140 @@
+"""Tests for adaptive cache timeouts and timeout jitter"""
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache import ttl
+from nginx_memcache.cache import (
+    nginx_cache as cache,
+    get_cache_key,
+    invalidate,
+    invalidate_from_request,
+    invalidate_many
+)
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.ttl import AdaptiveTTLPolicy, get_ttl_report, jitter
+
+
+class AdaptiveTTLPolicyTests(TestCase):
+
+    def setUp(self):
+        self.policy = AdaptiveTTLPolicy(min_ttl=10, max_ttl=100)
+        self._time = ttl.time.time
+        self.now = 1000.0
+        ttl.time.time = lambda: self.now
+
+    def tearDown(self):
+        ttl.time.time = self._time
+
+    def test_ttl_starts_at_default_within_bounds(self):
+        self.assertEqual(self.policy.record_cache('a', 50), 50)
+        self.assertEqual(self.policy.record_cache('b', 5000), 100)
+
+    def test_ttl_grows_when_recached_without_invalidation(self):
+        self.assertEqual(self.policy.record_cache('a', 30), 30)
+        self.now += 30
+        self.assertEqual(self.policy.record_cache('a', 30), 60)
+        self.now += 60
+        self.assertEqual(self.policy.record_cache('a', 30), 100)
+
+    def test_ttl_kept_when_recached_before_expiry(self):
+        # Invalidated by another process, or evicted
+        self.assertEqual(self.policy.record_cache('a', 30), 30)
+        self.now += 10
+        self.assertEqual(self.policy.record_cache('a', 30), 30)
+        self.now += 29
+        self.assertEqual(self.policy.record_cache('a', 30), 30)
+
+    def test_ttl_follows_invalidation_interval(self):
+        self.policy.record_cache('a', 100)
+        self.policy.record_invalidation('a')
+        self.now += 20
+        self.policy.record_invalidation('a')
+        self.assertEqual(self.policy.record_cache('a', 100), 20)
+
+    def test_unknown_scopes_not_tracked_on_invalidation(self):
+        self.policy.record_invalidation('never-cached')
+        self.assertEqual(self.policy.report(), {})
+
+    def test_oldest_scope_forgotten(self):
+        policy = AdaptiveTTLPolicy(min_ttl=10, max_ttl=100, max_entries=2)
+        for scope in ('a', 'b', 'c'):
+            policy.record_cache(scope, 50)
+        self.assertEqual(sorted(policy.report().keys()), ['b', 'c'])
+
+
+class AdaptiveTTLTests(TestCase):
+
+    def setUp(self):
+        ttl.reset_ttl_policy()
+        self._time = ttl.time.time
+        self.now = 1000.0
+        ttl.time.time = lambda: self.now
+        self.factory = RequestFactory()
+        self.request = self.factory.get('/', SERVER_NAME="example1.com")
+        cache.clear()
+        self.cache_key = get_cache_key(
+            self.request.get_host(),
+            self.request.get_full_path()
+        )
+
+    def tearDown(self):
+        for name in (
+            'CACHE_NGINX_TTL_JITTER',
+            'CACHE_NGINX_ADAPTIVE_TTL_SCOPE',
+        ):
+            if hasattr(settings, name):
+                delattr(settings, name)
+        ttl.time.time = self._time
+        ttl.reset_ttl_policy()
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def test_chosen_ttls_visible_in_report(self):
+        my_view_cached = cache_page_nginx(
+            self.my_view,
+            cache_timeout=120,
+            adaptive_ttl=True
+        )
+        my_view_cached(self.request)
+        self.assertEqual(get_ttl_report()[self.cache_key]['ttl'], 120)
+
+        # Expired and re-cached without changing
+        self.now += 120
+        my_view_cached(self.request)
+        self.assertEqual(get_ttl_report()[self.cache_key]['ttl'], 240)
+
+        invalidate_from_request(self.request)
+        entry = get_ttl_report()[self.cache_key]
+        self.assertEqual(entry['invalidations'], 1)
+        self.assertEqual(entry['caches'], 2)
+
+    def test_identifier_scope(self):
+        settings.CACHE_NGINX_ADAPTIVE_TTL_SCOPE = 'identifier'
+        my_view_cached = cache_page_nginx(
+            self.my_view,
+            cache_timeout=120,
+            lookup_identifier='site-1',
+            adaptive_ttl=True
+        )
+        my_view_cached(self.request)
+        invalidate('example1.com', '/', lookup_identifier='site-1')
+        invalidate_many([{
+            'request_host': 'example1.com',
+            'request_path': '/',
+            'lookup_identifier': 'site-1',
+        }])
+        report = get_ttl_report()
+        self.assertEqual(report.keys(), ['site-1'])
+        self.assertEqual(report['site-1']['invalidations'], 2)
+
+    def test_jitter_spreads_timeouts(self):
+        self.assertEqual(jitter(100), 100)
+        settings.CACHE_NGINX_TTL_JITTER = 0.1
+        timeouts = set(jitter(1000) for _ in range(50))
+        self.assertTrue(len(timeouts) > 1)
+        self.assertTrue(min(timeouts) >= 900)
+        self.assertTrue(max(timeouts) <= 1100)
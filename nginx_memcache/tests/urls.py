@@ -0,0 +1,46 @@
+from django.conf.urls import patterns, include, url
+from django.contrib import admin
+from django.http import Http404, HttpResponse
+from django.template import RequestContext, Template
+
+from nginx_memcache.decorators import cache_page_nginx
+
+admin.autodiscover()
+
+
+@cache_page_nginx
+def cached_page(request, number):
+    return HttpResponse('page %s' % number)
+
+
+@cache_page_nginx
+def page_shell(request):
+    return HttpResponse(Template(
+        "{% load nginx_fragments %}"
+        "<div>{% nginx_fragment 'news' %}</div>"
+        "<div>{% nginx_fragment 'greeting' %}</div>"
+    ).render(RequestContext(request, {'request': request})))
+
+# What each editable page says; tests change it to see pages refreshed
+page_contents = {}
+
+
+@cache_page_nginx(page_version_fn=lambda request: request.COOKIES.get('pv', ''))
+def editable_page(request, slug):
+    if slug not in page_contents:
+        raise Http404
+    return HttpResponse(page_contents[slug])
+
+
+@cache_page_nginx(max_stale=600)
+def stale_page(request, slug):
+    return HttpResponse(page_contents[slug])
+
+urlpatterns = patterns('',
+    url(r'^admin/', include(admin.site.urls)),
+    url(r'^cached/(\d+)/$', cached_page),
+    url(r'^shell/$', page_shell),
+    url(r'^editable/(\w+)/$', editable_page),
+    url(r'^stale/(\w+)/$', stale_page),
+    url(r'^_fragment/', include('nginx_memcache.urls')),
+)
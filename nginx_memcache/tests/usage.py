@@ -0,0 +1,70 @@
+"""Tests for memcache byte accounting via the lookup table"""
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.models import CachedPageRecord
+from nginx_memcache.cache import nginx_cache as cache
+from nginx_memcache.usage import usage_report
+
+
+class UsageReportTests(TestCase):
+
+    def setUp(self):
+        #monkey-patch settings for test purposes
+        setattr(settings, 'CACHE_NGINX_USE_LOOKUP_TABLE', True)
+        self.factory = RequestFactory()
+        cache.clear()
+
+    def cache_page(self, host, path, content, **kwargs):
+        view = cache_page_nginx(lambda request: HttpResponse(content), **kwargs)
+        view(self.factory.get(path, SERVER_NAME=host))
+
+    def test_stored_bytes_recorded_and_updated(self):
+        self.cache_page('example1.com', '/', 'x' * 10)
+        self.assertEqual(CachedPageRecord.objects.get().stored_bytes, 10)
+
+        self.cache_page('example1.com', '/', 'x' * 25)
+        self.assertEqual(CachedPageRecord.objects.get().stored_bytes, 25)
+
+    def test_usage_by_parent_identifier(self):
+        self.cache_page('example1.com', '/a/', 'x' * 10)
+        self.cache_page('example1.com', '/b/', 'x' * 30)
+        self.cache_page('example2.com', '/a/', 'x' * 100)
+
+        self.assertEqual(usage_report(), [
+            {
+                'identifier': 'example2.com',
+                'pages': 1,
+                'total_bytes': 100,
+                'average_bytes': 100
+            },
+            {
+                'identifier': 'example1.com',
+                'pages': 2,
+                'total_bytes': 40,
+                'average_bytes': 20
+            },
+        ])
+
+    def test_usage_by_supplementary_identifier_within_site(self):
+        self.cache_page('example1.com', '/a/', 'x' * 10,
+            supplementary_identifier='news')
+        self.cache_page('example1.com', '/b/', 'x' * 30,
+            supplementary_identifier='news')
+        self.cache_page('example1.com', '/c/', 'x' * 5,
+            supplementary_identifier='events')
+        self.cache_page('example2.com', '/d/', 'x' * 500,
+            supplementary_identifier='news')
+
+        report = usage_report(
+            group_by='supplementary_identifier',
+            lookup_identifier='example1.com'
+        )
+        self.assertEqual(
+            [(row['identifier'], row['total_bytes']) for row in report],
+            [('news', 40), ('events', 5)]
+        )
@@ -0,0 +1,117 @@
+"""Tests for pages that vary by several cookies and headers"""
+
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+
+from nginx_memcache.cache import get_cache_key, nginx_cache as cache
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.harness import nginx_cache_key
+from nginx_memcache.nginxconf import variant_map
+from nginx_memcache.variants import Cookie, Header, VariantSpec
+
+SPEC = VariantSpec('article', [
+    Header('lang', 'Accept-Language', [(r'^fr', 'fr'), (r'^de', 'de')],
+        default='en'),
+    Header('device', 'User-Agent', [(r'mobile|iphone', 'mobile')],
+        default='desktop'),
+    Cookie('ab', 'ab_bucket', ['a', 'b'], default='a'),
+])
+
+
+class VariantSpecTests(TestCase):
+
+    def setUp(self):
+        cache.clear()
+        self.factory = RequestFactory()
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def get(self, **extra):
+        request = self.factory.get('/article/', **extra)
+        request.user = AnonymousUser()
+        return request
+
+    def test_page_version(self):
+        self.assertEqual(SPEC.page_version(self.get()), 'en.desktop.a')
+        request = self.get(
+            HTTP_ACCEPT_LANGUAGE='fr-FR,fr;q=0.9',
+            HTTP_USER_AGENT='Mozilla/5.0 (iPhone; ...) Mobile/15E148',
+        )
+        request.COOKIES['ab_bucket'] = 'b'
+        self.assertEqual(SPEC.page_version(request), 'fr.mobile.b')
+        # Unknown cookie values count as the default
+        request.COOKIES['ab_bucket'] = 'z'
+        self.assertEqual(SPEC.page_version(request), 'fr.mobile.a')
+
+    def test_all_page_versions(self):
+        versions = SPEC.all_page_versions()
+        self.assertEqual(len(versions), 3 * 2 * 2)
+        self.assertEqual(versions[0], 'en.desktop.a')
+        self.assertTrue('de.mobile.b' in versions)
+
+    def test_cached_under_variant_key(self):
+        view = cache_page_nginx(self.my_view, variants=SPEC)
+        response = view(self.get(HTTP_ACCEPT_LANGUAGE='de'))
+        key = get_cache_key('testserver', '/article/', 'de.desktop.a')
+        self.assertEqual(cache.get(key), 'content')
+        # nginx works the version out itself; no cookie needed
+        self.assertFalse('pv' in response.cookies)
+        self.assertEqual(
+            response['Vary'], 'Accept-Language, User-Agent, Cookie'
+        )
+
+    def test_nginx_finds_it_with_the_same_key(self):
+        self.assertEqual(
+            nginx_cache_key('example.com', '/article/', 'pv=fr.mobile.b'),
+            ':1:' + get_cache_key('example.com', '/article/', 'fr.mobile.b')
+        )
+
+    def test_invalidate_every_variant(self):
+        view = cache_page_nginx(self.my_view, variants=SPEC)
+        view(self.get())
+        view(self.get(HTTP_ACCEPT_LANGUAGE='fr', HTTP_USER_AGENT='mobile'))
+        other = self.factory.get('/other/')
+        other.user = AnonymousUser()
+        view(other)
+
+        SPEC.invalidate('testserver', '/article/')
+        for key in SPEC.cache_keys('testserver', '/article/'):
+            self.assertEqual(cache.get(key), None)
+        self.assertEqual(
+            cache.get(get_cache_key('testserver', '/other/', 'en.desktop.a')),
+            'content'
+        )
+
+    def test_bad_values(self):
+        self.assertRaises(
+            ValueError, Cookie, 'ab', 'ab_bucket', ['a.b'], default='a'
+        )
+        self.assertRaises(ValueError, VariantSpec, 'no spaces', [])
+
+    def test_nginx_config(self):
+        self.assertEqual(variant_map(SPEC), '\n'.join([
+            'map $http_accept_language $nm_article_lang {',
+            '    "~*^fr" fr;',
+            '    "~*^de" de;',
+            '    default en;',
+            '}',
+            '',
+            'map $http_user_agent $nm_article_device {',
+            '    "~*mobile|iphone" mobile;',
+            '    default desktop;',
+            '}',
+            '',
+            'map $cookie_ab_bucket $nm_article_ab {',
+            '    "~*^a$" a;',
+            '    "~*^b$" b;',
+            '    default a;',
+            '}',
+            '',
+            '# In the locations serving article pages, in place of the page '
+            'version cookie:',
+            'set $page_version "${nm_article_lang}.${nm_article_device}.'
+            '${nm_article_ab}";',
+        ]))
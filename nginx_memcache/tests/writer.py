@@ -0,0 +1,115 @@
+"""Tests for the background writer, which takes memcache
+operations off the request/response cycle
+"""
+
+import threading
+
+from django.http import HttpResponse
+from django.test import TestCase
+from django.test.client import RequestFactory
+from django.conf import settings
+
+from nginx_memcache.decorators import cache_page_nginx
+from nginx_memcache.cache import (
+    nginx_cache as cache,
+    get_cache_key,
+    invalidate_from_request
+)
+from nginx_memcache import writer as writer_module
+from nginx_memcache.writer import BackgroundWriter, get_writer
+
+
+class BackgroundWriterTests(TestCase):
+
+    def setUp(self):
+        #monkey-patch settings for test purposes
+        setattr(settings, 'CACHE_NGINX_BACKGROUND_WRITES', True)
+
+        self.factory = RequestFactory()
+        self.request = self.factory.get('/', SERVER_NAME="example1.com")
+        cache.clear()
+        self.cache_key = get_cache_key(
+            self.request.get_host(),
+            self.request.get_full_path()
+        )
+        assert not cache.get(self.cache_key)
+
+    def tearDown(self):
+        setattr(settings, 'CACHE_NGINX_BACKGROUND_WRITES', False)
+        if hasattr(settings, 'CACHE_NGINX_USE_LOOKUP_TABLE'):
+            delattr(settings, 'CACHE_NGINX_USE_LOOKUP_TABLE')
+
+    def my_view(self, request):
+        return HttpResponse('content')
+
+    def test_response_cached_by_background_writer(self):
+        my_view_cached = cache_page_nginx(self.my_view)
+        self.assertEqual(my_view_cached(self.request).content, 'content')
+
+        get_writer().flush()
+        self.assertEqual(cache.get(self.cache_key), 'content')
+
+    def test_invalidation_via_background_writer(self):
+        my_view_cached = cache_page_nginx(self.my_view)
+        my_view_cached(self.request)
+        get_writer().flush()
+        assert cache.get(self.cache_key)
+
+        invalidate_from_request(self.request)
+        get_writer().flush()
+        self.assertEqual(cache.get(self.cache_key), None)
+
+    def test_operations_dropped_when_queue_full(self):
+        writer = BackgroundWriter(max_queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+        calls = []
+
+        def block():
+            started.set()
+            release.wait()
+
+        # The first operation blocks the worker, the second fills
+        # the queue, so the third has nowhere to go
+        self.assertTrue(writer.submit(block))
+        started.wait()
+        self.assertTrue(writer.submit(calls.append, 1))
+        self.assertFalse(writer.submit(calls.append, 2))
+
+        release.set()
+        writer.flush()
+        self.assertEqual(calls, [1])
+
+    def test_invalidation_waits_when_queue_full(self):
+        # The invalidation runs in a thread of its own, which can't see
+        # the test database
+        settings.CACHE_NGINX_USE_LOOKUP_TABLE = False
+        cache.set(self.cache_key, 'content')
+        writer = BackgroundWriter(max_queue_size=1)
+        started = threading.Event()
+        release = threading.Event()
+
+        def block():
+            started.set()
+            release.wait()
+
+        original_writer = writer_module._writer
+        writer_module._writer = writer
+        try:
+            writer.submit(block)
+            started.wait()
+            self.assertTrue(writer.submit(lambda: None))
+            invalidating = threading.Thread(
+                target=invalidate_from_request, args=(self.request,)
+            )
+            invalidating.start()
+            # Not dropped, but waiting for room on the queue
+            invalidating.join(0.2)
+            self.assertTrue(invalidating.is_alive())
+
+            release.set()
+            invalidating.join()
+            writer.flush()
+        finally:
+            writer_module._writer = original_writer
+        self.assertEqual(cache.get(self.cache_key), None)
@@ -0,0 +1,135 @@
+"""Timing each stage of cacheing a response.
+
+With settings.CACHE_NGINX_TIMING on, cache_response() times each stage of
+its work - rendering, page_version_fn, the cache key, the admission check,
+minification, the memcache set and the lookup table INSERT - for a sample
+of responses (settings.CACHE_NGINX_TIMING_SAMPLE_RATE, from 0 to 1).
+
+The timings of each sampled response are:
+
+    * passed to settings.CACHE_NGINX_TIMING_CALLBACK (a function, or its
+      dotted path), as callback(request, timings), where timings is a list
+      of (stage, seconds) in the order the stages ran
+    * added to the response as a Server-Timing header (which browsers'
+      developer tools show), depending on settings.CACHE_NGINX_SERVER_TIMING:
+      'staff' (the default) for staff users, or anyone when DEBUG is on;
+      'always'; or 'never'
+
+NB: a streamed response is only cached after it has been sent, so its
+memcache set and INSERT aren't timed; with background writes on, the
+memcache set is only the time taken to queue it.
+
+"""
+
+import random
+import time
+
+from django.conf import settings
+from django.utils.importlib import import_module
+
+SERVER_TIMING_HEADER = 'Server-Timing'
+# Prefixed to each stage name in the header, to tell them apart from
+# anyone else's
+SERVER_TIMING_PREFIX = 'nm-'
+
+
+class _NoStage(object):
+    def __enter__(self):
+        pass
+
+    def __exit__(self, *exc_info):
+        pass
+
+_no_stage = _NoStage()
+
+
+class NullTimer(object):
+    """What responses that aren't timed get: does nothing, cheaply"""
+
+    timings = ()
+
+    def stage(self, name):
+        return _no_stage
+
+    def finish(self, request, response):
+        pass
+
+_null_timer = NullTimer()
+
+
+class _Stage(object):
+    def __init__(self, timer, name):
+        self.timer = timer
+        self.name = name
+
+    def __enter__(self):
+        self.started = time.time()
+
+    def __exit__(self, *exc_info):
+        self.timer.timings.append((self.name, time.time() - self.started))
+
+
+class StageTimer(object):
+    """Collects (stage, seconds) for one response. Use as:
+
+        with timer.stage('render'):
+            response.render()
+
+    """
+
+    def __init__(self):
+        self.timings = []
+
+    def stage(self, name):
+        return _Stage(self, name)
+
+    def finish(self, request, response):
+        """Hand the timings to the callback, and add the Server-Timing
+        header if appropriate"""
+        callback = _get_callback()
+        if callback is not None:
+            callback(request, list(self.timings))
+        if show_server_timing(request):
+            response[SERVER_TIMING_HEADER] = format_server_timing(
+                self.timings
+            )
+
+
+def _get_callback():
+    callback = getattr(settings, 'CACHE_NGINX_TIMING_CALLBACK', None)
+    if isinstance(callback, basestring):
+        module, _, name = callback.rpartition('.')
+        callback = getattr(import_module(module), name)
+    return callback
+
+
+def start_timer(request):
+    """Returns a StageTimer if this response is to be timed, otherwise a
+    NullTimer"""
+    if not getattr(settings, 'CACHE_NGINX_TIMING', False):
+        return _null_timer
+    rate = getattr(settings, 'CACHE_NGINX_TIMING_SAMPLE_RATE', 1.0)
+    if rate < 1 and random.random() >= rate:
+        return _null_timer
+    return StageTimer()
+
+
+def show_server_timing(request):
+    """Whether this request should get a Server-Timing header"""
+    mode = getattr(settings, 'CACHE_NGINX_SERVER_TIMING', 'staff')
+    if mode == 'always':
+        return True
+    if mode == 'staff':
+        if settings.DEBUG:
+            return True
+        user = getattr(request, 'user', None)
+        return user is not None and user.is_staff
+    return False
+
+
+def format_server_timing(timings):
+    """Server-Timing header value for a list of (stage, seconds)"""
+    return ', '.join(
+        '%s%s;dur=%.3f' % (SERVER_TIMING_PREFIX, name, seconds * 1000)
+        for name, seconds in timings
+    )
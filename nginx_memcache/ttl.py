@@ -0,0 +1,180 @@
+"""Adaptive cache timeouts.
+
+A fixed cache_timeout is too short for pages that never change (they expire
+and get re-rendered for nothing) and too long for pages that are
+invalidated every few minutes anyway (they sit in memcache, taking up
+space, long after anyone's likely to see that version).
+
+With settings.CACHE_NGINX_ADAPTIVE_TTL on (or adaptive_ttl=True passed to
+the decorator), each page - or each lookup_identifier, depending on
+settings.CACHE_NGINX_ADAPTIVE_TTL_SCOPE - gets its own timeout, starting
+at the view's cache_timeout and then:
+
+    * doubled whenever the page is re-cached without having been
+      invalidated in between, once its timeout has passed (so it expired
+      without changing)
+    * moved towards the average time between invalidations, whenever it is
+      invalidated
+
+always staying between settings.CACHE_NGINX_TTL_MIN and CACHE_NGINX_TTL_MAX.
+
+Separately, settings.CACHE_NGINX_TTL_JITTER spreads every timeout by up to
+that fraction either way, so that pages cached at the same moment don't all
+expire at the same moment too.
+
+History is kept per process; get_ttl_report() shows what it has chosen.
+A process doesn't hear about invalidations made by another, so a page
+re-cached before its timeout is up is taken to have been invalidated (or
+evicted) elsewhere, and its timeout isn't doubled - otherwise every page
+would drift up to CACHE_NGINX_TTL_MAX.
+
+"""
+
+import random
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+
+# How much weight the latest interval between invalidations gets
+# when updating the running average
+SMOOTHING = 0.3
+
+
+class AdaptiveTTLPolicy(object):
+    """Keeps the invalidation history of up to max_entries scopes (pages or
+    identifiers), forgetting the least recently used beyond that"""
+
+    def __init__(self, min_ttl, max_ttl, max_entries=10000):
+        self.min_ttl = min_ttl
+        self.max_ttl = max_ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _clamp(self, ttl):
+        return int(max(self.min_ttl, min(self.max_ttl, ttl)))
+
+    def _entry(self, scope, default_ttl):
+        entry = self._entries.pop(scope, None)
+        if entry is None:
+            entry = {
+                'ttl': self._clamp(default_ttl),
+                'caches': 0,
+                'invalidations': 0,
+                'last_cached': None,
+                'last_invalidated': None,
+                'mean_invalidation_interval': None,
+                'invalidated_since_cached': True,
+            }
+            if len(self._entries) >= self.max_entries:
+                self._entries.popitem(last=False)
+        # Re-insert, so that it's the most recently used
+        self._entries[scope] = entry
+        return entry
+
+    def record_cache(self, scope, default_ttl):
+        """Note the page is being cached, and return the timeout to use"""
+        now = time.time()
+        # The timeout used may have been cut short by jitter()
+        spread = getattr(settings, 'CACHE_NGINX_TTL_JITTER', 0)
+        with self._lock:
+            entry = self._entry(scope, default_ttl)
+            if (
+                entry['caches'] and
+                not entry['invalidated_since_cached'] and
+                now - entry['last_cached'] >= entry['ttl'] * (1 - spread)
+            ):
+                # It expired, but nothing had changed: keep it for longer
+                entry['ttl'] = self._clamp(entry['ttl'] * 2)
+            entry['caches'] += 1
+            entry['last_cached'] = now
+            entry['invalidated_since_cached'] = False
+            return entry['ttl']
+
+    def record_invalidation(self, scope):
+        """Note the page has been invalidated. Pages this process hasn't
+        cached are ignored, which keeps bulk invalidations cheap"""
+        with self._lock:
+            entry = self._entries.get(scope)
+            if entry is None:
+                return
+            now = time.time()
+            if entry['last_invalidated'] is not None:
+                interval = now - entry['last_invalidated']
+                mean = entry['mean_invalidation_interval']
+                if mean is None:
+                    mean = interval
+                else:
+                    mean = SMOOTHING * interval + (1 - SMOOTHING) * mean
+                entry['mean_invalidation_interval'] = mean
+                entry['ttl'] = self._clamp(mean)
+            entry['last_invalidated'] = now
+            entry['invalidations'] += 1
+            entry['invalidated_since_cached'] = True
+
+    def report(self):
+        with self._lock:
+            return dict(
+                (scope, dict(entry)) for scope, entry in self._entries.items()
+            )
+
+
+_policy = None
+_policy_lock = threading.Lock()
+
+
+def get_policy():
+    """Returns this process's AdaptiveTTLPolicy, creating it if needed"""
+    global _policy
+    if _policy is None:
+        with _policy_lock:
+            if _policy is None:
+                _policy = AdaptiveTTLPolicy(
+                    min_ttl=getattr(settings, 'CACHE_NGINX_TTL_MIN', 60),
+                    max_ttl=getattr(
+                        settings, 'CACHE_NGINX_TTL_MAX', 3600 * 24 * 7
+                    ),
+                    max_entries=getattr(
+                        settings, 'CACHE_NGINX_ADAPTIVE_TTL_MAX_ENTRIES', 10000
+                    )
+                )
+    return _policy
+
+
+def ttl_scope(cache_key, lookup_identifier):
+    """What adaptive timeouts are tracked against: the page's
+    cache key, or its lookup_identifier"""
+    scope = getattr(settings, 'CACHE_NGINX_ADAPTIVE_TTL_SCOPE', 'key')
+    if scope == 'identifier':
+        return lookup_identifier
+    return cache_key
+
+
+def jitter(ttl):
+    """Spread ttl by up to settings.CACHE_NGINX_TTL_JITTER either way"""
+    spread = getattr(settings, 'CACHE_NGINX_TTL_JITTER', 0)
+    if not spread or not ttl:
+        return ttl
+    return max(1, int(round(ttl * random.uniform(1 - spread, 1 + spread))))
+
+
+def record_invalidation(scopes):
+    """Note that the given scopes (see ttl_scope()) have been invalidated,
+    if adaptive timeouts are in use in this process"""
+    if _policy is not None:
+        for scope in scopes:
+            _policy.record_invalidation(scope)
+
+
+def get_ttl_report():
+    """The timeouts currently chosen for each scope, with the history they
+    were chosen from"""
+    return get_policy().report()
+
+
+def reset_ttl_policy():
+    global _policy
+    with _policy_lock:
+        _policy = None
@@ -0,0 +1,15 @@
+"""Include these at CACHE_NGINX_FRAGMENT_PREFIX, eg:
+
+    url(r'^_fragment/', include('nginx_memcache.urls')),
+
+"""
+
+from django.conf.urls import patterns, url
+
+urlpatterns = patterns('nginx_memcache.fragments',
+    url(
+        r'^(?P<name>[\w\-/]+)$',
+        'fragment_view',
+        name='nginx_memcache_fragment'
+    ),
+)
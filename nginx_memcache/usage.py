@@ -0,0 +1,57 @@
+"""Reports on how much memcache each site, or section of a site, is using.
+
+Built on the stored_bytes recorded against each CachedPageRecord, so the
+lookup table (settings.CACHE_NGINX_USE_LOOKUP_TABLE) needs to be on.
+Figures are for pages as last cached: pages which have since expired or
+been evicted are still counted, so treat totals as an upper bound.
+
+"""
+
+from django.db.models import Avg, Count, Sum
+
+from .models import CachedPageRecord
+
+
+def usage_report(
+        group_by='parent_identifier',
+        lookup_identifier=None,
+        limit=None
+    ):
+    """Returns a list of dicts, one per value of group_by (which may be
+    'parent_identifier' or 'supplementary_identifier'), biggest first:
+
+        {
+            'identifier': 'example.com',
+            'pages': 1024,
+            'total_bytes': 52428800,
+            'average_bytes': 51200,
+        }
+
+    Pass lookup_identifier to limit the report to one parent identifier -
+    eg to break a single site down by supplementary_identifier.
+
+    """
+    if group_by not in ('parent_identifier', 'supplementary_identifier'):
+        raise ValueError("Can't group usage by '%s'" % group_by)
+
+    records = CachedPageRecord.objects.all()
+    if lookup_identifier:
+        records = records.filter(parent_identifier=lookup_identifier)
+
+    rows = records.values(group_by).annotate(
+        pages=Count('base_cache_key'),
+        total_bytes=Sum('stored_bytes'),
+        average_bytes=Avg('stored_bytes')
+    ).order_by('-total_bytes')
+    if limit:
+        rows = rows[:limit]
+
+    return [
+        {
+            'identifier': row[group_by],
+            'pages': row['pages'],
+            'total_bytes': row['total_bytes'] or 0,
+            'average_bytes': int(row['average_bytes'] or 0),
+        }
+        for row in rows
+    ]
@@ -0,0 +1,181 @@
+"""Pages that vary by more than one thing.
+
+The cache key has room for one page version, which nginx takes from the pv
+cookie. A VariantSpec builds that page version from any number of
+dimensions instead - cookies, headers, or classes derived from them - each
+of which has a fixed set of values, so that nginx can work out the same
+page version with map blocks, and so that every variant of a page can be
+invalidated together:
+
+    from nginx_memcache.variants import VariantSpec, Cookie, Header
+
+    ARTICLE_VARIANTS = VariantSpec('article', [
+        Header('lang', 'Accept-Language', [(r'^fr', 'fr'), (r'^de', 'de')],
+            default='en'),
+        Header('device', 'User-Agent', [(r'mobile|android|iphone', 'mobile')],
+            default='desktop'),
+        Cookie('ab', 'ab_bucket', ['a', 'b'], default='a'),
+    ])
+
+    @cache_page_nginx(variants=ARTICLE_VARIANTS)
+    def article(request, slug):
+        ...
+
+A rule is (regex, value): like nginx's '~*' map entries, the first regex
+found (case-insensitively) anywhere in the cookie or header gives the
+dimension its value, and if none is, it gets the default.
+
+nginxconf.variant_map(spec) writes the matching nginx config, and
+spec.invalidate(host, path) invalidates every variant of a page at once.
+
+"""
+
+import itertools
+import re
+
+from django.conf import settings
+
+from .cache import get_cache_key, invalidate_keys, key_schemes
+
+_VALUE_RE = re.compile(r'^[\w\-]+$')
+# Joins each dimension's value into the page version
+SEPARATOR = '.'
+
+
+class Dimension(object):
+    """One thing pages vary by: the value of request.META[meta_key] (which
+    nginx has as $<nginx_variable>), classified by rules"""
+
+    def __init__(self, name, meta_key, nginx_variable, rules, default):
+        for value in [default] + [value for pattern, value in rules]:
+            if not _VALUE_RE.match(value):
+                raise ValueError(
+                    "Variant values must be letters, digits, _ or -, "
+                    "not %r" % value
+                )
+        self.name = name
+        self.meta_key = meta_key
+        self.nginx_variable = nginx_variable
+        self.rules = [
+            (pattern, re.compile(pattern, re.IGNORECASE), value)
+            for pattern, value in rules
+        ]
+        self.default = default
+
+    def raw_value(self, request):
+        return request.META.get(self.meta_key, '')
+
+    def classify(self, request):
+        raw = self.raw_value(request)
+        for pattern, regex, value in self.rules:
+            if regex.search(raw):
+                return value
+        return self.default
+
+    @property
+    def values(self):
+        """Every value this dimension can have, default first"""
+        values = [self.default]
+        for pattern, regex, value in self.rules:
+            if value not in values:
+                values.append(value)
+        return values
+
+
+class Header(Dimension):
+    """Varies by a request header (eg 'Accept-Language', 'User-Agent')"""
+
+    def __init__(self, name, header, rules, default):
+        normalised = header.upper().replace('-', '_')
+        super(Header, self).__init__(
+            name,
+            'HTTP_' + normalised,
+            'http_' + normalised.lower(),
+            rules,
+            default
+        )
+
+
+class Cookie(Dimension):
+    """Varies by a cookie, which must have one of the given values (or else
+    counts as the default)"""
+
+    def __init__(self, name, cookie_name, values, default):
+        super(Cookie, self).__init__(
+            name,
+            None,
+            'cookie_' + cookie_name,
+            [('^%s$' % re.escape(value), value) for value in values],
+            default
+        )
+        self.cookie_name = cookie_name
+
+    def raw_value(self, request):
+        return request.COOKIES.get(self.cookie_name, '')
+
+
+class VariantSpec(object):
+    """The dimensions a view's pages vary by. Pass it to the decorator as
+    variants=spec"""
+
+    def __init__(self, name, dimensions):
+        if not _VALUE_RE.match(name):
+            raise ValueError("Variant spec names must be letters, digits, "
+                             "_ or -, not %r" % name)
+        self.name = name
+        self.dimensions = list(dimensions)
+
+    def page_version(self, request):
+        """The page version for this request: every dimension's value"""
+        return SEPARATOR.join(
+            dimension.classify(request) for dimension in self.dimensions
+        )
+
+    def all_page_versions(self):
+        """The page version of every possible variant"""
+        return [
+            SEPARATOR.join(values) for values in itertools.product(
+                *[dimension.values for dimension in self.dimensions]
+            )
+        ]
+
+    def vary_headers(self):
+        """Headers for the Vary response header, for any caches between
+        nginx and the browser"""
+        headers = []
+        for dimension in self.dimensions:
+            if isinstance(dimension, Cookie):
+                header = 'Cookie'
+            else:
+                header = dimension.meta_key[5:].replace('_', '-').title()
+            if header not in headers:
+                headers.append(header)
+        return headers
+
+    def cache_keys(self, request_host, request_path, cookie_name=None):
+        """The cache key of every variant of the page - over HTTP and
+        HTTPS, if the scheme is part of the key"""
+        cookie_name = cookie_name or getattr(
+            settings, 'CACHE_NGINX_COOKIE', 'pv'
+        )
+        return [
+            get_cache_key(
+                request_host, request_path, page_version, cookie_name, scheme
+            )
+            for page_version in self.all_page_versions()
+            for scheme in key_schemes()
+        ]
+
+    def invalidate(
+            self,
+            request_host,
+            request_path,
+            lookup_identifier=None,
+            include_stale=False
+        ):
+        """Invalidate every variant of the page, in one batch"""
+        invalidate_keys(
+            self.cache_keys(request_host, request_path),
+            lookup_identifier or request_host,
+            include_stale
+        )
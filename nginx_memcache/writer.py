@@ -0,0 +1,117 @@
+"""A background writer for memcache operations, so that the
+request/response cycle doesn't have to wait on memcache round trips.
+
+Enabled with settings.CACHE_NGINX_BACKGROUND_WRITES. Operations are put on
+a bounded queue and carried out, in order, by a single daemon thread per
+process. That thread keeps using the same cache client - and so the same
+memcache connection - for every operation it performs.
+
+"""
+
+import logging
+import os
+import threading
+import Queue
+
+from django.conf import settings
+
+
+class BackgroundWriter(object):
+    """Runs queued cache operations on a daemon worker thread.
+
+    If the queue is full, a write is dropped (and logged) rather than
+    blocking the request: a page that isn't cached will simply be cached next
+    time it's requested. An invalidation can't be dropped - the page would be
+    served stale until it expired - so submit_blocking() waits for room
+    instead, keeping it in order behind the writes already queued.
+
+    """
+
+    def __init__(self, max_queue_size=1000):
+        self.max_queue_size = max_queue_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._queue = None
+        self._thread = None
+
+    def _ensure_started(self):
+        # Threads don't survive a fork, so a forked worker process
+        # needs its own queue and thread.
+        pid = os.getpid()
+        if self._pid == pid and self._thread.is_alive():
+            return
+        with self._lock:
+            if self._pid == pid and self._thread.is_alive():
+                return
+            self._queue = Queue.Queue(maxsize=self.max_queue_size)
+            self._thread = threading.Thread(
+                target=self._run,
+                args=(self._queue,),
+                name="nginx-memcache-writer"
+            )
+            self._thread.daemon = True
+            self._thread.start()
+            self._pid = pid
+
+    def _run(self, queue):
+        while True:
+            fn, args, kwargs = queue.get()
+            try:
+                fn(*args, **kwargs)
+            except Exception:
+                logging.exception("Background cache operation failed")
+            finally:
+                queue.task_done()
+
+    def submit(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) to be run by the worker thread.
+        Returns False if the operation had to be dropped."""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+        except Queue.Full:
+            logging.warning(
+                "Background cache queue full; dropping %s" % fn.__name__
+            )
+            return False
+        return True
+
+    def submit_blocking(self, fn, *args, **kwargs):
+        """Queue fn(*args, **kwargs) to be run by the worker thread, waiting
+        for room on the queue if it's full"""
+        self._ensure_started()
+        try:
+            self._queue.put_nowait((fn, args, kwargs))
+        except Queue.Full:
+            logging.warning(
+                "Background cache queue full; waiting to queue %s" % (
+                    fn.__name__
+                )
+            )
+            self._queue.put((fn, args, kwargs))
+
+    def flush(self):
+        """Block until every queued operation has been carried out.
+        Mainly of use in tests and management commands."""
+        if self._queue is not None and self._pid == os.getpid():
+            self._queue.join()
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    """Returns the process-wide BackgroundWriter, creating it if needed"""
+    global _writer
+    if _writer is None:
+        with _writer_lock:
+            if _writer is None:
+                _writer = BackgroundWriter(
+                    max_queue_size=getattr(
+                        settings,
+                        'CACHE_NGINX_BACKGROUND_QUEUE_SIZE',
+                        1000
+                    )
+                )
+    return _writer